@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# encoding=utf-8
+# per-frame cost of compositing the mouse cursor into a captured frame
+# compares the previous per-pixel python loop with the current vectorized merge_cursor
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import remotedesktopwebserver
+
+CURSOR_BGRA_IMAGE = remotedesktopwebserver.CURSOR_BGRA_IMAGE
+CURSOR_HEIGHT = remotedesktopwebserver.CURSOR_HEIGHT
+CURSOR_WIDTH = remotedesktopwebserver.CURSOR_WIDTH
+
+LEGACY_NON_ALPHA_INDEX_LIST = []
+for y in range(CURSOR_HEIGHT):
+    x_index_list = []
+    for x in range(CURSOR_WIDTH):
+        if CURSOR_BGRA_IMAGE[y, x][3] != 0:
+            x_index_list.append(x)
+    LEGACY_NON_ALPHA_INDEX_LIST.append(x_index_list)
+
+
+def legacy_merge_cursor(
+    bgra_image: np.ndarray,
+    location: tuple,
+    monitor_region: dict,
+):
+    # the implementation before the vectorized version, kept here for comparison only
+    mousex, mousey = location
+    monitor_left = monitor_region['left']
+    monitor_top = monitor_region['top']
+    monitor_right = monitor_region['left'] + monitor_region['width']
+    monitor_bottom = monitor_region['top'] + monitor_region['height']
+
+    if mousex < monitor_left or mousex > monitor_right:
+        return
+
+    if mousey < monitor_top or mousey > monitor_bottom:
+        return
+
+    image_height, image_width = bgra_image.shape[:2]
+    for y in range(CURSOR_HEIGHT):
+        real_y = y + mousey
+        if real_y >= image_height:
+            break
+
+        color_index_list = LEGACY_NON_ALPHA_INDEX_LIST[y]
+        for x in color_index_list:
+            real_x = x + mousex
+            if real_x >= image_width:
+                break
+
+            bgra_image[real_y, real_x][0:3] = CURSOR_BGRA_IMAGE[y, x][0:3]
+
+
+def benchmark(
+    merge_function,
+    bgra_image: np.ndarray,
+    location_list: list,
+    monitor_region: dict,
+    number_of_iterations: int,
+):
+    duration_list = []
+    for _ in range(number_of_iterations):
+        for location in location_list:
+            start_time = time.perf_counter_ns()
+            merge_function(bgra_image, location, monitor_region)
+            duration_list.append(time.perf_counter_ns() - start_time)
+
+    duration_list.sort()
+    median_us = duration_list[len(duration_list) // 2] / 1000
+    p99_us = duration_list[int(len(duration_list) * 0.99)] / 1000
+    return median_us, p99_us
+
+
+def main():
+    parser = argparse.ArgumentParser(description='merge_cursor micro-benchmark')
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--iterations', type=int, default=2000)
+    args = parser.parse_args()
+    print(args)
+
+    monitor_region = {
+        'left': 0,
+        'top': 0,
+        'width': args.width,
+        'height': args.height,
+    }
+
+    bgra_image = np.random.randint(0, 256, (args.height, args.width, 4), dtype=np.uint8)
+    location_list = [
+        # fully inside the frame
+        (args.width // 2, args.height // 2),
+        (10, 10),
+        # clipped by the right and bottom edges
+        (args.width - CURSOR_WIDTH // 2, args.height - CURSOR_HEIGHT // 2),
+    ]
+
+    for name, merge_function in [
+        ('legacy', legacy_merge_cursor),
+        ('vectorized', remotedesktopwebserver.merge_cursor),
+    ]:
+        median_us, p99_us = benchmark(
+            merge_function,
+            bgra_image,
+            location_list,
+            monitor_region,
+            args.iterations,
+        )
+        print(f'{name:>12}: median {median_us:8.2f} us/frame, p99 {p99_us:8.2f} us/frame')
+
+
+if __name__ == '__main__':
+    main()
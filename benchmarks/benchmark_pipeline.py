@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+# encoding=utf-8
+# headless benchmark of the capture pipeline on synthetic screen content
+# pipeline: grab, merge_cursor, resize, convert and imencode through ImageStreamProducer.capture_and_encode
+# stream: the same frames sent by ImageStreamHandler to a local tornado client over /imagestream
+# writes the results as json and exits with status 1 when a result regresses past the baseline
+#
+# python benchmarks/benchmark_pipeline.py --save-baseline benchmarks/pipeline_baseline.json
+# python benchmarks/benchmark_pipeline.py --baseline benchmarks/pipeline_baseline.json --output results.json
+import os
+import sys
+import time
+import json
+import argparse
+import asyncio
+
+try:
+    # peak resident memory, not available on windows
+    import resource
+except ImportError:
+    resource = None
+
+import tornado
+import tornado.httpclient
+import tornado.web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import remotedesktopwebserver
+import synthetic_screen
+import multipart_stream
+
+BENCHMARK_PIPELINE = 'pipeline'
+BENCHMARK_STREAM = 'stream'
+BENCHMARK_LIST = [
+    BENCHMARK_PIPELINE,
+    BENCHMARK_STREAM,
+]
+
+DEFAULT_RESOLUTION_LIST = [
+    '1080p',
+    '1440p',
+    '4k',
+]
+DEFAULT_TOLERANCE = 0.25
+
+# metric name -> True when larger is better
+REGRESSION_METRIC_DICT = {
+    'fps': True,
+    'latency_p95_ms': False,
+    'bytes_per_frame': False,
+    'peak_rss_mb': False,
+}
+
+STAGE_LIST = [
+    remotedesktopwebserver.STAGE_GRAB,
+    remotedesktopwebserver.STAGE_CURSOR,
+    remotedesktopwebserver.STAGE_RESIZE,
+    remotedesktopwebserver.STAGE_CONVERT,
+    remotedesktopwebserver.STAGE_ENCODE,
+    remotedesktopwebserver.STAGE_WRITE,
+]
+
+
+def get_peak_rss_mb():
+    if resource is None:
+        return None
+
+    # kilobytes on linux, bytes on macos
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak_rss = peak_rss / 1024
+    return round(peak_rss / 1024, 1)
+
+
+def get_percentile(sorted_value_list: list, percentile: float):
+    if len(sorted_value_list) == 0:
+        return None
+
+    index = min(int(len(sorted_value_list) * percentile / 100), len(sorted_value_list) - 1)
+    return sorted_value_list[index]
+
+
+def reset_stage_metrics():
+    metrics = remotedesktopwebserver.METRICS
+    with metrics.lock:
+        metrics.series_dict[remotedesktopwebserver.METRIC_STAGE_DURATION] = {}
+
+
+def get_stage_mean_ms_dict():
+    # mean duration of each stage since reset_stage_metrics from the /metrics histograms
+    metrics = remotedesktopwebserver.METRICS
+    stage_mean_ms_dict = {}
+    with metrics.lock:
+        for label_key, histogram in metrics.series_dict[remotedesktopwebserver.METRIC_STAGE_DURATION].items():
+            stage = dict(label_key)['stage']
+            if histogram.count > 0:
+                stage_mean_ms_dict[stage] = round(histogram.sum / histogram.count * 1000, 3)
+
+    return {x: stage_mean_ms_dict[x] for x in STAGE_LIST if x in stage_mean_ms_dict}
+
+
+def summarize(
+    frame_count: int,
+    total_duration: float,
+    latency_list: list,
+    bytes_list: list,
+):
+    latency_list = sorted(latency_list)
+    result = {
+        'frames': frame_count,
+        'fps': round(frame_count / total_duration, 2) if total_duration > 0 else 0.0,
+    }
+
+    for percentile in [50, 95, 99]:
+        latency = get_percentile(latency_list, percentile)
+        result[f'latency_p{percentile}_ms'] = None if latency is None else round(latency * 1000, 3)
+
+    if len(bytes_list) > 0:
+        result['bytes_per_frame'] = int(sum(bytes_list) / len(bytes_list))
+    else:
+        result['bytes_per_frame'] = None
+
+    return result
+
+
+def create_producer(
+    content: str,
+    width: int,
+    height: int,
+    encoder_worker_count: int,
+):
+    # the cursor stays still on the static screen so that nothing has to be encoded again
+    remotedesktopwebserver.MOUSE_CONTROLLER = synthetic_screen.SyntheticMouse(
+        width,
+        height,
+        moving=(content != synthetic_screen.CONTENT_STATIC),
+    )
+    producer = remotedesktopwebserver.ImageStreamProducer()
+    producer.encoder_worker_count = encoder_worker_count
+    producer.frame_grabber = remotedesktopwebserver.FrameGrabber(
+        lambda: synthetic_screen.SyntheticScreen(content, width, height),
+    )
+    return producer
+
+
+def run_pipeline_benchmark(
+    content: str,
+    width: int,
+    height: int,
+    query: str,
+    number_of_frames: int,
+    encoder_worker_count: int,
+):
+    producer = create_producer(content, width, height, encoder_worker_count)
+    params = remotedesktopwebserver.parse_query_string(query)
+    stream_key, _ = remotedesktopwebserver.parse_image_stream_arguments(params)
+
+    # the first frame opens the synthetic screen and allocates the buffers
+    producer.capture_and_encode([stream_key], 0, time.time())
+    reset_stage_metrics()
+
+    latency_list = []
+    bytes_list = []
+    start_time = time.perf_counter()
+    for sequence_number in range(1, number_of_frames + 1):
+        frame_start_time = time.perf_counter()
+        screen_changed = producer.capture_and_encode([stream_key], sequence_number, time.time())
+        latency_list.append(time.perf_counter() - frame_start_time)
+
+        frame = producer.latest_frame_dict.get(stream_key)
+        if screen_changed and (frame is not None):
+            if frame.image_bytes is not None:
+                bytes_list.append(len(frame.image_bytes))
+            else:
+                bytes_list.append(sum(len(x) for x in frame.tile_list))
+    total_duration = time.perf_counter() - start_time
+
+    producer.frame_grabber.close()
+    return summarize(number_of_frames, total_duration, latency_list, bytes_list)
+
+
+async def run_stream_benchmark(
+    content: str,
+    width: int,
+    height: int,
+    query: str,
+    duration_seconds: float,
+    encoder_worker_count: int,
+    port: int,
+):
+    remotedesktopwebserver.IMAGE_STREAM_PRODUCER = create_producer(content, width, height, encoder_worker_count)
+
+    app = tornado.web.Application([
+        (r'/imagestream', remotedesktopwebserver.ImageStreamHandler),
+    ])
+    server = app.listen(port, address='127.0.0.1')
+
+    latency_list = []
+    bytes_list = []
+
+    def on_part(header_dict: dict, body_length: int, arrival_time: float):
+        bytes_list.append(body_length)
+        latency_list.append(arrival_time - float(header_dict['x-capture-timestamp']))
+
+    reader = multipart_stream.MultipartStreamReader(on_part)
+
+    client = tornado.httpclient.AsyncHTTPClient(force_instance=True)
+    reset_stage_metrics()
+    start_time = time.perf_counter()
+    try:
+        # the stream never ends, the request timeout closes it after the duration
+        await client.fetch(
+            f'http://127.0.0.1:{port}/imagestream?{query}',
+            streaming_callback=reader.feed,
+            request_timeout=duration_seconds,
+        )
+    except tornado.httpclient.HTTPClientError as ex:
+        if ex.code != 599:
+            raise
+    total_duration = time.perf_counter() - start_time
+    client.close()
+
+    # let the handler see the closed connection and the producer stop before the next case
+    while remotedesktopwebserver.IMAGE_STREAM_PRODUCER.running:
+        await asyncio.sleep(0.05)
+    server.stop()
+    remotedesktopwebserver.IMAGE_STREAM_PRODUCER.frame_grabber.close()
+
+    return summarize(
+        reader.part_count,
+        total_duration,
+        latency_list,
+        bytes_list,
+    )
+
+
+def get_case_name(
+    benchmark: str,
+    content: str,
+    resolution: str,
+):
+    return f'{benchmark}/{content}/{resolution}'
+
+
+def find_regressions(
+    result_dict: dict,
+    baseline_dict: dict,
+    tolerance: float,
+):
+    regression_list = []
+    for case_name, result in result_dict.items():
+        baseline = baseline_dict.get(case_name)
+        if baseline is None:
+            continue
+
+        for metric_name, larger_is_better in REGRESSION_METRIC_DICT.items():
+            value = result.get(metric_name)
+            baseline_value = baseline.get(metric_name)
+            if (value is None) or (baseline_value is None) or (baseline_value == 0):
+                continue
+
+            if larger_is_better:
+                regressed = value < baseline_value * (1 - tolerance)
+            else:
+                regressed = value > baseline_value * (1 + tolerance)
+
+            if regressed:
+                regression_list.append(f'{case_name} {metric_name}: {value} (baseline {baseline_value})')
+
+    return regression_list
+
+
+async def async_main(args):
+    result_dict = {}
+    port = args.port
+    for resolution in args.resolution:
+        width, height = synthetic_screen.RESOLUTION_DICT[resolution]
+        for content in args.content:
+            for benchmark in args.benchmark:
+                if benchmark == BENCHMARK_PIPELINE:
+                    result = run_pipeline_benchmark(
+                        content,
+                        width,
+                        height,
+                        args.query,
+                        args.frames,
+                        args.encoder_workers,
+                    )
+                else:
+                    result = await run_stream_benchmark(
+                        content,
+                        width,
+                        height,
+                        args.query,
+                        args.stream_seconds,
+                        args.encoder_workers,
+                        port,
+                    )
+                    port += 1
+
+                result['stage_mean_ms'] = get_stage_mean_ms_dict()
+                # the peak of the whole process so far, the cases run from the smallest resolution up
+                result['peak_rss_mb'] = get_peak_rss_mb()
+
+                case_name = get_case_name(benchmark, content, resolution)
+                result_dict[case_name] = result
+                print(f'{case_name:>24}: {result["fps"]:8.2f} fps, p95 {result["latency_p95_ms"]} ms, {result["bytes_per_frame"]} bytes/frame, peak rss {result["peak_rss_mb"]} MB', file=sys.stderr)
+
+    return result_dict
+
+
+def main():
+    parser = argparse.ArgumentParser(description='headless capture pipeline benchmark')
+    parser.add_argument('--benchmark', action='append', choices=BENCHMARK_LIST, help=f'can be repeated (default: {BENCHMARK_LIST})')
+    parser.add_argument('--content', action='append', choices=synthetic_screen.CONTENT_LIST, help=f'can be repeated (default: {synthetic_screen.CONTENT_LIST})')
+    parser.add_argument('--resolution', action='append', choices=list(synthetic_screen.RESOLUTION_DICT.keys()), help=f'can be repeated (default: {DEFAULT_RESOLUTION_LIST})')
+    parser.add_argument('--query', default='format=jpg&quality=80&fps=30&cursor', help='stream parameters as in /imagestream')
+    parser.add_argument('--frames', type=int, default=60, help='frames per pipeline case')
+    parser.add_argument('--stream-seconds', type=float, default=3.0, help='duration of each stream case')
+    parser.add_argument('--encoder-workers', type=int, default=remotedesktopwebserver.DEFAULT_ENCODER_WORKER_COUNT)
+    parser.add_argument('--port', type=int, default=21700)
+    parser.add_argument('--output', help='write the results to this json file instead of stdout')
+    parser.add_argument('--baseline', help='json results of an earlier run to compare with')
+    parser.add_argument('--save-baseline', help='write the results to this json file as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help='allowed relative regression, 0.25 is 25%%')
+    args = parser.parse_args()
+    if args.benchmark is None:
+        args.benchmark = BENCHMARK_LIST
+    if args.content is None:
+        args.content = synthetic_screen.CONTENT_LIST
+    if args.resolution is None:
+        args.resolution = DEFAULT_RESOLUTION_LIST
+    print(args, file=sys.stderr)
+
+    result_dict = asyncio.run(async_main(args))
+    report = {
+        'query': args.query,
+        'encoder_workers': args.encoder_workers,
+        'peak_rss_mb': get_peak_rss_mb(),
+        'results': result_dict,
+    }
+
+    report_json = json.dumps(report, indent=2)
+    if args.output is None:
+        print(report_json)
+    else:
+        with open(args.output, 'w', encoding='utf-8') as outfile:
+            outfile.write(report_json)
+
+    if args.save_baseline is not None:
+        with open(args.save_baseline, 'w', encoding='utf-8') as outfile:
+            outfile.write(report_json)
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r', encoding='utf-8') as infile:
+            baseline_report = json.load(infile)
+
+        regression_list = find_regressions(result_dict, baseline_report['results'], args.tolerance)
+        for regression in regression_list:
+            print(f'regression: {regression}', file=sys.stderr)
+
+        if len(regression_list) > 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
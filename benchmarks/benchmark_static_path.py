@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# encoding=utf-8
+# requests per second of the static file handler for the small files of the viewer page
+# compares cold lookups (path resolution and directory index caches cleared before each request, like the handler before them)
+# with the cached ones, the asset cache stays warm in both cases so that only these two caches are measured
+import os
+import sys
+import time
+import argparse
+import asyncio
+
+import tornado
+import tornado.httpclient
+import tornado.web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import remotedesktopwebserver
+
+DEFAULT_PATH_LIST = [
+    '/',
+    '/index.js',
+    '/style.css',
+]
+
+
+def clear_path_caches():
+    remotedesktopwebserver.RESOLVED_PATH_CACHE.clear()
+    remotedesktopwebserver.DIRECTORY_INDEX_CACHE.clear()
+
+
+class ColdRequestHandler(remotedesktopwebserver.AllRequestHandler):
+    async def get(self):
+        clear_path_caches()
+        await super().get()
+
+
+async def benchmark(
+    port: int,
+    path_list: list,
+    number_of_requests: int,
+    concurrency: int,
+):
+    client = tornado.httpclient.AsyncHTTPClient(max_clients=concurrency)
+    url_list = [f'http://127.0.0.1:{port}{x}' for x in path_list]
+
+    # warm up the connections and the caches
+    for url in url_list:
+        await client.fetch(url)
+
+    next_request_index = 0
+    duration_list = []
+
+    async def worker():
+        nonlocal next_request_index
+        while next_request_index < number_of_requests:
+            url = url_list[next_request_index % len(url_list)]
+            next_request_index += 1
+            start_time = time.perf_counter()
+            await client.fetch(url)
+            duration_list.append(time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    total_duration = time.perf_counter() - start_time
+
+    duration_list.sort()
+    requests_per_second = len(duration_list) / total_duration
+    median_ms = duration_list[len(duration_list) // 2] * 1000
+    p99_ms = duration_list[int(len(duration_list) * 0.99)] * 1000
+    return requests_per_second, median_ms, p99_ms
+
+
+async def async_main(args):
+    for name, handler_class, port in [
+        ('cold', ColdRequestHandler, args.port),
+        ('cached', remotedesktopwebserver.AllRequestHandler, args.port + 1),
+    ]:
+        app = tornado.web.Application([
+            (r'/.*', handler_class),
+        ])
+        server = app.listen(port, address='127.0.0.1')
+        try:
+            requests_per_second, median_ms, p99_ms = await benchmark(
+                port,
+                args.path,
+                args.requests,
+                args.concurrency,
+            )
+        finally:
+            server.stop()
+
+        print(f'{name:>8}: {requests_per_second:9.1f} requests/s, median {median_ms:7.3f} ms, p99 {p99_ms:7.3f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='static file handler benchmark')
+    parser.add_argument('--port', type=int, default=21600)
+    parser.add_argument('--requests', type=int, default=3000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--path', action='append', help=f'request path, can be repeated (default: {DEFAULT_PATH_LIST})')
+    args = parser.parse_args()
+    if args.path is None:
+        args.path = DEFAULT_PATH_LIST
+    print(args)
+
+    asyncio.run(async_main(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+# encoding=utf-8
+# opens N concurrent /imagestream viewers and reports what each of them received
+# delivered fps, inter-frame jitter, bytes/s, time to the first frame and stalls per client
+# run it with a list of client counts to find where the server stops keeping up
+#
+# without --url a server on a synthetic screen is started locally (benchmarks/synthetic_server.py)
+# python benchmarks/load_viewers.py --clients 1,2,4,8,16,32 --content text --resolution 1080p
+# python benchmarks/load_viewers.py --url http://127.0.0.1:21578 --clients 8 --query "fps=30&format=jpg"
+import os
+import sys
+import time
+import json
+import socket
+import argparse
+import asyncio
+import statistics
+import subprocess
+import concurrent.futures
+
+import tornado
+import tornado.httpclient
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import multipart_stream
+import synthetic_screen
+
+SYNTHETIC_SERVER_FILEPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'synthetic_server.py')
+
+DEFAULT_CLIENT_COUNT_LIST = [1, 2, 4, 8, 16]
+DEFAULT_QUERY = 'fps=30&format=jpg&quality=80'
+DEFAULT_DURATION_SECONDS = 10.0
+# a gap between two frames longer than this is a stall
+DEFAULT_STALL_SECONDS = 1.0
+DEFAULT_SERVER_PORT = 21800
+SERVER_START_TIMEOUT_SECONDS = 30.0
+
+
+class ViewerStats:
+    def __init__(self, client_index: int):
+        self.client_index = client_index
+        self.start_time = None
+        self.first_frame_time = None
+        self.last_frame_time = None
+        self.frame_count = 0
+        self.body_bytes = 0
+        self.interval_list = []
+        self.error = None
+
+    def on_part(
+        self,
+        header_dict: dict,
+        body_length: int,
+        arrival_time: float,
+    ):
+        if self.first_frame_time is None:
+            self.first_frame_time = arrival_time
+        else:
+            interval = arrival_time - self.last_frame_time
+            self.interval_list.append(interval)
+
+        self.last_frame_time = arrival_time
+        self.frame_count += 1
+        self.body_bytes += body_length
+
+    def get_report(
+        self,
+        end_time: float,
+        stall_seconds: float,
+    ):
+        duration_seconds = end_time - self.start_time
+        # the time before the first frame and after the last one count as gaps as well
+        gap_list = list(self.interval_list)
+        if self.first_frame_time is None:
+            gap_list.append(duration_seconds)
+        else:
+            gap_list.append(self.first_frame_time - self.start_time)
+            gap_list.append(end_time - self.last_frame_time)
+
+        report = {
+            'client': self.client_index,
+            'frames': self.frame_count,
+            'fps': round(self.frame_count / duration_seconds, 2),
+            'bytes_per_second': int(self.body_bytes / duration_seconds),
+            'first_frame_ms': None,
+            'interval_mean_ms': None,
+            'jitter_ms': None,
+            'max_gap_ms': round(max(gap_list) * 1000, 1),
+            'stalls': sum(1 for x in gap_list if x > stall_seconds),
+            # nothing arrived during the last stall_seconds of the run
+            'stalled': (self.last_frame_time is None) or ((end_time - self.last_frame_time) > stall_seconds),
+            'error': self.error,
+        }
+
+        if self.first_frame_time is not None:
+            report['first_frame_ms'] = round((self.first_frame_time - self.start_time) * 1000, 1)
+
+        if len(self.interval_list) > 0:
+            report['interval_mean_ms'] = round(statistics.mean(self.interval_list) * 1000, 2)
+            # standard deviation of the time between two frames
+            report['jitter_ms'] = round(statistics.pstdev(self.interval_list) * 1000, 2)
+
+        return report
+
+
+async def run_viewer(
+    client: tornado.httpclient.AsyncHTTPClient,
+    url: str,
+    viewer_stats: ViewerStats,
+    duration_seconds: float,
+):
+    reader = multipart_stream.MultipartStreamReader(viewer_stats.on_part)
+    viewer_stats.start_time = time.time()
+    try:
+        # the stream never ends, the request timeout closes it after the duration
+        await client.fetch(
+            url,
+            streaming_callback=reader.feed,
+            connect_timeout=duration_seconds,
+            request_timeout=duration_seconds,
+        )
+    except tornado.httpclient.HTTPClientError as ex:
+        if ex.code != 599:
+            viewer_stats.error = str(ex)
+    except Exception as ex:
+        viewer_stats.error = str(ex)
+
+
+async def run_viewers(
+    url: str,
+    first_client_index: int,
+    client_count: int,
+    duration_seconds: float,
+    stall_seconds: float,
+):
+    client = tornado.httpclient.AsyncHTTPClient(force_instance=True, max_clients=client_count)
+    viewer_stats_list = [ViewerStats(first_client_index + x) for x in range(client_count)]
+    await asyncio.gather(*[
+        run_viewer(client, url, x, duration_seconds)
+        for x in viewer_stats_list
+    ])
+    end_time = time.time()
+    client.close()
+    return [x.get_report(end_time, stall_seconds) for x in viewer_stats_list]
+
+
+def run_viewer_process(
+    url: str,
+    first_client_index: int,
+    client_count: int,
+    duration_seconds: float,
+    stall_seconds: float,
+):
+    # entry point of a load process, parsing many streams in one process would make the client the bottleneck
+    return asyncio.run(run_viewers(
+        url,
+        first_client_index,
+        client_count,
+        duration_seconds,
+        stall_seconds,
+    ))
+
+
+def run_load(
+    url: str,
+    client_count: int,
+    process_count: int,
+    duration_seconds: float,
+    stall_seconds: float,
+):
+    process_count = max(1, min(process_count, client_count))
+    future_list = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=process_count) as executor:
+        first_client_index = 0
+        for process_index in range(process_count):
+            # spread the clients evenly over the processes
+            process_client_count = client_count // process_count + (1 if process_index < (client_count % process_count) else 0)
+            future_list.append(executor.submit(
+                run_viewer_process,
+                url,
+                first_client_index,
+                process_client_count,
+                duration_seconds,
+                stall_seconds,
+            ))
+            first_client_index += process_client_count
+
+        client_report_list = []
+        for future in future_list:
+            client_report_list.extend(future.result())
+
+    fps_list = [x['fps'] for x in client_report_list]
+    jitter_list = [x['jitter_ms'] for x in client_report_list if x['jitter_ms'] is not None]
+    first_frame_list = [x['first_frame_ms'] for x in client_report_list if x['first_frame_ms'] is not None]
+    return {
+        'clients': client_count,
+        'delivered_fps_total': round(sum(fps_list), 2),
+        'fps_per_client_mean': round(statistics.mean(fps_list), 2),
+        'fps_per_client_min': min(fps_list),
+        'jitter_ms_mean': round(statistics.mean(jitter_list), 2) if len(jitter_list) > 0 else None,
+        'jitter_ms_max': max(jitter_list) if len(jitter_list) > 0 else None,
+        'first_frame_ms_max': max(first_frame_list) if len(first_frame_list) > 0 else None,
+        'bytes_per_second_total': sum(x['bytes_per_second'] for x in client_report_list),
+        'stalls': sum(x['stalls'] for x in client_report_list),
+        'stalled_clients': sum(1 for x in client_report_list if x['stalled']),
+        'failed_clients': sum(1 for x in client_report_list if x['error'] is not None),
+        'client_list': client_report_list,
+    }
+
+
+def wait_for_port(
+    port: int,
+    server_process: subprocess.Popen,
+):
+    deadline = time.perf_counter() + SERVER_START_TIMEOUT_SECONDS
+    while time.perf_counter() < deadline:
+        if server_process.poll() is not None:
+            raise Exception(f'the server exited with code {server_process.returncode}')
+
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+
+    raise Exception(f'the server did not listen on port {port} in {SERVER_START_TIMEOUT_SECONDS} seconds')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='concurrent /imagestream viewers load test')
+    parser.add_argument('--clients', default=','.join(str(x) for x in DEFAULT_CLIENT_COUNT_LIST), help='comma separated numbers of concurrent viewers, one run each')
+    parser.add_argument('--duration', type=float, default=DEFAULT_DURATION_SECONDS, help='seconds per run')
+    parser.add_argument('--query', default=DEFAULT_QUERY, help='stream parameters as in /imagestream')
+    parser.add_argument('--stall-seconds', type=float, default=DEFAULT_STALL_SECONDS, help='a gap between two frames longer than this is a stall')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help='client processes the viewers are spread over')
+    parser.add_argument('--url', help='server to test (default: start a server on a synthetic screen)')
+    parser.add_argument('--content', choices=synthetic_screen.CONTENT_LIST, default=synthetic_screen.CONTENT_TEXT, help='synthetic screen content of the local server')
+    parser.add_argument('--resolution', choices=list(synthetic_screen.RESOLUTION_DICT.keys()), default='1080p', help='synthetic screen resolution of the local server')
+    parser.add_argument('--port', type=int, default=DEFAULT_SERVER_PORT, help='port of the local server')
+    parser.add_argument('--server-args', default='', help='extra arguments of the local server, e.g. "--workers 4"')
+    parser.add_argument('--output', help='write the results to this json file instead of stdout')
+    args = parser.parse_args()
+    print(args, file=sys.stderr)
+
+    client_count_list = [int(x) for x in args.clients.split(',')]
+
+    server_process = None
+    base_url = args.url
+    if base_url is None:
+        server_command = [
+            sys.executable,
+            SYNTHETIC_SERVER_FILEPATH,
+            '--content', args.content,
+            '--resolution', args.resolution,
+            str(args.port),
+        ] + args.server_args.split()
+        print(' '.join(server_command), file=sys.stderr)
+        server_process = subprocess.Popen(
+            server_command,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        wait_for_port(args.port, server_process)
+        base_url = f'http://127.0.0.1:{args.port}'
+
+    url = f'{base_url.rstrip("/")}/imagestream?{args.query}'
+    run_list = []
+    try:
+        for client_count in client_count_list:
+            run = run_load(
+                url,
+                client_count,
+                args.processes,
+                args.duration,
+                args.stall_seconds,
+            )
+            run_list.append(run)
+            print(f'{client_count:>5} clients: {run["delivered_fps_total"]:9.2f} fps total, {run["fps_per_client_mean"]:7.2f} fps/client (min {run["fps_per_client_min"]}), jitter {run["jitter_ms_mean"]} ms, {run["bytes_per_second_total"] / (1024 ** 2):8.2f} MB/s, {run["stalled_clients"]} stalled, {run["failed_clients"]} failed', file=sys.stderr)
+    finally:
+        if server_process is not None:
+            server_process.terminate()
+            server_process.wait()
+
+    report_json = json.dumps({
+        'url': url,
+        'duration_seconds': args.duration,
+        'stall_seconds': args.stall_seconds,
+        'runs': run_list,
+    }, indent=2)
+    if args.output is None:
+        print(report_json)
+    else:
+        with open(args.output, 'w', encoding='utf-8') as outfile:
+            outfile.write(report_json)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# encoding=utf-8
+# incremental parser of the multipart/x-mixed-replace responses of /imagestream and /replay
+# part bodies are counted and skipped as they arrive, only the part headers are ever buffered
+import time
+
+
+class MultipartStreamReader:
+    def __init__(self, on_part=None):
+        # on_part(header_dict, body_length, arrival_time) is called once the whole body of a part arrived
+        self.on_part = on_part
+        self.header_buffer = bytearray()
+        self.header_dict = None
+        self.remaining_body_length = 0
+        self.part_count = 0
+        self.body_bytes = 0
+
+    def feed(self, chunk: bytes):
+        chunk = memoryview(chunk)
+        while len(chunk) > 0:
+            if self.header_dict is None:
+                search_start_index = max(0, len(self.header_buffer) - 3)
+                self.header_buffer.extend(chunk)
+                header_end_index = self.header_buffer.find(b'\r\n\r\n', search_start_index)
+                if header_end_index < 0:
+                    return
+
+                # the rest of the chunk after the headers is body
+                chunk = chunk[len(chunk) - (len(self.header_buffer) - header_end_index - 4):]
+                self.header_dict = {}
+                for line in self.header_buffer[:header_end_index].decode('ascii').split('\r\n'):
+                    name, separator, value = line.partition(':')
+                    if separator:
+                        # header names are lowercased, the boundary line is skipped
+                        self.header_dict[name.strip().lower()] = value.strip()
+                self.header_buffer.clear()
+                self.remaining_body_length = int(self.header_dict['content-length'])
+
+            body_length = min(len(chunk), self.remaining_body_length)
+            chunk = chunk[body_length:]
+            self.remaining_body_length -= body_length
+            if self.remaining_body_length > 0:
+                return
+
+            body_length = int(self.header_dict['content-length'])
+            self.part_count += 1
+            self.body_bytes += body_length
+            if self.on_part is not None:
+                self.on_part(self.header_dict, body_length, time.time())
+            self.header_dict = None
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# encoding=utf-8
+# synthetic stand-in for mss.mss() and pynput.mouse.Controller() so the capture pipeline runs without a display
+# usage: remotedesktopwebserver.FrameGrabber(lambda: SyntheticScreen('text', 1920, 1080))
+import numpy as np
+import cv2
+import mss.screenshot
+
+CONTENT_STATIC = 'static'
+CONTENT_SCROLL = 'scroll'
+CONTENT_VIDEO = 'video'
+CONTENT_TEXT = 'text'
+CONTENT_LIST = [
+    CONTENT_STATIC,
+    CONTENT_SCROLL,
+    CONTENT_VIDEO,
+    CONTENT_TEXT,
+]
+
+RESOLUTION_DICT = {
+    '1080p': (1920, 1080),
+    '1440p': (2560, 1440),
+    '4k': (3840, 2160),
+}
+
+TEXT_LINE_HEIGHT = 20
+TEXT_FONT_SCALE = 0.5
+TEXT_CHARACTER_WIDTH = 10
+SCROLL_PIXELS_PER_FRAME = 12
+# typed characters per frame of the text content
+TYPING_CHARACTERS_PER_FRAME = 2
+VIDEO_PAN_PIXELS_PER_FRAME = 7
+
+WORD_LIST = [
+    'def', 'return', 'import', 'class', 'self', 'frame', 'image', 'stream',
+    'buffer', 'encode', 'capture', 'region', 'width', 'height', 'None', 'for',
+    'in', 'if', 'else', 'while', 'await', 'async', 'numpy', 'cv2', 'tornado',
+]
+
+
+def render_text_page(
+    width: int,
+    height: int,
+    rng: np.random.Generator,
+):
+    # dark text on a light background, like an editor or a terminal with a light theme
+    page = np.full((height, width, 4), 255, dtype=np.uint8)
+    page[:, :, 0:3] = (246, 246, 246)
+    for baseline_y in range(TEXT_LINE_HEIGHT - 5, height, TEXT_LINE_HEIGHT):
+        indent = int(rng.integers(0, 6)) * 4 * TEXT_CHARACTER_WIDTH
+        word_count = int(rng.integers(0, (width - indent) // (TEXT_CHARACTER_WIDTH * 7)))
+        line = ' '.join(rng.choice(WORD_LIST, size=word_count))
+        cv2.putText(
+            page,
+            line,
+            (8 + indent, baseline_y),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            TEXT_FONT_SCALE,
+            (40, 40, 40, 255),
+            1,
+            cv2.LINE_AA,
+        )
+
+    return page
+
+
+def render_video_texture(
+    width: int,
+    height: int,
+    rng: np.random.Generator,
+):
+    # smooth noise which is panned across the video rectangle, every pixel changes on every frame
+    noise = rng.integers(0, 256, (height // 8, width // 8, 4), dtype=np.uint8)
+    texture = cv2.resize(noise, dsize=(width, height), interpolation=cv2.INTER_CUBIC)
+    texture[:, :, 3] = 255
+    return texture
+
+
+class SyntheticMouse:
+    def __init__(
+        self,
+        width: int,
+        height: int,
+        moving: bool = True,
+    ):
+        self.width = width
+        self.height = height
+        self.moving = moving
+        self.move_count = 0
+
+    @property
+    def position(self):
+        # a slow diagonal sweep so the cursor is drawn at a different place on every frame
+        if self.moving:
+            self.move_count += 1
+        return (
+            (self.move_count * 13) % self.width,
+            (self.move_count * 7) % self.height,
+        )
+
+
+class SyntheticScreen:
+    def __init__(
+        self,
+        content: str,
+        width: int,
+        height: int,
+        seed: int = 0,
+    ):
+        if content not in CONTENT_LIST:
+            raise Exception(f'unknown synthetic content: {content}, expected one of {CONTENT_LIST}')
+
+        self.content = content
+        self.width = width
+        self.height = height
+        self.monitors = [
+            {'left': 0, 'top': 0, 'width': width, 'height': height},
+            {'left': 0, 'top': 0, 'width': width, 'height': height},
+        ]
+        self.frame_index = 0
+
+        rng = np.random.default_rng(seed)
+        if content == CONTENT_SCROLL:
+            # twice the screen height so the window can wrap around
+            self.page = render_text_page(width, height * 2, rng)
+        else:
+            self.page = render_text_page(width, height, rng)
+
+        if content == CONTENT_VIDEO:
+            # a 16:9 player in the middle of the page
+            self.video_width = width // 2
+            self.video_height = self.video_width * 9 // 16
+            self.video_left = (width - self.video_width) // 2
+            self.video_top = (height - self.video_height) // 2
+            self.video_texture = render_video_texture(self.video_width * 2, self.video_height * 2, rng)
+
+        # the text content types into a copy of the page
+        self.screen = self.page[:height].copy()
+        self.typing_x = 8
+        self.typing_y = TEXT_LINE_HEIGHT - 5
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        pass
+
+    def type_characters(self):
+        for _ in range(TYPING_CHARACTERS_PER_FRAME):
+            if self.typing_x + TEXT_CHARACTER_WIDTH >= self.width:
+                self.typing_x = 8
+                self.typing_y += TEXT_LINE_HEIGHT
+                if self.typing_y >= self.height:
+                    self.typing_y = TEXT_LINE_HEIGHT - 5
+                    self.screen[...] = self.page[:self.height]
+
+                # clear the line before typing over it
+                self.screen[self.typing_y - TEXT_LINE_HEIGHT + 5:self.typing_y + 5, :, 0:3] = (246, 246, 246)
+
+            character = chr(ord('a') + (self.frame_index * 7 + self.typing_x) % 26)
+            cv2.putText(
+                self.screen,
+                character,
+                (self.typing_x, self.typing_y),
+                cv2.FONT_HERSHEY_SIMPLEX,
+                TEXT_FONT_SCALE,
+                (40, 40, 40, 255),
+                1,
+                cv2.LINE_AA,
+            )
+            self.typing_x += TEXT_CHARACTER_WIDTH
+
+    def render_frame(self):
+        if self.content == CONTENT_STATIC:
+            return self.screen
+
+        if self.content == CONTENT_SCROLL:
+            scroll_y = (self.frame_index * SCROLL_PIXELS_PER_FRAME) % self.height
+            return self.page[scroll_y:scroll_y + self.height]
+
+        if self.content == CONTENT_VIDEO:
+            pan = self.frame_index * VIDEO_PAN_PIXELS_PER_FRAME
+            texture_x = pan % self.video_width
+            texture_y = (pan // 2) % self.video_height
+            self.screen[
+                self.video_top:self.video_top + self.video_height,
+                self.video_left:self.video_left + self.video_width,
+            ] = self.video_texture[
+                texture_y:texture_y + self.video_height,
+                texture_x:texture_x + self.video_width,
+            ]
+            return self.screen
+
+        self.type_characters()
+        return self.screen
+
+    def grab(self, region: dict):
+        frame = self.render_frame()
+        self.frame_index += 1
+
+        left = region['left'] - self.monitors[0]['left']
+        top = region['top'] - self.monitors[0]['top']
+        region_image = frame[top:top + region['height'], left:left + region['width']]
+        # a fresh bytearray per grab like mss, the grabber keeps the previous one for change detection
+        raw = bytearray(np.ascontiguousarray(region_image))
+        return mss.screenshot.ScreenShot(raw, region)
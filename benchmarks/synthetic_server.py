@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# encoding=utf-8
+# runs remotedesktopwebserver with a synthetic screen instead of the display, e.g. for benchmarks/load_viewers.py
+# every other argument is passed to the server
+#
+# python benchmarks/synthetic_server.py --content video --resolution 1440p 21578 --workers 4
+import os
+import sys
+import argparse
+
+import mss
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import remotedesktopwebserver
+import synthetic_screen
+
+# content:resolution, read again by the spawned capture and server processes which import this file too
+SYNTHETIC_SCREEN_ENVIRONMENT_VARIABLE = 'REMOTEDESKTOP_SYNTHETIC_SCREEN'
+
+
+def install_synthetic_screen(
+    content: str,
+    resolution: str,
+):
+    width, height = synthetic_screen.RESOLUTION_DICT[resolution]
+    mss.mss = lambda *args, **kwargs: synthetic_screen.SyntheticScreen(content, width, height)
+    remotedesktopwebserver.MOUSE_CONTROLLER = synthetic_screen.SyntheticMouse(
+        width,
+        height,
+        moving=(content != synthetic_screen.CONTENT_STATIC),
+    )
+
+
+if SYNTHETIC_SCREEN_ENVIRONMENT_VARIABLE in os.environ:
+    install_synthetic_screen(*os.environ[SYNTHETIC_SCREEN_ENVIRONMENT_VARIABLE].split(':'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='remote desktop webserver on a synthetic screen')
+    parser.add_argument('--content', choices=synthetic_screen.CONTENT_LIST, default=synthetic_screen.CONTENT_TEXT)
+    parser.add_argument('--resolution', choices=list(synthetic_screen.RESOLUTION_DICT.keys()), default='1080p')
+    args, server_argument_list = parser.parse_known_args()
+
+    os.environ[SYNTHETIC_SCREEN_ENVIRONMENT_VARIABLE] = f'{args.content}:{args.resolution}'
+    install_synthetic_screen(args.content, args.resolution)
+
+    sys.argv = [sys.argv[0]] + server_argument_list
+    remotedesktopwebserver.main()
+
+
+if __name__ == '__main__':
+    main()
@@ -6,20 +6,36 @@ import time
 import io
 import threading
 import json
+import base64
 import re
 import stat
+import struct
 import math
 import traceback
+import signal
+import bisect
+import email.utils
+import uuid
+import hashlib
+import gzip
+import concurrent.futures
+import multiprocessing
+import multiprocessing.shared_memory
+import collections
+import itertools
 
 import urllib
 import urllib.parse
 
-import tqdm
-
 import tornado
 import tornado.gen
+import tornado.httpserver
+import tornado.iostream
 import tornado.ioloop
+import tornado.locks
+import tornado.netutil
 import tornado.web
+import tornado.websocket
 
 import numpy as np
 import PIL
@@ -27,8 +43,22 @@ import PIL.Image
 import cv2
 
 import mss
-import pynput
-import pynput.mouse
+
+try:
+    import pynput
+    import pynput.mouse
+    import pynput.keyboard
+except ImportError as ex:
+    # pynput needs a display, without it the server still runs but does not draw the mouse cursor or accept input
+    # e.g. the benchmarks on a headless machine with a synthetic screen source
+    print(f'pynput is not available: {ex}')
+    pynput = None
+
+try:
+    # optional, only used for the precompressed static files
+    import brotli
+except ImportError:
+    brotli = None
 
 ROOT = os.path.dirname(os.path.abspath(__file__))
 CURSOR_ICON_FILEPATH = os.path.join(ROOT, 'aero_arrow.png')
@@ -37,16 +67,25 @@ if not os.path.exists(CURSOR_ICON_FILEPATH):
 
 CURSOR_BGRA_IMAGE = cv2.imread(CURSOR_ICON_FILEPATH, cv2.IMREAD_UNCHANGED)
 CURSOR_HEIGHT, CURSOR_WIDTH = CURSOR_BGRA_IMAGE.shape[:2]
-CACHED_NON_ALPHA_INDEX_LIST = []
-for y in range(CURSOR_HEIGHT):
-    x_index_list = []
-    for x in range(CURSOR_WIDTH):
-        bgra_pixel = CURSOR_BGRA_IMAGE[y, x]
-        if bgra_pixel[3] != 0:
-            x_index_list.append(x)
-    CACHED_NON_ALPHA_INDEX_LIST.append(x_index_list)
+# precomputed planes for alpha blending in 16 bits integer
+# blended = (cursor * alpha + background * (255 - alpha) + 127) // 255
+CURSOR_ALPHA_PLANE = CURSOR_BGRA_IMAGE[:, :, 3:4].astype(np.uint16)
+CURSOR_INVERSE_ALPHA_PLANE = 255 - CURSOR_ALPHA_PLANE
+CURSOR_PREMULTIPLIED_BGR_IMAGE = CURSOR_BGRA_IMAGE[:, :, 0:3].astype(np.uint16) * CURSOR_ALPHA_PLANE + 127
+
+if pynput is None:
+    MOUSE_CONTROLLER = None
+    KEYBOARD_CONTROLLER = None
+else:
+    MOUSE_CONTROLLER = pynput.mouse.Controller()
+    KEYBOARD_CONTROLLER = pynput.keyboard.Controller()
+
+
+def get_mouse_position():
+    if MOUSE_CONTROLLER is None:
+        return None
 
-MOUSE_CONTROLLER = pynput.mouse.Controller()
+    return MOUSE_CONTROLLER.position
 
 
 def merge_cursor(
@@ -54,71 +93,815 @@ def merge_cursor(
     location: tuple,
     monitor_region: dict,
 ):
-    mousex, mousey = location
-    monitor_left = monitor_region['left']
-    monitor_top = monitor_region['top']
-    monitor_right = monitor_region['left'] + monitor_region['width']
-    monitor_bottom = monitor_region['top'] + monitor_region['height']
-
-    if mousex < monitor_left or mousex > monitor_right:
+    if location is None:
         return
 
-    if mousey < monitor_top or mousey > monitor_bottom:
-        return
+    # cursor location is in virtual screen coordinates which can be negative on multi-monitor setups
+    cursor_left = int(location[0]) - monitor_region['left']
+    cursor_top = int(location[1]) - monitor_region['top']
 
     image_height, image_width = bgra_image.shape[:2]
-    for y in range(CURSOR_HEIGHT):
-        real_y = y + mousey
-        if real_y >= image_height:
-            break
+    # clip the cursor rectangle against the image on every edge
+    left = max(cursor_left, 0)
+    top = max(cursor_top, 0)
+    right = min(cursor_left + CURSOR_WIDTH, image_width)
+    bottom = min(cursor_top + CURSOR_HEIGHT, image_height)
+    if (left >= right) or (top >= bottom):
+        return
 
-        color_index_list = CACHED_NON_ALPHA_INDEX_LIST[y]
-        for x in color_index_list:
-            real_x = x + mousex
-            if real_x >= image_width:
-                break
+    cursor_slice = (
+        slice(top - cursor_top, bottom - cursor_top),
+        slice(left - cursor_left, right - cursor_left),
+    )
+
+    background = bgra_image[top:bottom, left:right, 0:3]
+    blended = CURSOR_PREMULTIPLIED_BGR_IMAGE[cursor_slice] + background * CURSOR_INVERSE_ALPHA_PLANE[cursor_slice]
+    background[...] = blended // 255
+
+
+########################################################################
+### IMAGE ENCODING #####################################################
+# jpeg and png are encoded with opencv
+# webp is encoded with pillow because opencv does not expose the webp method (speed/size tradeoff)
+
+MAX_IMAGE_QUALITY = 100
+DEFAULT_WEBP_QUALITY = 80
+# 0 is the fastest method, 6 the smallest output
+DEFAULT_WEBP_METHOD = 0
+
+# image formats which can be encoded straight from the BGRA capture without dropping the alpha channel first
+BGRA_ENCODABLE_IMAGE_FORMAT_LIST = [
+    'jpg',
+    'jpeg',
+    'webp',
+]
+
+# not every opencv build has the sampling factor constants (added in 4.5.5)
+JPEG_SUBSAMPLING_DICT = {}
+for subsampling in ['444', '422', '420', '411', '440']:
+    constant_name = f'IMWRITE_JPEG_SAMPLING_FACTOR_{subsampling}'
+    if hasattr(cv2, constant_name):
+        JPEG_SUBSAMPLING_DICT[subsampling] = getattr(cv2, constant_name)
+
+PNG_STRATEGY_DICT = {
+    'default': cv2.IMWRITE_PNG_STRATEGY_DEFAULT,
+    'filtered': cv2.IMWRITE_PNG_STRATEGY_FILTERED,
+    'huffman': cv2.IMWRITE_PNG_STRATEGY_HUFFMAN_ONLY,
+    'rle': cv2.IMWRITE_PNG_STRATEGY_RLE,
+    'fixed': cv2.IMWRITE_PNG_STRATEGY_FIXED,
+}
+
+
+def get_encode_parameters(
+    image_format: str,
+    image_quality: int = None,
+    encoder_option_dict: dict = None,
+):
+    # quality 1-100 for every format, higher is better looking and bigger
+    # the format specific options take precedence over it
+    if encoder_option_dict is None:
+        encoder_option_dict = {}
+
+    encode_parameters = []
+    if image_format in ('jpg', 'jpeg'):
+        jpeg_quality = encoder_option_dict.get('jpeg_quality', image_quality)
+        if jpeg_quality is not None:
+            encode_parameters.extend([cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
+
+        jpeg_subsampling = encoder_option_dict.get('jpeg_subsampling')
+        if jpeg_subsampling in JPEG_SUBSAMPLING_DICT:
+            encode_parameters.extend([cv2.IMWRITE_JPEG_SAMPLING_FACTOR, JPEG_SUBSAMPLING_DICT[jpeg_subsampling]])
+    elif image_format == 'png':
+        png_compression_level = encoder_option_dict.get('png_compression')
+        if (png_compression_level is None) and (image_quality is not None):
+            # png is lossless, lower quality means more compression
+            png_compression_level = int(round((MAX_IMAGE_QUALITY - image_quality) * 9 / MAX_IMAGE_QUALITY))
+
+        if png_compression_level is not None:
+            encode_parameters.extend([cv2.IMWRITE_PNG_COMPRESSION, png_compression_level])
+
+        png_strategy = encoder_option_dict.get('png_strategy')
+        if png_strategy in PNG_STRATEGY_DICT:
+            encode_parameters.extend([cv2.IMWRITE_PNG_STRATEGY, PNG_STRATEGY_DICT[png_strategy]])
+
+    return encode_parameters
+
+
+def encode_webp_image(
+    image: np.ndarray,
+    image_quality: int = None,
+    encoder_option_dict: dict = None,
+):
+    if encoder_option_dict is None:
+        encoder_option_dict = {}
+
+    webp_quality = encoder_option_dict.get('webp_quality', image_quality)
+    if webp_quality is None:
+        webp_quality = DEFAULT_WEBP_QUALITY
+
+    image_height, image_width, number_of_channels = image.shape
+    # let pillow unpack the BGR(A) layout itself instead of converting to RGB first
+    if number_of_channels == 4:
+        raw_mode = 'BGRX'
+    else:
+        raw_mode = 'BGR'
+
+    pil_image = PIL.Image.frombuffer(
+        'RGB',
+        (image_width, image_height),
+        np.ascontiguousarray(image),
+        'raw',
+        raw_mode,
+        0,
+        1,
+    )
+
+    output = io.BytesIO()
+    pil_image.save(
+        output,
+        format='WEBP',
+        quality=webp_quality,
+        method=encoder_option_dict.get('webp_method', DEFAULT_WEBP_METHOD),
+        lossless=encoder_option_dict.get('lossless', False),
+    )
+    return output.getvalue()
+
+
+def encode_image(
+    image: np.ndarray,
+    image_format: str,
+    image_quality: int = None,
+    encoder_options: tuple = (),
+):
+    # encoder_options is a tuple of (name, value) pairs so that it can be part of the stream key
+    encoder_option_dict = dict(encoder_options)
+    if image_format == 'webp':
+        return encode_webp_image(image, image_quality, encoder_option_dict)
+
+    encode_parameters = get_encode_parameters(image_format, image_quality, encoder_option_dict)
+    status, bs = cv2.imencode(f'.{image_format}', image, encode_parameters)
+    if status:
+        return bs.tobytes()
+
+    return None
+
+
+### END IMAGE ENCODING #################################################
+########################################################################
+### METRICS ############################################################
+# per stage timings and stream counters in the prometheus text format, see MetricsHandler
+# observed from the io loop, the capture thread and the encoder threads
+
+# histogram bucket upper bounds in seconds
+STAGE_DURATION_BUCKET_LIST = [
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+]
+
+METRIC_TYPE_COUNTER = 'counter'
+METRIC_TYPE_GAUGE = 'gauge'
+METRIC_TYPE_HISTOGRAM = 'histogram'
+
+
+class Histogram:
+    def __init__(self, bucket_list: list):
+        self.bucket_list = bucket_list
+        # the last count is the +Inf bucket
+        self.bucket_count_list = [0] * (len(bucket_list) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.bucket_count_list[bisect.bisect_left(self.bucket_list, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def format_metric_labels(label_key: tuple):
+    if len(label_key) == 0:
+        return ''
+
+    label_str_list = []
+    for label_name, label_value in label_key:
+        label_value = str(label_value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        label_str_list.append(f'{label_name}="{label_value}"')
+
+    return '{' + ','.join(label_str_list) + '}'
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # metric name -> (metric type, help text) in the order of registration
+        self.description_dict = {}
+        # metric name -> {sorted label tuple -> value or Histogram}
+        self.series_dict = {}
+        # gauge name -> function returning a list of (label dict, value), called when rendering
+        self.gauge_function_dict = {}
+
+    def describe(
+        self,
+        name: str,
+        metric_type: str,
+        help_text: str,
+    ):
+        self.description_dict[name] = (metric_type, help_text)
+        self.series_dict[name] = {}
+
+    def increment(
+        self,
+        name: str,
+        value: float = 1,
+        **labels,
+    ):
+        label_key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series_dict[name]
+            series[label_key] = series.get(label_key, 0) + value
+
+    def observe(
+        self,
+        name: str,
+        value: float,
+        **labels,
+    ):
+        label_key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.series_dict[name]
+            histogram = series.get(label_key)
+            if histogram is None:
+                histogram = Histogram(STAGE_DURATION_BUCKET_LIST)
+                series[label_key] = histogram
+            histogram.observe(value)
+
+    def remove(
+        self,
+        name: str,
+        **labels,
+    ):
+        label_key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.series_dict[name].pop(label_key, None)
+
+    def set_gauge_function(
+        self,
+        name: str,
+        function,
+    ):
+        self.gauge_function_dict[name] = function
+
+    def render(self):
+        line_list = []
+        with self.lock:
+            for name, (metric_type, help_text) in self.description_dict.items():
+                line_list.append(f'# HELP {name} {help_text}')
+                line_list.append(f'# TYPE {name} {metric_type}')
+
+                if name in self.gauge_function_dict:
+                    series_list = [(tuple(sorted(x.items())), y) for x, y in self.gauge_function_dict[name]()]
+                else:
+                    series_list = list(self.series_dict[name].items())
+
+                for label_key, value in series_list:
+                    if metric_type != METRIC_TYPE_HISTOGRAM:
+                        line_list.append(f'{name}{format_metric_labels(label_key)} {value}')
+                        continue
+
+                    cumulative_count = 0
+                    for bucket, bucket_count in zip(value.bucket_list + ['+Inf'], value.bucket_count_list):
+                        cumulative_count += bucket_count
+                        bucket_label_key = label_key + (('le', bucket),)
+                        line_list.append(f'{name}_bucket{format_metric_labels(bucket_label_key)} {cumulative_count}')
+                    line_list.append(f'{name}_sum{format_metric_labels(label_key)} {value.sum}')
+                    line_list.append(f'{name}_count{format_metric_labels(label_key)} {value.count}')
+
+        return '\n'.join(line_list) + '\n'
+
+
+METRIC_STAGE_DURATION = 'remotedesktop_stage_duration_seconds'
+METRIC_FRAMES_SENT = 'remotedesktop_frames_sent_total'
+METRIC_FRAMES_DROPPED = 'remotedesktop_frames_dropped_total'
+METRIC_SENT_BYTES = 'remotedesktop_sent_bytes_total'
+METRIC_VIEWER_SENT_BYTES = 'remotedesktop_viewer_sent_bytes_total'
+METRIC_ACTIVE_STREAMS = 'remotedesktop_active_streams'
+METRIC_ACTIVE_ENCODINGS = 'remotedesktop_active_encodings'
+METRIC_FRAME_BUFFER_ALLOCATIONS = 'remotedesktop_frame_buffer_allocations_total'
+METRIC_INPUT_EVENTS = 'remotedesktop_input_events_total'
+METRIC_COALESCED_MOUSE_MOVES = 'remotedesktop_coalesced_mouse_moves_total'
+METRIC_CURSOR_POSITIONS_SENT = 'remotedesktop_cursor_positions_sent_total'
+
+STAGE_GRAB = 'grab'
+STAGE_CURSOR = 'cursor'
+STAGE_CONVERT = 'convert'
+STAGE_RESIZE = 'resize'
+STAGE_ENCODE = 'encode'
+STAGE_WRITE = 'write'
+
+METRICS = MetricsRegistry()
+METRICS.describe(METRIC_STAGE_DURATION, METRIC_TYPE_HISTOGRAM, 'Time spent in each stage of the capture pipeline (grab, cursor, convert, resize, encode, write).')
+METRICS.describe(METRIC_FRAMES_SENT, METRIC_TYPE_COUNTER, 'Frames written to the viewers.')
+METRICS.describe(METRIC_FRAMES_DROPPED, METRIC_TYPE_COUNTER, 'Frames skipped because the capture loop ran late (reason="capture"), the capture process reused the shared memory slot while the frame was being encoded (reason="overwritten") or a viewer had not taken the previous frame yet (reason="viewer").')
+METRICS.describe(METRIC_SENT_BYTES, METRIC_TYPE_COUNTER, 'Image bytes written to the viewers.')
+METRICS.describe(METRIC_VIEWER_SENT_BYTES, METRIC_TYPE_COUNTER, 'Image bytes written to each connected viewer.')
+METRICS.describe(METRIC_ACTIVE_STREAMS, METRIC_TYPE_GAUGE, 'Subscribers of the shared capture, viewers plus the recorders.')
+METRICS.describe(METRIC_ACTIVE_ENCODINGS, METRIC_TYPE_GAUGE, 'Distinct stream settings encoded for each capture.')
+METRICS.describe(METRIC_FRAME_BUFFER_ALLOCATIONS, METRIC_TYPE_COUNTER, 'Image buffers allocated by the frame grabber, only grows when a new stream setting or region needs its buffers.')
+METRICS.describe(METRIC_INPUT_EVENTS, METRIC_TYPE_COUNTER, 'Mouse and keyboard events applied from the viewers.')
+METRICS.describe(METRIC_COALESCED_MOUSE_MOVES, METRIC_TYPE_COUNTER, 'Mouse moves replaced by a newer position before they were applied.')
+METRICS.describe(METRIC_CURSOR_POSITIONS_SENT, METRIC_TYPE_COUNTER, 'Cursor positions sent to the viewers drawing the cursor themselves (cursor=overlay).')
+
+VIEWER_ID_COUNTER = itertools.count(1)
+
+
+def observe_stage_duration(
+    stage: str,
+    start_time: float,
+):
+    METRICS.observe(METRIC_STAGE_DURATION, time.perf_counter() - start_time, stage=stage)
 
-            bgra_image[real_y, real_x][0:3] = CURSOR_BGRA_IMAGE[y, x][0:3]
+
+def record_frame_sent(
+    transport: str,
+    viewer_id: int,
+    remote_ip: str,
+    sent_bytes: int,
+    write_duration_seconds: float,
+):
+    METRICS.observe(METRIC_STAGE_DURATION, write_duration_seconds, stage=STAGE_WRITE)
+    METRICS.increment(METRIC_FRAMES_SENT, transport=transport)
+    METRICS.increment(METRIC_SENT_BYTES, sent_bytes, transport=transport)
+    METRICS.increment(METRIC_VIEWER_SENT_BYTES, sent_bytes, viewer=viewer_id, remote_ip=remote_ip, transport=transport)
+
+
+def remove_viewer_metrics(
+    transport: str,
+    viewer_id: int,
+    remote_ip: str,
+):
+    # the per viewer series go away with the viewer
+    METRICS.remove(METRIC_VIEWER_SENT_BYTES, viewer=viewer_id, remote_ip=remote_ip, transport=transport)
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(METRICS.render())
 
 
-def capture_screen_to_image_bytes(
-    screen_region: dict = None,
-    encode_image_format_extension: str = '.png',
+class ClockHandler(tornado.web.RequestHandler):
+    def get(self):
+        # the viewer estimates the offset between its clock and the capture timestamps from the round trip
+        self.set_header('Content-Type', 'application/json')
+        self.set_header('Cache-Control', 'no-store')
+        self.write(json.dumps({'time': time.time()}))
+
+
+### END METRICS ########################################################
+########################################################################
+### FRAME GRABBER ######################################################
+# long-lived capture object which keeps the mss handle open and reuses its output buffers between frames
+# it is not thread-safe and must stay on the thread which created it (mss handles are thread-bound on windows)
+
+def get_rendition_size(
+    image_width: int,
+    image_height: int,
     scaling_factor: float = None,
-    render_mouse_cursor: bool = False,
+    target_width: int = None,
 ):
-    with mss.mss() as sct:
+    # renditions are never larger than the captured image
+    scaled_width = image_width
+    if target_width is not None:
+        scaled_width = min(target_width, scaled_width)
+    if scaling_factor is not None:
+        scaled_width = scaled_width * scaling_factor
+
+    scaled_width = max(1, int(round(scaled_width)))
+    scaled_height = max(1, int(round(image_height * scaled_width / image_width)))
+    return scaled_width, scaled_height
+
+
+def get_screen_region_key(screen_region: dict):
+    return (
+        screen_region['left'],
+        screen_region['top'],
+        screen_region['width'],
+        screen_region['height'],
+    )
+
+
+class FrameGrabber:
+    def __init__(
+        self,
+        screen_source_factory=None,
+        frame_ring=None,
+    ):
+        # mss.mss by default, anything with the same monitors, grab() and close() can stand in for the screen
+        # see benchmarks/synthetic_screen.py
+        self.screen_source_factory = screen_source_factory
+        # read the frames of the capture process instead of grabbing the screen, see SharedFrameRing
+        self.frame_ring = frame_ring
+        self.frame_ring_sequence_number = None
+        self.frame_ring_capture_timestamp = None
+        # stage -> seconds spent on the current frame, reset by grab, sent to the viewers with the frame
+        self.stage_duration_dict = {}
+        self.sct = None
+        self.buffer_dict = {}
+        # previous screenshot bytes of each grabbed region for change detection
+        self.previous_raw_dict = {}
+        self.frame_changed = True
+
+    def open(self):
+        if self.sct is None:
+            if self.screen_source_factory is None:
+                self.sct = mss.mss()
+            else:
+                self.sct = self.screen_source_factory()
+
+    def close(self):
+        if self.sct is not None:
+            self.sct.close()
+            self.sct = None
+
+        self.buffer_dict = {}
+        self.previous_raw_dict = {}
+
+    def get_buffer(
+        self,
+        name: str,
+        shape: tuple,
+    ):
+        # keyed by shape as well so that streams with different scaling do not keep reallocating the same buffer
+        buffer_key = (name, shape)
+        np_buffer = self.buffer_dict.get(buffer_key)
+        if np_buffer is None:
+            np_buffer = np.empty(shape, dtype=np.uint8)
+            self.buffer_dict[buffer_key] = np_buffer
+            # stays flat once every stream setting has its buffers, the hot path allocates nothing
+            METRICS.increment(METRIC_FRAME_BUFFER_ALLOCATIONS)
+
+        return np_buffer
+
+    def get_monitor_list(self):
+        # index 0 is the bounding box of all the monitors, the monitors themselves start at 1
+        if self.frame_ring is not None:
+            return self.frame_ring.get_monitor_list()
+
+        self.open()
+        return self.sct.monitors
+
+    def get_screen_region(
+        self,
+        monitor_index: int = None,
+        capture_region: tuple = None,
+    ):
+        monitor_list = self.get_monitor_list()
+        if (monitor_index is None) or (monitor_index >= len(monitor_list)):
+            monitor_index = 1
+        monitor = monitor_list[monitor_index]
+
+        if capture_region is None:
+            return {
+                'left': monitor['left'],
+                'top': monitor['top'],
+                'width': monitor['width'],
+                'height': monitor['height'],
+            }
+
+        # the rectangle is relative to the monitor and clipped to its bounds
+        x, y, width, height = capture_region
+        x1 = min(max(x, 0), monitor['width'])
+        y1 = min(max(y, 0), monitor['height'])
+        x2 = min(max(x + width, 0), monitor['width'])
+        y2 = min(max(y + height, 0), monitor['height'])
+        if (x2 <= x1) or (y2 <= y1):
+            return self.get_screen_region(monitor_index)
+
+        return {
+            'left': monitor['left'] + x1,
+            'top': monitor['top'] + y1,
+            'width': x2 - x1,
+            'height': y2 - y1,
+        }
+
+    def forget_screen_regions(self, screen_region_list: list):
+        # keep the change detection state of the given regions only
+        keep_key_set = set(get_screen_region_key(x) for x in screen_region_list)
+        for region_key in list(self.previous_raw_dict.keys()):
+            if region_key not in keep_key_set:
+                del self.previous_raw_dict[region_key]
+
+    def grab(
+        self,
+        screen_region: dict = None,
+        detect_changes: bool = True,
+    ):
+        # stage durations are reported per frame and each frame starts with a grab
+        self.stage_duration_dict = {}
+
         if screen_region is None:
-            screen_region = sct.monitors[1]
+            screen_region = self.get_screen_region()
+
+        if self.frame_ring is not None:
+            return self.grab_from_frame_ring(screen_region, detect_changes), screen_region
+
+        self.open()
+        start_time = time.perf_counter()
+        # only the pixels of the region are copied out of the X server
+        mss_image = self.sct.grab(screen_region)
+        if detect_changes:
+            # comparing two bytearrays is a memcmp, much cheaper than encoding a frame which did not change
+            # the grabbed image must not be modified in place or this comparison breaks for the next frame
+            region_key = get_screen_region_key(screen_region)
+            previous_raw = self.previous_raw_dict.get(region_key)
+            self.frame_changed = (previous_raw is None) or (previous_raw != mss_image.raw)
+            self.previous_raw_dict[region_key] = mss_image.raw
+
+        # view the BGRA bytes owned by the screenshot instead of copying them with np.array
+        np_image = np.frombuffer(mss_image.raw, dtype=np.uint8)
+        np_image = np_image.reshape((mss_image.height, mss_image.width, 4))
+        self.observe_stage(STAGE_GRAB, start_time)
+        return np_image, screen_region
+
+    def grab_from_frame_ring(
+        self,
+        screen_region: dict,
+        detect_changes: bool = True,
+    ):
+        start_time = time.perf_counter()
+        sequence_number, capture_timestamp, frame_image = self.frame_ring.read_latest()
+        self.frame_ring_sequence_number = sequence_number
+        self.frame_ring_capture_timestamp = capture_timestamp
+
+        # a view of the shared memory, cropping does not copy either
+        virtual_screen = self.frame_ring.get_monitor_list()[0]
+        x = screen_region['left'] - virtual_screen['left']
+        y = screen_region['top'] - virtual_screen['top']
+        np_image = frame_image[y:y + screen_region['height'], x:x + screen_region['width']]
+
+        if detect_changes:
+            # the capture process writes a frame for a change anywhere on the virtual screen
+            # the same sequence number means nothing changed, a new one is compared against a copy of this region
+            region_key = get_screen_region_key(screen_region)
+            previous_sequence_number, previous_image = self.previous_raw_dict.get(region_key, (None, None))
+            if previous_sequence_number == sequence_number:
+                self.frame_changed = False
+            elif (previous_image is None) or (previous_image.shape != np_image.shape):
+                self.frame_changed = True
+                previous_image = np_image.copy()
+            else:
+                self.frame_changed = not np.array_equal(previous_image, np_image)
+                if self.frame_changed:
+                    np.copyto(previous_image, np_image)
+            self.previous_raw_dict[region_key] = (sequence_number, previous_image)
+
+        self.observe_stage(STAGE_GRAB, start_time)
+        return np_image
+
+    def is_grabbed_frame_intact(
+        self,
+        screen_region: dict,
+    ):
+        # false when the capture process reused the ring slot while the frame was being encoded
+        if (self.frame_ring is None) or self.frame_ring.is_intact(self.frame_ring_sequence_number):
+            return True
+
+        # encode this region again from the next frame even if the screen does not change anymore
+        self.previous_raw_dict.pop(get_screen_region_key(screen_region), None)
+        return False
+
+    def observe_stage(
+        self,
+        stage: str,
+        start_time: float,
+    ):
+        duration_seconds = time.perf_counter() - start_time
+        self.stage_duration_dict[stage] = self.stage_duration_dict.get(stage, 0.0) + duration_seconds
+        METRICS.observe(METRIC_STAGE_DURATION, duration_seconds, stage=stage)
+
+    def copy_to_buffer(
+        self,
+        name: str,
+        bgra_image: np.ndarray,
+    ):
+        np_buffer = self.get_buffer(name, bgra_image.shape)
+        np.copyto(np_buffer, bgra_image)
+        return np_buffer
+
+    def resize(
+        self,
+        bgra_image: np.ndarray,
+        scaling_factor: float = None,
+        target_width: int = None,
+        buffer_name: str = 'resize',
+    ):
+        image_height, image_width = bgra_image.shape[:2]
+        scaled_width, scaled_height = get_rendition_size(
+            image_width,
+            image_height,
+            scaling_factor=scaling_factor,
+            target_width=target_width,
+        )
+        return self.resize_to(
+            bgra_image,
+            scaled_width,
+            scaled_height,
+            buffer_name=buffer_name,
+        )
 
-        mss_image = sct.grab(screen_region)
-        np_image = np.array(mss_image, dtype=np.uint8)
+    def resize_to(
+        self,
+        bgra_image: np.ndarray,
+        width: int,
+        height: int,
+        buffer_name: str = 'resize',
+    ):
+        image_height, image_width = bgra_image.shape[:2]
+        if (width == image_width) and (height == image_height):
+            return bgra_image
+
+        start_time = time.perf_counter()
+        # resize before dropping the alpha channel so the conversion runs on the smaller image
+        resized_image = self.get_buffer(
+            buffer_name,
+            (height, width, 4),
+        )
+        cv2.resize(
+            bgra_image,
+            dsize=(width, height),
+            dst=resized_image,
+            # averages the source pixels when shrinking, nearest neighbour drops whole rows and columns of text
+            interpolation=cv2.INTER_AREA,
+        )
+        self.observe_stage(STAGE_RESIZE, start_time)
+        return resized_image
+
+    def convert_to_bgr(
+        self,
+        bgra_image: np.ndarray,
+    ):
+        start_time = time.perf_counter()
+        bgr_image = self.get_buffer('bgr', bgra_image.shape[:2] + (3,))
+        cv2.cvtColor(bgra_image, cv2.COLOR_BGRA2BGR, dst=bgr_image)
+        self.observe_stage(STAGE_CONVERT, start_time)
+        return bgr_image
+
+    def encode(
+        self,
+        bgra_image: np.ndarray,
+        image_format: str = 'png',
+        scaling_factor: float = None,
+        image_quality: int = None,
+        encoder_options: tuple = (),
+    ):
+        bgra_image = self.resize(bgra_image, scaling_factor)
+
+        if image_format in BGRA_ENCODABLE_IMAGE_FORMAT_LIST:
+            # the jpeg and webp encoders drop the alpha channel by themselves, skip the BGRA -> BGR copy
+            source_image = bgra_image
+        else:
+            source_image = self.convert_to_bgr(bgra_image)
+
+        start_time = time.perf_counter()
+        bs = encode_image(
+            source_image,
+            image_format,
+            image_quality=image_quality,
+            encoder_options=encoder_options,
+        )
+        self.observe_stage(STAGE_ENCODE, start_time)
+        return bs
 
-        if render_mouse_cursor:
-            mouse_position = MOUSE_CONTROLLER.position
-            merge_cursor(
-                np_image,
-                mouse_position,
-                monitor_region=screen_region,
-            )
 
-        rgb_image = cv2.cvtColor(np_image, cv2.COLOR_BGRA2BGR)
+### END FRAME GRABBER ##################################################
+########################################################################
+### DIRTY TILE STREAM ##################################################
+# split the frame into fixed size tiles and only encode the tiles which changed since the previous frame
+
+DEFAULT_TILE_SIZE = 128
+# keep the stripe boundaries on the jpeg macroblock grid
+STRIPE_HEIGHT_ALIGNMENT = 16
+
 
-        if scaling_factor is not None:
-            rgb_image = cv2.resize(
-                rgb_image,
-                dsize=None,
-                fx=scaling_factor,
-                fy=scaling_factor,
-                interpolation=cv2.INTER_NEAREST,
+def compute_changed_tile_grid(
+    previous_image: np.ndarray,
+    current_image: np.ndarray,
+    tile_width: int,
+    tile_height: int,
+):
+    image_height, image_width = current_image.shape[:2]
+    changed_pixel_mask = (previous_image != current_image).any(axis=2)
+    # reduceat handles the partial tiles on the right and bottom edges
+    row_start_list = np.arange(0, image_height, tile_height)
+    column_start_list = np.arange(0, image_width, tile_width)
+    changed_row_mask = np.logical_or.reduceat(changed_pixel_mask, row_start_list, axis=0)
+    return np.logical_or.reduceat(changed_row_mask, column_start_list, axis=1)
+
+
+def get_stripe_height(
+    image_height: int,
+    stripe_count: int,
+):
+    stripe_height = int(math.ceil(image_height / max(1, stripe_count)))
+    stripe_height = int(math.ceil(stripe_height / STRIPE_HEIGHT_ALIGNMENT)) * STRIPE_HEIGHT_ALIGNMENT
+    return max(STRIPE_HEIGHT_ALIGNMENT, stripe_height)
+
+
+class TileStreamState:
+    def __init__(
+        self,
+        tile_width: int = DEFAULT_TILE_SIZE,
+        tile_height: int = DEFAULT_TILE_SIZE,
+    ):
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.previous_image = None
+        # sequence number of the frame which last changed each tile
+        self.tile_version_grid = None
+        # encoded bytes of each tile in row-major order
+        self.tile_list = None
+        # time spent encoding the changed tiles of the last update
+        self.encode_duration_seconds = 0.0
+
+    def update(
+        self,
+        bgr_image: np.ndarray,
+        image_format: str,
+        sequence_number: int,
+        image_quality: int = None,
+        encoder_options: tuple = (),
+        encoder_executor: concurrent.futures.Executor = None,
+    ):
+        tile_width = self.tile_width
+        tile_height = self.tile_height
+        image_height, image_width = bgr_image.shape[:2]
+        grid_width = int(math.ceil(image_width / tile_width))
+        grid_height = int(math.ceil(image_height / tile_height))
+
+        if (self.previous_image is None) or (self.previous_image.shape != bgr_image.shape):
+            self.previous_image = np.empty_like(bgr_image)
+            self.tile_version_grid = np.zeros((grid_height, grid_width), dtype=np.int64)
+            self.tile_list = [None] * (grid_height * grid_width)
+            changed_tile_grid = np.ones((grid_height, grid_width), dtype=bool)
+        else:
+            changed_tile_grid = compute_changed_tile_grid(
+                self.previous_image,
+                bgr_image,
+                tile_width,
+                tile_height,
             )
 
-        print(time.perf_counter_ns(), 'rgb_image.shape', rgb_image.shape, end='\r')
-        status, bs = cv2.imencode(encode_image_format_extension, rgb_image)
-        if status:
-            return bs.tobytes()
+        changed_tile_index_list = []
+        tile_image_list = []
+        for tile_y, tile_x in zip(*np.nonzero(changed_tile_grid)):
+            y = tile_y * tile_height
+            x = tile_x * tile_width
+            tile_slice = (slice(y, y + tile_height), slice(x, x + tile_width))
+            self.previous_image[tile_slice] = bgr_image[tile_slice]
+            changed_tile_index_list.append((tile_y, tile_x))
+            tile_image_list.append(self.previous_image[tile_slice])
+
+        def encode_tile(tile_image):
+            return encode_image(
+                tile_image,
+                image_format,
+                image_quality=image_quality,
+                encoder_options=encoder_options,
+            )
 
-        return None
+        # cv2.imencode releases the GIL so the tiles are encoded on all the cores at the same time
+        start_time = time.perf_counter()
+        if (encoder_executor is None) or (len(tile_image_list) < 2):
+            encoded_tile_list = list(map(encode_tile, tile_image_list))
+        else:
+            encoded_tile_list = list(encoder_executor.map(encode_tile, tile_image_list))
+        self.encode_duration_seconds = time.perf_counter() - start_time
+        if len(tile_image_list) > 0:
+            observe_stage_duration(STAGE_ENCODE, start_time)
+
+        number_of_changed_tiles = 0
+        for (tile_y, tile_x), bs in zip(changed_tile_index_list, encoded_tile_list):
+            if bs is None:
+                continue
+
+            self.tile_list[tile_y * grid_width + tile_x] = bs
+            self.tile_version_grid[tile_y, tile_x] = sequence_number
+            number_of_changed_tiles += 1
+
+        return number_of_changed_tiles
+
+
+### END DIRTY TILE STREAM ##############################################
+########################################################################
 
 
 def make_obj_json_friendly(obj):
@@ -147,9 +930,6 @@ def is_child_path(parent_path, child_path):
     parent_path = parent_path.lower()
     child_path = child_path.lower()
 
-    print('parent_path', parent_path)
-    print('child_path', child_path)
-
     return child_path.startswith(parent_path)
 
 
@@ -227,49 +1007,92 @@ def normalize_request_path(request_path: str):
 
 
 ########################################################################
-RESPONSE_FILE_CHUNKS_SIZE = 8388608  # 8MB
+# at most one chunk is waiting in tornado's output buffer and one more is being read from the disk
+# so the memory used by a download does not depend on the file size
+RESPONSE_FILE_CHUNKS_SIZE = 1048576  # 1MB
+
+# the disk reads are kept off the io loop
+STATIC_FILE_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=4,
+    thread_name_prefix='static',
+)
 
 
-def send_file_data(
+def read_file_chunk(
+    infile,
+    offset: int,
+    size: int,
+):
+    infile.seek(offset)
+    return infile.read(size)
+
+
+async def send_file_data(
     request_handler: tornado.web.RequestHandler,
     inpath: str,
     range_pair_list=None,
+    part_header_list: list = None,
+    closing_bytes: bytes = None,
 ):
-    with open(inpath, 'rb') as infile:
-        if range_pair_list is not None:
-            total_number_of_chunks = 0
+    # range pairs are [start, end) byte offsets, the whole file by default
+    # part_header_list and closing_bytes wrap the ranges of a multipart/byteranges response
+    # the content size header and status code should have already been set before calling this function
+    io_loop = tornado.ioloop.IOLoop.current()
+    sent_bytes = 0
 
-            for range_pair in range_pair_list:
-                remaining_bytes = range_pair[1] - range_pair[0]
-                infile.seek(range_pair[0])
-
-                number_of_chunks = int(math.ceil(remaining_bytes / RESPONSE_FILE_CHUNKS_SIZE))
-                total_number_of_chunks += number_of_chunks
+    with open(inpath, 'rb') as infile:
+        if range_pair_list is None:
+            range_pair_list = [(0, os.fstat(infile.fileno()).st_size)]
 
-            pbar = tqdm.tqdm(total=total_number_of_chunks)
-            for range_pair in range_pair_list:
-                remaining_bytes = range_pair[1] - range_pair[0]
-                infile.seek(range_pair[0])
+        read_future = None
+        try:
+            for range_index, (range_start, range_end) in enumerate(range_pair_list):
+                if part_header_list is not None:
+                    request_handler.write(part_header_list[range_index])
+
+                offset = range_start
+                if offset < range_end:
+                    read_future = io_loop.run_in_executor(
+                        STATIC_FILE_EXECUTOR,
+                        read_file_chunk,
+                        infile,
+                        offset,
+                        min(RESPONSE_FILE_CHUNKS_SIZE, range_end - offset),
+                    )
+
+                while read_future is not None:
+                    data = await read_future
+                    read_future = None
+                    if len(data) == 0:
+                        raise Exception(f'{inpath} is shorter than the Content-Length which was sent')
+
+                    offset += len(data)
+                    if offset < range_end:
+                        # read the next chunk while this one is being sent
+                        read_future = io_loop.run_in_executor(
+                            STATIC_FILE_EXECUTOR,
+                            read_file_chunk,
+                            infile,
+                            offset,
+                            min(RESPONSE_FILE_CHUNKS_SIZE, range_end - offset),
+                        )
 
-                number_of_chunks = int(math.ceil(remaining_bytes / RESPONSE_FILE_CHUNKS_SIZE))
-                for i in range(number_of_chunks):
-                    read_data_size = int(min(RESPONSE_FILE_CHUNKS_SIZE, remaining_bytes))
-                    data = infile.read(read_data_size)
                     request_handler.write(data)
-                    remaining_bytes -= read_data_size
+                    await request_handler.flush()
+                    sent_bytes += len(data)
 
-        else:
-            # send whole file
-            # the content size header and status code should have already been set before calling this function
-            filesize = os.stat(inpath).st_size
-            number_of_chunks = int(math.ceil(filesize / RESPONSE_FILE_CHUNKS_SIZE))
-            pbar = tqdm.tqdm(range(number_of_chunks))
-            remote_address = request_handler.request.connection.stream.socket.getpeername()
-            description = f'{inpath} > {remote_address}'
-            pbar.set_description(description)
-            for _ in pbar:
-                data = infile.read(RESPONSE_FILE_CHUNKS_SIZE)
-                request_handler.write(data)
+            if closing_bytes is not None:
+                request_handler.write(closing_bytes)
+        except tornado.iostream.StreamClosedError:
+            print(f'{inpath} > {request_handler.request.remote_ip}: connection closed after {sent_bytes} bytes')
+            return
+        finally:
+            if read_future is not None:
+                # the file must not be closed under a pending read
+                try:
+                    await read_future
+                except Exception:
+                    pass
 
 
 ########################################################################
@@ -307,6 +1130,439 @@ def get_mime_type_by_filename(
         return 'application/octet-stream'
 
 
+########################################################################
+### STATIC ASSET CACHE #################################################
+# small static files are kept in memory with their content hash and their compressed variants
+# an entry is reloaded when the size or the modified time of the file changes
+
+DEFAULT_STATIC_CACHE_MEGABYTES = 64
+MAX_CACHED_ASSET_SIZE = 4194304  # 4MB
+# compressing tiny files is not worth the Vary header
+MIN_COMPRESSED_ASSET_SIZE = 256
+COMPRESSIBLE_MIME_TYPE_LIST = TEXT_MIME_TYPE_LIST + [
+    'image/svg+xml',
+]
+
+
+class StaticAsset:
+    def __init__(
+        self,
+        local_path: str,
+        file_stat: os.stat_result,
+        data: bytes,
+    ):
+        self.local_path = local_path
+        self.mtime_ns = file_stat.st_mtime_ns
+        self.size = file_stat.st_size
+        self.data = data
+        # strong validator, the same content always gets the same tag
+        self.content_hash = hashlib.sha256(data).hexdigest()[:32]
+        self.etag = f'"{self.content_hash}"'
+        # content coding -> compressed bytes, None when the coding does not make it smaller
+        self.variant_dict = {}
+
+    def is_stale(self, file_stat: os.stat_result):
+        return (file_stat.st_mtime_ns != self.mtime_ns) or (file_stat.st_size != self.size)
+
+    def get_cached_size(self):
+        return len(self.data) + sum(len(x) for x in self.variant_dict.values() if x is not None)
+
+    def get_etag(self, content_coding: str = None):
+        # each content coding is a different sequence of bytes and needs its own strong validator
+        if content_coding is None:
+            return self.etag
+
+        return f'"{self.content_hash}-{content_coding}"'
+
+    def get_variant(self, content_coding: str):
+        # compressed once per version of the file
+        if content_coding not in self.variant_dict:
+            if content_coding == 'br':
+                compressed_data = brotli.compress(self.data)
+            else:
+                compressed_data = gzip.compress(self.data, compresslevel=9, mtime=0)
+
+            if len(compressed_data) >= len(self.data):
+                compressed_data = None
+            self.variant_dict[content_coding] = compressed_data
+
+        return self.variant_dict[content_coding]
+
+
+class StaticAssetCache:
+    def __init__(
+        self,
+        max_bytes: int = DEFAULT_STATIC_CACHE_MEGABYTES * (1024 ** 2),
+    ):
+        self.max_bytes = max_bytes
+        # least recently used first
+        self.asset_dict = collections.OrderedDict()
+
+    def get(
+        self,
+        local_path: str,
+        file_stat: os.stat_result,
+    ):
+        # None for the files which are too large, they are streamed from the disk
+        if (file_stat.st_size > MAX_CACHED_ASSET_SIZE) or (file_stat.st_size > self.max_bytes):
+            return None
+
+        asset = self.asset_dict.get(local_path)
+        if (asset is None) or asset.is_stale(file_stat):
+            with open(local_path, 'rb') as infile:
+                data = infile.read()
+            if len(data) != file_stat.st_size:
+                # the file is being written, do not cache a partial copy
+                return None
+
+            asset = StaticAsset(local_path, file_stat, data)
+            self.asset_dict[local_path] = asset
+
+        self.asset_dict.move_to_end(local_path)
+        self.evict()
+        return asset
+
+    def evict(self):
+        total_size = sum(x.get_cached_size() for x in self.asset_dict.values())
+        while (total_size > self.max_bytes) and (len(self.asset_dict) > 1):
+            _, asset = self.asset_dict.popitem(last=False)
+            total_size -= asset.get_cached_size()
+
+
+STATIC_ASSET_CACHE = StaticAssetCache()
+
+
+def get_accepted_content_coding(
+    accept_encoding_header: str,
+):
+    # the best coding we can produce which the client accepts, None for identity
+    accepted_coding_set = set()
+    for coding_spec in accept_encoding_header.split(','):
+        coding_spec_part_list = coding_spec.strip().split(';')
+        coding = coding_spec_part_list[0].strip().lower()
+        is_refused = False
+        for param in coding_spec_part_list[1:]:
+            param = param.strip().lower()
+            if param.startswith('q='):
+                try:
+                    is_refused = float(param[2:]) == 0
+                except Exception as ex:
+                    is_refused = True
+
+        if not is_refused:
+            accepted_coding_set.add(coding)
+
+    if (brotli is not None) and ('br' in accepted_coding_set):
+        return 'br'
+    if 'gzip' in accepted_coding_set:
+        return 'gzip'
+
+    return None
+
+
+def is_not_modified(
+    request_handler: tornado.web.RequestHandler,
+    last_modified_time: float,
+    etag: str = None,
+):
+    # If-None-Match takes precedence over If-Modified-Since
+    if_none_match_header = request_handler.request.headers.get('If-None-Match')
+    if if_none_match_header is not None:
+        if etag is None:
+            return False
+
+        if if_none_match_header.strip() == '*':
+            return True
+
+        # weak comparison
+        for client_etag in if_none_match_header.split(','):
+            client_etag = client_etag.strip()
+            if client_etag.startswith('W/'):
+                client_etag = client_etag[2:]
+            if client_etag == etag:
+                return True
+
+        return False
+
+    if_modified_since_header = request_handler.request.headers.get('If-Modified-Since')
+    if if_modified_since_header is not None:
+        try:
+            if_modified_since_time = email.utils.parsedate_to_datetime(if_modified_since_header).timestamp()
+        except Exception as ex:
+            return False
+
+        # http dates have a one second resolution
+        return int(last_modified_time) <= int(if_modified_since_time)
+
+    return False
+
+
+def is_compressible_asset(
+    asset: StaticAsset,
+    content_type: str,
+):
+    mime_type = content_type.split(';')[0]
+    return (mime_type in COMPRESSIBLE_MIME_TYPE_LIST) and (asset.size >= MIN_COMPRESSED_ASSET_SIZE)
+
+
+def select_asset_content_coding(
+    request_handler: tornado.web.RequestHandler,
+    asset: StaticAsset,
+    content_type: str,
+):
+    # None for the identity bytes, which are also the bytes of the range requests
+    if not is_compressible_asset(asset, content_type):
+        return None
+
+    if request_handler.request.headers.get('Range') is not None:
+        return None
+
+    content_coding = get_accepted_content_coding(request_handler.request.headers.get('Accept-Encoding', ''))
+    if (content_coding is None) or (asset.get_variant(content_coding) is None):
+        return None
+
+    return content_coding
+
+
+def send_cached_asset(
+    request_handler: tornado.web.RequestHandler,
+    asset: StaticAsset,
+    content_type: str,
+    content_coding: str = None,
+):
+    request_handler.set_status(200)
+    request_handler.set_header('Content-Type', content_type)
+
+    data = asset.data
+    if content_coding is not None:
+        request_handler.set_header('Content-Encoding', content_coding)
+        data = asset.get_variant(content_coding)
+
+    request_handler.set_header('Content-Length', str(len(data)))
+    request_handler.write(data)
+
+
+### END STATIC ASSET CACHE #############################################
+########################################################################
+### HTTP RANGE REQUESTS ################################################
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+# more ranges than this are answered with the whole file
+MAX_RANGE_COUNT = 32
+
+
+def parse_range_header(
+    range_header: str,
+    filesize: int,
+):
+    # returns the sorted and merged [start, end) pairs
+    # None means the header must be ignored and the whole file is sent
+    # raises RangeNotSatisfiable when the syntax is valid but no range overlaps the file
+    range_header = range_header.strip()
+    if not range_header.lower().startswith('bytes='):
+        return None
+
+    range_pair_list = []
+    for range_spec in range_header[len('bytes='):].split(','):
+        range_spec = range_spec.strip()
+        if len(range_spec) == 0:
+            continue
+
+        if '-' not in range_spec:
+            return None
+
+        first_str, last_str = range_spec.split('-', 1)
+        first_str = first_str.strip()
+        last_str = last_str.strip()
+        if (not first_str.isdigit()) and (len(first_str) > 0):
+            return None
+        if (not last_str.isdigit()) and (len(last_str) > 0):
+            return None
+
+        if len(first_str) == 0:
+            # suffix range, the last N bytes
+            if len(last_str) == 0:
+                return None
+
+            suffix_length = int(last_str)
+            if suffix_length == 0:
+                continue
+
+            start = max(0, filesize - suffix_length)
+            end = filesize
+        else:
+            start = int(first_str)
+            if len(last_str) == 0:
+                end = filesize
+            else:
+                last = int(last_str)
+                if last < start:
+                    return None
+                end = min(last + 1, filesize)
+
+        if start >= filesize:
+            # this range is not satisfiable, the others may be
+            continue
+
+        range_pair_list.append((start, end))
+
+    if len(range_pair_list) == 0:
+        raise RangeNotSatisfiable(f'{range_header} is outside of {filesize} bytes')
+
+    # overlapping and adjacent ranges are sent once
+    range_pair_list.sort()
+    merged_range_pair_list = [range_pair_list[0]]
+    for start, end in range_pair_list[1:]:
+        previous_start, previous_end = merged_range_pair_list[-1]
+        if start <= previous_end:
+            merged_range_pair_list[-1] = (previous_start, max(previous_end, end))
+        else:
+            merged_range_pair_list.append((start, end))
+
+    if len(merged_range_pair_list) > MAX_RANGE_COUNT:
+        return None
+
+    return merged_range_pair_list
+
+
+def is_if_range_satisfied(
+    if_range_header: str,
+    last_modified_time: float,
+    etag: str = None,
+):
+    # the range applies only if the client still has the same version of the file
+    if_range_header = if_range_header.strip()
+    if if_range_header.startswith('"') or if_range_header.startswith('W/'):
+        # weak entity tags never match
+        return (etag is not None) and (if_range_header == etag)
+
+    try:
+        if_range_time = email.utils.parsedate_to_datetime(if_range_header).timestamp()
+    except Exception as ex:
+        return False
+
+    # http dates have a one second resolution
+    return int(if_range_time) == int(last_modified_time)
+
+
+def get_multipart_byteranges_parts(
+    range_pair_list: list,
+    boundary: str,
+    content_type: str,
+    filesize: int,
+):
+    part_header_list = []
+    for start, end in range_pair_list:
+        part_header = (
+            f'\r\n--{boundary}\r\n'
+            f'Content-Type: {content_type}\r\n'
+            f'Content-Range: bytes {start}-{end - 1}/{filesize}\r\n'
+            '\r\n'
+        )
+        part_header_list.append(part_header.encode('ascii'))
+
+    closing_bytes = f'\r\n--{boundary}--\r\n'.encode('ascii')
+    return part_header_list, closing_bytes
+
+
+async def send_file_response(
+    request_handler: tornado.web.RequestHandler,
+    local_path: str,
+    content_type: str,
+    file_stat: os.stat_result = None,
+):
+    if file_stat is None:
+        file_stat = os.stat(local_path)
+    filesize = file_stat.st_size
+
+    asset = STATIC_ASSET_CACHE.get(local_path, file_stat)
+    content_coding = None
+    if asset is None:
+        etag = None
+    else:
+        # the coding is picked before the validators are compared so that they refer to the bytes which would be sent
+        content_coding = select_asset_content_coding(request_handler, asset, content_type)
+        etag = asset.get_etag(content_coding)
+        if is_compressible_asset(asset, content_type):
+            # on the 304 and 206 responses as well, caches must not mix the codings up
+            request_handler.set_header('Vary', 'Accept-Encoding')
+
+    request_handler.set_header('Accept-Ranges', 'bytes')
+    request_handler.set_header('Last-Modified', email.utils.formatdate(file_stat.st_mtime, usegmt=True))
+    if etag is not None:
+        request_handler.set_header('ETag', etag)
+        # let the browser keep the file but ask whether it changed on every reload
+        request_handler.set_header('Cache-Control', 'no-cache')
+
+    if is_not_modified(request_handler, file_stat.st_mtime, etag):
+        request_handler.set_status(304)
+        return
+
+    range_pair_list = None
+    range_header = request_handler.request.headers.get('Range')
+    if_range_header = request_handler.request.headers.get('If-Range')
+    if (range_header is not None) and (if_range_header is not None):
+        if not is_if_range_satisfied(if_range_header, file_stat.st_mtime, etag):
+            # the file changed, send all of it
+            range_header = None
+
+    if range_header is not None:
+        try:
+            range_pair_list = parse_range_header(range_header, filesize)
+        except RangeNotSatisfiable as ex:
+            print(ex)
+            request_handler.set_status(416)
+            request_handler.set_header('Content-Range', f'bytes */{filesize}')
+            request_handler.set_header('Content-Length', '0')
+            return
+
+    if (range_pair_list is None) and (asset is not None):
+        send_cached_asset(request_handler, asset, content_type, content_coding)
+        return
+
+    if range_pair_list is None:
+        request_handler.set_status(200)
+        request_handler.set_header('Content-Type', content_type)
+        request_handler.set_header('Content-Length', str(filesize))
+        if filesize > 0:
+            await send_file_data(request_handler, local_path)
+        return
+
+    request_handler.set_status(206)
+    if len(range_pair_list) == 1:
+        start, end = range_pair_list[0]
+        request_handler.set_header('Content-Type', content_type)
+        request_handler.set_header('Content-Range', f'bytes {start}-{end - 1}/{filesize}')
+        request_handler.set_header('Content-Length', str(end - start))
+        await send_file_data(request_handler, local_path, range_pair_list)
+        return
+
+    boundary = uuid.uuid4().hex
+    part_header_list, closing_bytes = get_multipart_byteranges_parts(
+        range_pair_list,
+        boundary,
+        content_type,
+        filesize,
+    )
+    content_length = sum(len(x) for x in part_header_list) + len(closing_bytes)
+    content_length += sum(end - start for start, end in range_pair_list)
+
+    request_handler.set_header('Content-Type', f'multipart/byteranges; boundary={boundary}')
+    request_handler.set_header('Content-Length', str(content_length))
+    await send_file_data(
+        request_handler,
+        local_path,
+        range_pair_list,
+        part_header_list=part_header_list,
+        closing_bytes=closing_bytes,
+    )
+
+
+### END HTTP RANGE REQUESTS ############################################
 ########################################################################
 WEBDATA_DIRECTORY = os.path.join(ROOT, 'webdata')
 VALID_HTML_INDEX_FILENAME_LIST = [
@@ -315,44 +1571,108 @@ VALID_HTML_INDEX_FILENAME_LIST = [
 ]
 
 
-def handle_webdata_request(
-    request_handler: tornado.web.RequestHandler,
-):
-    request_path = request_handler.request.path
-    # normalize request path
+# the resolution only depends on the request path string, the entries never go stale
+MAX_RESOLVED_PATH_CACHE_SIZE = 4096
+RESOLVED_PATH_CACHE = collections.OrderedDict()
+
+
+def resolve_request_path(request_path: str):
+    # returns (normalized_request_path, local_path, error_message)
+    resolved_path = RESOLVED_PATH_CACHE.get(request_path)
+    if resolved_path is not None:
+        RESOLVED_PATH_CACHE.move_to_end(request_path)
+        return resolved_path
+
     try:
         normalized_request_path = normalize_request_path(request_path)
     except InvalidCharacterInPath as ex:
         print(ex)
-        # unauthorize
-        request_handler.set_status(403)
-        request_handler.set_header('Content-Type', 'application/json')
-        response_obj = {
-            'message': 'invalid character in path',
-            'path': request_path,
-        }
+        normalized_request_path = None
 
-        response_str = json.dumps(response_obj)
-        request_handler.write(response_str)
+    if normalized_request_path is None:
+        resolved_path = (None, None, 'invalid character in path')
+    else:
+        # join with webdata directory
+        if len(normalized_request_path) == 0:
+            local_path = WEBDATA_DIRECTORY
+        else:
+            local_path = os.path.join(WEBDATA_DIRECTORY, normalized_request_path)
 
-        return
+        if (local_path == WEBDATA_DIRECTORY) or is_child_path(WEBDATA_DIRECTORY, local_path):
+            resolved_path = (normalized_request_path, local_path, None)
+        else:
+            resolved_path = (normalized_request_path, None, 'unauthorized access')
 
-    # join with webdata directory
-    if len(normalized_request_path) == 0:
-        local_path = WEBDATA_DIRECTORY
-    elif normalized_request_path == '/':
-        local_path = WEBDATA_DIRECTORY
-    else:
-        local_path = os.path.join(WEBDATA_DIRECTORY, normalized_request_path)
+    RESOLVED_PATH_CACHE[request_path] = resolved_path
+    if len(RESOLVED_PATH_CACHE) > MAX_RESOLVED_PATH_CACHE_SIZE:
+        RESOLVED_PATH_CACHE.popitem(last=False)
 
-    if local_path == WEBDATA_DIRECTORY:
-        pass
-    elif not is_child_path(WEBDATA_DIRECTORY, local_path):
+    return resolved_path
+
+
+# adding, removing or renaming an entry changes the modified time of the directory
+DirectoryIndex = collections.namedtuple(
+    'DirectoryIndex',
+    [
+        'mtime_ns',
+        # None when the directory has no index.html
+        'index_filepath',
+        'listing_html',
+    ],
+)
+DIRECTORY_INDEX_CACHE = collections.OrderedDict()
+
+
+def get_directory_index(
+    local_path: str,
+    normalized_request_path: str,
+    directory_stat: os.stat_result,
+):
+    cache_key = (local_path, normalized_request_path)
+    directory_index = DIRECTORY_INDEX_CACHE.get(cache_key)
+    if (directory_index is not None) and (directory_index.mtime_ns == directory_stat.st_mtime_ns):
+        DIRECTORY_INDEX_CACHE.move_to_end(cache_key)
+        return directory_index
+
+    child_filename_list = os.listdir(local_path)
+    index_filepath = None
+    listing_html = None
+    for child_filename in child_filename_list:
+        lowered_child_filename = child_filename.lower()
+        if lowered_child_filename in VALID_HTML_INDEX_FILENAME_LIST:
+            index_filepath = os.path.join(local_path, child_filename)
+            break
+
+    if index_filepath is None:
+        # contruct static html page
+        listing_html = render_static_directory_listing_html(
+            normalized_request_path,
+            child_filename_list,
+        )
+
+    directory_index = DirectoryIndex(
+        mtime_ns=directory_stat.st_mtime_ns,
+        index_filepath=index_filepath,
+        listing_html=listing_html,
+    )
+    DIRECTORY_INDEX_CACHE[cache_key] = directory_index
+    if len(DIRECTORY_INDEX_CACHE) > MAX_RESOLVED_PATH_CACHE_SIZE:
+        DIRECTORY_INDEX_CACHE.popitem(last=False)
+
+    return directory_index
+
+
+async def handle_webdata_request(
+    request_handler: tornado.web.RequestHandler,
+):
+    request_path = request_handler.request.path
+    normalized_request_path, local_path, error_message = resolve_request_path(request_path)
+    if error_message is not None:
         # unauthorize
         request_handler.set_status(403)
         request_handler.set_header('Content-Type', 'application/json')
         response_obj = {
-            'message': 'unauthorized access',
+            'message': error_message,
             'path': request_path,
         }
 
@@ -362,7 +1682,9 @@ def handle_webdata_request(
         return
 
     # check if file exists
-    if not os.path.exists(local_path):
+    try:
+        file_stat = os.stat(local_path)
+    except (FileNotFoundError, NotADirectoryError):
         # not found
         request_handler.set_status(404)
         request_handler.set_header('Content-Type', 'application/json')
@@ -376,38 +1698,23 @@ def handle_webdata_request(
 
         return
 
-    file_stat = os.stat(local_path)
     if stat.S_ISDIR(file_stat.st_mode):
         # automatically serve index.html
-        # directory
-        # check if index.html exists
-        child_filename_list = os.listdir(local_path)
-        for child_filename in child_filename_list:
-            lowered_child_filename = child_filename.lower()
-            if lowered_child_filename in VALID_HTML_INDEX_FILENAME_LIST:
-                child_filepath = os.path.join(local_path, child_filename)
-                # send modified time
-                os.path.getmtime(child_filepath)
-                # TODO
-                request_handler.set_status(200)
-                request_handler.set_header('Content-Type', 'text/html')
-                filesize = os.stat(child_filepath).st_size
-                if filesize > 0:
-                    send_file_data(request_handler, child_filepath)
-                return
+        directory_index = get_directory_index(
+            local_path,
+            normalized_request_path,
+            file_stat,
+        )
+        if directory_index.index_filepath is not None:
+            await send_file_response(request_handler, directory_index.index_filepath, 'text/html; charset=utf-8')
+            return
 
         # not found
         # return directory listing
         # TODO option to disable directory listing
-        # contruct static html page
-        html_str = render_static_directory_listing_html(
-            normalized_request_path,
-            child_filename_list,
-        )
-
         request_handler.set_status(200)
         request_handler.set_header('Content-Type', 'text/html')
-        request_handler.write(html_str)
+        request_handler.write(directory_index.listing_html)
         return
 
     if not stat.S_ISREG(file_stat.st_mode):
@@ -426,21 +1733,15 @@ def handle_webdata_request(
         return
 
     # regular file
-    # TODO parse and support Range header
-    request_handler.set_status(200)
     mime_type = get_mime_type_by_filename(local_path)
 
     if mime_type in TEXT_MIME_TYPE_LIST:
         # set mime type and charset to utf-8
-        header_value = f'{mime_type}; charset=utf-8'
-        request_handler.set_header('Content-Type', header_value)
+        content_type = f'{mime_type}; charset=utf-8'
     else:
-        request_handler.set_header('Content-Type', mime_type)
-
-    filesize = os.stat(local_path).st_size
-    request_handler.set_header('Content-Length', str(filesize))
+        content_type = mime_type
 
-    send_file_data(request_handler, local_path)
+    await send_file_response(request_handler, local_path, content_type, file_stat)
 
 
 ### END STATIC FILE HANDLER FUNCTIONS ##################################
@@ -450,7 +1751,7 @@ def handle_webdata_request(
 class AllRequestHandler(tornado.web.RequestHandler):
     async def get(self):
         try:
-            handle_webdata_request(
+            await handle_webdata_request(
                 request_handler=self,
             )
 
@@ -518,6 +1819,17 @@ class AllRequestHandler(tornado.web.RequestHandler):
 
 
 ########################################################################
+STREAM_MODE_FULL = 'full'
+STREAM_MODE_TILES = 'tiles'
+# full width stripes, one per encoder worker
+STREAM_MODE_STRIPES = 'stripes'
+STREAM_MODE_LIST = [
+    STREAM_MODE_FULL,
+    STREAM_MODE_TILES,
+    STREAM_MODE_STRIPES,
+]
+
+
 def web_parse_scaling_value(value_list: list):
     if len(value_list) == 0:
         return None
@@ -547,7 +1859,7 @@ def web_parse_image_format_value(value_list: list):
     try:
         value_str = value_bs.decode('ascii')
         value_str = value_str.lower()
-        if value_str in ('png', 'jpg', 'jpeg'):
+        if value_str in ('png', 'jpg', 'jpeg', 'webp'):
             return value_str
     except Exception as ex:
         pass
@@ -555,7 +1867,7 @@ def web_parse_image_format_value(value_list: list):
     return None
 
 
-def web_parse_frame_rate_value(value_list: list):
+def web_parse_stream_mode_value(value_list: list):
     if len(value_list) == 0:
         return None
 
@@ -564,100 +1876,2891 @@ def web_parse_frame_rate_value(value_list: list):
         return None
 
     try:
-        value_int = int(value_bs)
-        if value_int < 1:
-            return None
-
-        return value_int
+        value_str = value_bs.decode('ascii')
+        value_str = value_str.lower()
+        if value_str in STREAM_MODE_LIST:
+            return value_str
     except Exception as ex:
-        return None
+        pass
 
+    return None
+
+
+def web_parse_frame_rate_value(value_list: list):
+    if len(value_list) == 0:
+        return None
+
+    value_bs = value_list[0]
+    if len(value_bs) == 0:
+        return None
+
+    try:
+        value_int = int(value_bs)
+        if value_int < 1:
+            return None
+
+        return value_int
+    except Exception as ex:
+        return None
+
+
+def web_parse_positive_int_value(value_list: list):
+    if len(value_list) == 0:
+        return None
+
+    value_bs = value_list[0]
+    if len(value_bs) == 0:
+        return None
+
+    try:
+        value_int = int(value_bs)
+        if value_int < 1:
+            return None
+
+        return value_int
+    except Exception as ex:
+        return None
+
+
+def web_parse_quality_value(value_list: list):
+    value_int = web_parse_positive_int_value(value_list)
+    if value_int is None:
+        return None
+
+    return min(value_int, MAX_IMAGE_QUALITY)
+
+
+def web_parse_int_range_value(
+    value_list: list,
+    min_value: int,
+    max_value: int,
+):
+    if len(value_list) == 0:
+        return None
+
+    value_bs = value_list[0]
+    if len(value_bs) == 0:
+        return None
+
+    try:
+        value_int = int(value_bs)
+        if (value_int < min_value) or (value_int > max_value):
+            return None
+
+        return value_int
+    except Exception as ex:
+        return None
+
+
+def web_parse_choice_value(
+    value_list: list,
+    choice_list: list,
+):
+    if len(value_list) == 0:
+        return None
+
+    value_bs = value_list[0]
+    if len(value_bs) == 0:
+        return None
+
+    try:
+        value_str = value_bs.decode('ascii')
+        value_str = value_str.lower()
+        if value_str in choice_list:
+            return value_str
+    except Exception as ex:
+        pass
+
+    return None
+
+
+def web_parse_region_value(value_list: list):
+    # `region=x,y,width,height` in pixels relative to the captured monitor
+    if len(value_list) == 0:
+        return None
+
+    value_bs = value_list[0]
+    if len(value_bs) == 0:
+        return None
+
+    try:
+        value_str = value_bs.decode('ascii')
+        x, y, width, height = [int(x) for x in value_str.split(',')]
+        if (x < 0) or (y < 0) or (width < 1) or (height < 1):
+            return None
+
+        return x, y, width, height
+    except Exception as ex:
+        return None
+
+
+def web_parse_timestamp_value(value_list: list):
+    if len(value_list) == 0:
+        return None
+
+    value_bs = value_list[0]
+    if len(value_bs) == 0:
+        return None
+
+    try:
+        value_float = float(value_bs)
+        if (not math.isfinite(value_float)) or (value_float < 0):
+            return None
+
+        return value_float
+    except Exception as ex:
+        return None
+
+
+def web_parse_speed_value(value_list: list):
+    value_float = web_parse_timestamp_value(value_list)
+    if (value_float is None) or (value_float == 0):
+        return None
+
+    return min(max(value_float, MIN_REPLAY_SPEED), MAX_REPLAY_SPEED)
+
+
+def web_parse_flag_value(value_list: list):
+    # a flag is set by its presence (`?lossless`), `lossless=false` or `lossless=0` unsets it
+    if len(value_list) == 0:
+        return True
+
+    if value_list[0].lower() in (b'false', b'0'):
+        return None
+
+    return True
+
+
+# query parameter name and parser of each encoder option
+ENCODER_OPTION_PARSER_LIST = [
+    ('jpeg_quality', lambda value_list: web_parse_int_range_value(value_list, 1, 100)),
+    ('jpeg_subsampling', lambda value_list: web_parse_choice_value(value_list, list(JPEG_SUBSAMPLING_DICT.keys()))),
+    ('png_compression', lambda value_list: web_parse_int_range_value(value_list, 0, 9)),
+    ('png_strategy', lambda value_list: web_parse_choice_value(value_list, list(PNG_STRATEGY_DICT.keys()))),
+    ('webp_quality', lambda value_list: web_parse_int_range_value(value_list, 1, 100)),
+    ('webp_method', lambda value_list: web_parse_int_range_value(value_list, 0, 6)),
+    ('lossless', lambda value_list: web_parse_flag_value(value_list)),
+]
+
+
+def web_parse_encoder_options(
+    params: dict,
+    encoder_options: tuple = (),
+):
+    encoder_option_dict = dict(encoder_options)
+    for option_name, parse_function in ENCODER_OPTION_PARSER_LIST:
+        if option_name not in params:
+            continue
+
+        retval = parse_function(params[option_name])
+        if retval is None:
+            encoder_option_dict.pop(option_name, None)
+        else:
+            encoder_option_dict[option_name] = retval
+
+    return tuple(sorted(encoder_option_dict.items()))
+
+
+########################################################################
+DEFAULT_FRAME_RATE = 32
+MAX_FRAME_RATE = 128
+
+DEFAULT_IMAGE_FORMAT = 'png'
+DEFAULT_STREAM_MODE = STREAM_MODE_FULL
+
+DEFAULT_IDLE_FRAME_RATE = 2
+DEFAULT_IDLE_AFTER_SECONDS = 1.0
+DEFAULT_KEEPALIVE_INTERVAL_SECONDS = 5.0
+DEFAULT_ENCODER_WORKER_COUNT = os.cpu_count() or 1
+MAX_MONITOR_INDEX = 16
+MIN_REPLAY_SPEED = 0.1
+MAX_REPLAY_SPEED = 64.0
+
+########################################################################
+### SHARED FRAME RING ##################################################
+# the screen is grabbed by a capture process which writes the raw BGRA frames into shared memory
+# the server processes encode from numpy views of the ring slots, the pixels are never copied between processes
+# the capture process only writes a frame when the screen changed, a slot is never written while it is the latest one
+#
+# layout: header, monitor table, slot table, slot data
+# a slot is written as: begin sequence number, pixels, end sequence number, then the latest sequence number of the header
+# a reader checks the end sequence number before using a slot and the begin sequence number after it is done
+# if the begin sequence number changed in between, the slot was overwritten while it was being read
+
+FRAME_RING_MAGIC = b'RDFRAME1'
+# magic, slot count, monitor count, slot size in bytes
+FRAME_RING_HEADER_STRUCT = struct.Struct('<8sIIQ')
+FRAME_RING_LATEST_SEQUENCE_OFFSET = 24
+FRAME_RING_LAST_READ_TIME_OFFSET = 32
+FRAME_RING_MONITOR_TABLE_OFFSET = 64
+# left, top, width, height
+FRAME_RING_MONITOR_STRUCT = struct.Struct('<iiii')
+FRAME_RING_MAX_MONITOR_COUNT = MAX_MONITOR_INDEX + 1
+# begin sequence number, capture timestamp, end sequence number
+FRAME_RING_SLOT_STRUCT = struct.Struct('<QdQ')
+FRAME_RING_ALIGNMENT = 64
+SEQUENCE_NUMBER_STRUCT = struct.Struct('<Q')
+TIMESTAMP_STRUCT = struct.Struct('<d')
+
+DEFAULT_FRAME_RING_SLOT_COUNT = 4
+DEFAULT_CAPTURE_FRAME_RATE = DEFAULT_FRAME_RATE
+# the capture process drops to the idle rate when no server process has read a frame for this long
+FRAME_RING_READER_TIMEOUT_SECONDS = 2.0
+FRAME_RING_WAIT_SECONDS = 2.0
+
+
+def align_to(
+    value: int,
+    alignment: int,
+):
+    return (value + alignment - 1) // alignment * alignment
+
+
+class SharedFrameRing:
+    def __init__(self, shared_memory: multiprocessing.shared_memory.SharedMemory):
+        self.shared_memory = shared_memory
+        self.name = shared_memory.name
+        buffer = shared_memory.buf
+
+        magic, self.slot_count, monitor_count, self.slot_size = FRAME_RING_HEADER_STRUCT.unpack_from(buffer, 0)
+        if magic != FRAME_RING_MAGIC:
+            raise Exception(f'not a frame ring: {self.name}')
+
+        self.monitor_list = []
+        for monitor_index in range(monitor_count):
+            left, top, width, height = FRAME_RING_MONITOR_STRUCT.unpack_from(
+                buffer,
+                FRAME_RING_MONITOR_TABLE_OFFSET + monitor_index * FRAME_RING_MONITOR_STRUCT.size,
+            )
+            self.monitor_list.append({
+                'left': left,
+                'top': top,
+                'width': width,
+                'height': height,
+            })
+
+        # every slot holds a grab of the whole virtual screen, monitor 0
+        virtual_screen = self.monitor_list[0]
+        self.frame_shape = (virtual_screen['height'], virtual_screen['width'], 4)
+
+        self.slot_table_offset = FRAME_RING_MONITOR_TABLE_OFFSET + FRAME_RING_MAX_MONITOR_COUNT * FRAME_RING_MONITOR_STRUCT.size
+        slot_data_offset = align_to(self.slot_table_offset + self.slot_count * FRAME_RING_SLOT_STRUCT.size, FRAME_RING_ALIGNMENT)
+        self.slot_image_list = []
+        for slot_index in range(self.slot_count):
+            self.slot_image_list.append(np.ndarray(
+                self.frame_shape,
+                dtype=np.uint8,
+                buffer=buffer,
+                offset=slot_data_offset + slot_index * self.slot_size,
+            ))
+
+    def close(self):
+        # the numpy views keep the shared memory buffer exported, drop them first
+        self.slot_image_list = []
+        self.shared_memory.close()
+
+    def unlink(self):
+        self.shared_memory.unlink()
+
+    def get_monitor_list(self):
+        return self.monitor_list
+
+    def get_slot_offset(self, sequence_number: int):
+        return self.slot_table_offset + (sequence_number % self.slot_count) * FRAME_RING_SLOT_STRUCT.size
+
+    def get_latest_sequence_number(self):
+        return SEQUENCE_NUMBER_STRUCT.unpack_from(self.shared_memory.buf, FRAME_RING_LATEST_SEQUENCE_OFFSET)[0]
+
+    def get_last_read_time(self):
+        return TIMESTAMP_STRUCT.unpack_from(self.shared_memory.buf, FRAME_RING_LAST_READ_TIME_OFFSET)[0]
+
+    def write(
+        self,
+        bgra_image: np.ndarray,
+        capture_timestamp: float,
+    ):
+        # only called from the capture process
+        buffer = self.shared_memory.buf
+        sequence_number = self.get_latest_sequence_number() + 1
+        slot_offset = self.get_slot_offset(sequence_number)
+
+        FRAME_RING_SLOT_STRUCT.pack_into(buffer, slot_offset, sequence_number, capture_timestamp, 0)
+        np.copyto(self.slot_image_list[sequence_number % self.slot_count], bgra_image)
+        FRAME_RING_SLOT_STRUCT.pack_into(buffer, slot_offset, sequence_number, capture_timestamp, sequence_number)
+        SEQUENCE_NUMBER_STRUCT.pack_into(buffer, FRAME_RING_LATEST_SEQUENCE_OFFSET, sequence_number)
+        return sequence_number
+
+    def read_latest(self):
+        # returns (sequence number, capture timestamp, view of the slot)
+        # the view is only valid while is_intact(sequence number) is true
+        buffer = self.shared_memory.buf
+        TIMESTAMP_STRUCT.pack_into(buffer, FRAME_RING_LAST_READ_TIME_OFFSET, time.time())
+
+        deadline = time.perf_counter() + FRAME_RING_WAIT_SECONDS
+        while True:
+            sequence_number = self.get_latest_sequence_number()
+            if sequence_number > 0:
+                _, capture_timestamp, end_sequence_number = FRAME_RING_SLOT_STRUCT.unpack_from(
+                    buffer,
+                    self.get_slot_offset(sequence_number),
+                )
+                if end_sequence_number == sequence_number:
+                    return sequence_number, capture_timestamp, self.slot_image_list[sequence_number % self.slot_count]
+
+            if time.perf_counter() > deadline:
+                raise Exception(f'no frame from the capture process in {FRAME_RING_WAIT_SECONDS} seconds')
+            time.sleep(0.01)
+
+    def is_intact(self, sequence_number: int):
+        begin_sequence_number, _, _ = FRAME_RING_SLOT_STRUCT.unpack_from(
+            self.shared_memory.buf,
+            self.get_slot_offset(sequence_number),
+        )
+        return begin_sequence_number == sequence_number
+
+
+def create_shared_frame_ring(
+    monitor_list: list,
+    slot_count: int = DEFAULT_FRAME_RING_SLOT_COUNT,
+):
+    monitor_list = monitor_list[:FRAME_RING_MAX_MONITOR_COUNT]
+    virtual_screen = monitor_list[0]
+    slot_size = align_to(virtual_screen['width'] * virtual_screen['height'] * 4, FRAME_RING_ALIGNMENT)
+    slot_table_offset = FRAME_RING_MONITOR_TABLE_OFFSET + FRAME_RING_MAX_MONITOR_COUNT * FRAME_RING_MONITOR_STRUCT.size
+    slot_data_offset = align_to(slot_table_offset + slot_count * FRAME_RING_SLOT_STRUCT.size, FRAME_RING_ALIGNMENT)
+
+    shared_memory = multiprocessing.shared_memory.SharedMemory(
+        create=True,
+        size=slot_data_offset + slot_count * slot_size,
+    )
+    # new shared memory is zero filled, the latest sequence number 0 means no frame yet
+    FRAME_RING_HEADER_STRUCT.pack_into(shared_memory.buf, 0, FRAME_RING_MAGIC, slot_count, len(monitor_list), slot_size)
+    for monitor_index, monitor in enumerate(monitor_list):
+        FRAME_RING_MONITOR_STRUCT.pack_into(
+            shared_memory.buf,
+            FRAME_RING_MONITOR_TABLE_OFFSET + monitor_index * FRAME_RING_MONITOR_STRUCT.size,
+            monitor['left'],
+            monitor['top'],
+            monitor['width'],
+            monitor['height'],
+        )
+
+    print(f'SharedFrameRing: {shared_memory.name} {slot_count} slots of {virtual_screen["width"]}x{virtual_screen["height"]}, {shared_memory.size / (1024 ** 2):.1f} MB')
+    return SharedFrameRing(shared_memory)
+
+
+def open_shared_frame_ring(name: str):
+    return SharedFrameRing(multiprocessing.shared_memory.SharedMemory(name=name))
+
+
+def is_parent_process_alive():
+    parent_process = multiprocessing.parent_process()
+    return (parent_process is None) or parent_process.is_alive()
+
+
+def run_capture_process(
+    frame_ring_name: str,
+    frame_rate: int,
+    idle_frame_rate: int,
+):
+    # entry point of the capture process
+    frame_ring = open_shared_frame_ring(frame_ring_name)
+    frame_grabber = FrameGrabber()
+    virtual_screen = frame_ring.get_monitor_list()[0]
+    print(f'capture process: {os.getpid()} {frame_rate} fps')
+
+    next_frame_deadline = time.perf_counter()
+    try:
+        while is_parent_process_alive():
+            # grab at the full rate only while a server process is reading the frames
+            if (time.time() - frame_ring.get_last_read_time()) < FRAME_RING_READER_TIMEOUT_SECONDS:
+                frame_interval = 1.0 / frame_rate
+            else:
+                frame_interval = 1.0 / idle_frame_rate
+
+            capture_timestamp = time.time()
+            np_image, _ = frame_grabber.grab(virtual_screen)
+            if frame_grabber.frame_changed:
+                frame_ring.write(np_image, capture_timestamp)
+
+            next_frame_deadline += frame_interval
+            remaining_seconds = next_frame_deadline - time.perf_counter()
+            if remaining_seconds > 0:
+                time.sleep(remaining_seconds)
+            else:
+                next_frame_deadline = time.perf_counter()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        frame_grabber.close()
+        frame_ring.close()
+
+
+### END SHARED FRAME RING ##############################################
+########################################################################
+### SHARED IMAGE STREAM PRODUCER #######################################
+# capture the screen once per frame interval and encode once per distinct stream settings
+# no matter how many viewers are watching
+
+ImageStreamKey = collections.namedtuple(
+    'ImageStreamKey',
+    [
+        'image_format',
+        'scaling_factor',
+        # the rendition width in pixels, scaling_factor is applied on top of it
+        'target_width',
+        'render_mouse_cursor',
+        'stream_mode',
+        'image_quality',
+        # tuple of (name, value) pairs, see ENCODER_OPTION_PARSER_LIST
+        'encoder_options',
+        # index in sct.monitors, None for the primary monitor
+        'monitor_index',
+        # (x, y, width, height) relative to the monitor, None for the whole monitor
+        'capture_region',
+    ],
+)
+
+
+class ImageStreamFrame:
+    def __init__(
+        self,
+        image_bytes: bytes,
+        sequence_number: int,
+        capture_timestamp: float,
+        frame_width: int,
+        frame_height: int,
+        image_format: str,
+        tile_width: int = None,
+        tile_height: int = None,
+        tile_version_grid: np.ndarray = None,
+        tile_list: list = None,
+        stage_duration_dict: dict = None,
+    ):
+        # image_bytes is None for tile frames
+        self.image_bytes = image_bytes
+        self.sequence_number = sequence_number
+        self.capture_timestamp = capture_timestamp
+        self.frame_width = frame_width
+        self.frame_height = frame_height
+        self.image_format = image_format
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.tile_version_grid = tile_version_grid
+        self.tile_list = tile_list
+        # stage -> seconds spent producing this frame, see FrameGrabber.observe_stage
+        self.stage_duration_dict = stage_duration_dict
+
+
+class ImageStreamSubscriber:
+    def __init__(
+        self,
+        stream_key: ImageStreamKey,
+        frame_rate: int,
+    ):
+        self.stream_key = stream_key
+        self.frame_rate = frame_rate
+        self.latest_frame = None
+        self.new_frame_event = tornado.locks.Event()
+        self.next_frame_deadline = time.perf_counter()
+        self.last_publish_time = self.next_frame_deadline
+        # frames replaced before the viewer took them
+        self.dropped_frame_count = 0
+        self.closed = False
+
+    def is_frame_due(
+        self,
+        now: float,
+        producer_frame_interval: float,
+    ):
+        # accept a frame up to half a producer interval early
+        # so the phase of the two clocks does not make us skip every other frame
+        return now >= (self.next_frame_deadline - (producer_frame_interval / 2))
+
+    def publish(
+        self,
+        frame: ImageStreamFrame,
+        now: float,
+    ):
+        frame_interval = 1.0 / self.frame_rate
+        # do not try to catch up with a burst of frames after a stall
+        self.next_frame_deadline = max(self.next_frame_deadline + frame_interval, now - frame_interval)
+        self.last_publish_time = now
+        if self.new_frame_event.is_set() and (self.latest_frame is not frame):
+            # the viewer is still sending an older frame, this one replaces the one it has not taken yet
+            METRICS.increment(METRIC_FRAMES_DROPPED, reason='viewer')
+            self.dropped_frame_count += 1
+        self.latest_frame = frame
+        self.new_frame_event.set()
+
+    def close(self):
+        self.closed = True
+        self.new_frame_event.set()
+
+    async def wait_for_frame(self):
+        await self.new_frame_event.wait()
+        self.new_frame_event.clear()
+        if self.closed:
+            return None
+
+        return self.latest_frame
+
+
+class ImageStreamProducer:
+    def __init__(self):
+        self.subscriber_list = []
+        self.running = False
+        self.sequence_number = 0
+        # only used from the capture executor thread
+        self.frame_grabber = FrameGrabber()
+        self.tile_stream_state_dict = {}
+        self.encoder_worker_count = DEFAULT_ENCODER_WORKER_COUNT
+        self.encoder_executor = None
+        self.previous_mouse_position = None
+        # written by the capture executor thread, read by the subscribers
+        self.latest_frame_dict = {}
+
+        # static screen detection
+        self.idle_frame_rate = DEFAULT_IDLE_FRAME_RATE
+        self.idle_after_seconds = DEFAULT_IDLE_AFTER_SECONDS
+        self.keepalive_interval_seconds = DEFAULT_KEEPALIVE_INTERVAL_SECONDS
+        self.last_change_time = time.perf_counter()
+
+    def subscribe(self, subscriber: ImageStreamSubscriber):
+        self.subscriber_list.append(subscriber)
+        print(f'ImageStreamProducer: {len(self.subscriber_list)} subscriber(s)')
+
+        # the screen may be static, do not make a new viewer wait for the next change
+        latest_frame = self.latest_frame_dict.get(subscriber.stream_key)
+        if latest_frame is not None:
+            subscriber.publish(latest_frame, time.perf_counter())
+
+        if not self.running:
+            self.running = True
+            tornado.ioloop.IOLoop.current().spawn_callback(self.run)
+
+    def unsubscribe(self, subscriber: ImageStreamSubscriber):
+        if subscriber in self.subscriber_list:
+            self.subscriber_list.remove(subscriber)
+        print(f'ImageStreamProducer: {len(self.subscriber_list)} subscriber(s)')
+
+    def update_subscriber(
+        self,
+        subscriber: ImageStreamSubscriber,
+        stream_key: ImageStreamKey,
+        frame_rate: int,
+    ):
+        subscriber.frame_rate = frame_rate
+        if subscriber.stream_key == stream_key:
+            return
+
+        subscriber.stream_key = stream_key
+        subscriber.latest_frame = None
+        latest_frame = self.latest_frame_dict.get(stream_key)
+        if latest_frame is not None:
+            subscriber.publish(latest_frame, time.perf_counter())
+
+    def get_encoder_executor(self):
+        if self.encoder_worker_count < 2:
+            return None
+
+        if self.encoder_executor is None:
+            self.encoder_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.encoder_worker_count,
+                thread_name_prefix='encoder',
+            )
+
+        return self.encoder_executor
+
+    def capture_and_encode(
+        self,
+        stream_key_list: list,
+        sequence_number: int,
+        capture_timestamp: float,
+    ):
+        frame_grabber = self.frame_grabber
+
+        mouse_position = None
+        mouse_moved = False
+        if any(x.render_mouse_cursor for x in stream_key_list):
+            mouse_position = get_mouse_position()
+            mouse_moved = mouse_position != self.previous_mouse_position
+            self.previous_mouse_position = mouse_position
+
+        # forget the streams which nobody is watching anymore
+        for stream_key in list(self.latest_frame_dict.keys()):
+            if stream_key not in stream_key_list:
+                del self.latest_frame_dict[stream_key]
+        for stream_key in list(self.tile_stream_state_dict.keys()):
+            if stream_key not in stream_key_list:
+                del self.tile_stream_state_dict[stream_key]
+
+        # the streams watching the same part of the screen share one grab
+        region_stream_key_dict = collections.defaultdict(list)
+        for stream_key in stream_key_list:
+            screen_region = frame_grabber.get_screen_region(stream_key.monitor_index, stream_key.capture_region)
+            region_stream_key_dict[get_screen_region_key(screen_region)].append(stream_key)
+
+        screen_changed = False
+        screen_region_list = []
+        for (left, top, width, height), region_stream_key_list in region_stream_key_dict.items():
+            screen_region = {
+                'left': left,
+                'top': top,
+                'width': width,
+                'height': height,
+            }
+            screen_region_list.append(screen_region)
+
+            np_image, screen_region = frame_grabber.grab(screen_region)
+            region_changed = frame_grabber.frame_changed
+            if frame_grabber.frame_ring is not None:
+                # when the capture process grabbed the frame, not when it was read
+                capture_timestamp = frame_grabber.frame_ring_capture_timestamp
+            if mouse_moved and any(x.render_mouse_cursor for x in region_stream_key_list):
+                region_changed = True
+
+            if region_changed:
+                screen_changed = True
+            else:
+                # nothing to encode except for the streams which have not produced any frame yet
+                region_stream_key_list = [x for x in region_stream_key_list if x not in self.latest_frame_dict]
+
+            frame_dict = self.encode_stream_frames(
+                np_image,
+                screen_region,
+                region_stream_key_list,
+                mouse_position,
+                sequence_number,
+                capture_timestamp,
+            )
+            if not frame_grabber.is_grabbed_frame_intact(screen_region):
+                METRICS.increment(METRIC_FRAMES_DROPPED, reason='overwritten')
+                continue
+            self.latest_frame_dict.update(frame_dict)
+
+        frame_grabber.forget_screen_regions(screen_region_list)
+        return screen_changed
+
+    def get_rendition(
+        self,
+        rendition_dict: dict,
+        source_image: np.ndarray,
+        stream_key: ImageStreamKey,
+    ):
+        image_height, image_width = source_image.shape[:2]
+        rendition_size = get_rendition_size(
+            image_width,
+            image_height,
+            scaling_factor=stream_key.scaling_factor,
+            target_width=stream_key.target_width,
+        )
+        rendition_key = (stream_key.render_mouse_cursor, rendition_size)
+        rendition_image = rendition_dict.get(rendition_key)
+        if rendition_image is not None:
+            return rendition_image
+
+        # walk down the pyramid, shrink from the smallest rendition of this frame which is still larger
+        # so that the 1/4 level is computed from the 1/2 level instead of the full frame
+        parent_image = source_image
+        for (render_mouse_cursor, (width, height)), image in rendition_dict.items():
+            if render_mouse_cursor != stream_key.render_mouse_cursor:
+                continue
+            if (width < rendition_size[0]) or (height < rendition_size[1]):
+                continue
+            if width < parent_image.shape[1]:
+                parent_image = image
+
+        if stream_key.render_mouse_cursor:
+            buffer_name = 'rendition_cursor'
+        else:
+            buffer_name = 'rendition'
+
+        rendition_image = self.frame_grabber.resize_to(
+            parent_image,
+            rendition_size[0],
+            rendition_size[1],
+            buffer_name=buffer_name,
+        )
+        rendition_dict[rendition_key] = rendition_image
+        return rendition_image
+
+    def encode_stream_frames(
+        self,
+        np_image: np.ndarray,
+        screen_region: dict,
+        stream_key_list: list,
+        mouse_position: tuple,
+        sequence_number: int,
+        capture_timestamp: float,
+    ):
+        frame_grabber = self.frame_grabber
+        cursor_image = None
+        for stream_key in stream_key_list:
+            if stream_key.render_mouse_cursor:
+                # the grabbed image is kept for change detection so the cursor is drawn on a copy
+                start_time = time.perf_counter()
+                cursor_image = frame_grabber.copy_to_buffer('cursor', np_image)
+                merge_cursor(
+                    cursor_image,
+                    mouse_position,
+                    monitor_region=screen_region,
+                )
+                frame_grabber.observe_stage(STAGE_CURSOR, start_time)
+                break
+
+        # every rendition size is resized once per frame and shared by all the streams using it
+        rendition_dict = {}
+        frame_dict = {}
+        # the grab and the cursor are shared, a resize is counted by the first stream using the rendition
+        shared_stage_duration_dict = frame_grabber.stage_duration_dict
+        for stream_key in stream_key_list:
+            frame_grabber.stage_duration_dict = dict(shared_stage_duration_dict)
+            if stream_key.render_mouse_cursor:
+                source_image = cursor_image
+            else:
+                source_image = np_image
+
+            rendition_image = self.get_rendition(
+                rendition_dict,
+                source_image,
+                stream_key,
+            )
+
+            if stream_key.stream_mode in (STREAM_MODE_TILES, STREAM_MODE_STRIPES):
+                bgr_image = frame_grabber.convert_to_bgr(rendition_image)
+
+                if stream_key.stream_mode == STREAM_MODE_STRIPES:
+                    tile_width = bgr_image.shape[1]
+                    tile_height = get_stripe_height(bgr_image.shape[0], self.encoder_worker_count)
+                else:
+                    tile_width = DEFAULT_TILE_SIZE
+                    tile_height = DEFAULT_TILE_SIZE
+
+                tile_stream_state = self.tile_stream_state_dict.get(stream_key)
+                if (tile_stream_state is None) or (tile_stream_state.tile_width != tile_width) or (tile_stream_state.tile_height != tile_height):
+                    tile_stream_state = TileStreamState(tile_width, tile_height)
+                    self.tile_stream_state_dict[stream_key] = tile_stream_state
+
+                tile_stream_state.update(
+                    bgr_image,
+                    stream_key.image_format,
+                    sequence_number,
+                    image_quality=stream_key.image_quality,
+                    encoder_options=stream_key.encoder_options,
+                    encoder_executor=self.get_encoder_executor(),
+                )
+                frame_grabber.stage_duration_dict[STAGE_ENCODE] = tile_stream_state.encode_duration_seconds
+
+                frame_dict[stream_key] = ImageStreamFrame(
+                    image_bytes=None,
+                    sequence_number=sequence_number,
+                    capture_timestamp=capture_timestamp,
+                    frame_width=bgr_image.shape[1],
+                    frame_height=bgr_image.shape[0],
+                    image_format=stream_key.image_format,
+                    tile_width=tile_stream_state.tile_width,
+                    tile_height=tile_stream_state.tile_height,
+                    # snapshot for the subscribers, the state keeps changing on the capture thread
+                    tile_version_grid=tile_stream_state.tile_version_grid.copy(),
+                    tile_list=list(tile_stream_state.tile_list),
+                    stage_duration_dict=frame_grabber.stage_duration_dict,
+                )
+                continue
+
+            bs = frame_grabber.encode(
+                rendition_image,
+                image_format=stream_key.image_format,
+                image_quality=stream_key.image_quality,
+                encoder_options=stream_key.encoder_options,
+            )
+
+            if bs is None:
+                continue
+
+            frame_height, frame_width = rendition_image.shape[:2]
+            frame_dict[stream_key] = ImageStreamFrame(
+                image_bytes=bs,
+                sequence_number=sequence_number,
+                capture_timestamp=capture_timestamp,
+                frame_width=frame_width,
+                frame_height=frame_height,
+                image_format=stream_key.image_format,
+                stage_duration_dict=frame_grabber.stage_duration_dict,
+            )
+
+        return frame_dict
+
+    async def run(self):
+        io_loop = tornado.ioloop.IOLoop.current()
+        next_frame_deadline = time.perf_counter()
+        try:
+            while len(self.subscriber_list) > 0:
+                frame_rate = max(x.frame_rate for x in self.subscriber_list)
+                frame_interval = 1.0 / frame_rate
+                stream_key_list = list(set(x.stream_key for x in self.subscriber_list))
+
+                self.sequence_number += 1
+                capture_timestamp = time.time()
+                try:
+                    screen_changed = await io_loop.run_in_executor(
+                        CAPTURE_EXECUTOR,
+                        self.capture_and_encode,
+                        stream_key_list,
+                        self.sequence_number,
+                        capture_timestamp,
+                    )
+                except Exception as ex:
+                    print(ex)
+                    print(traceback.format_exc())
+                    screen_changed = False
+
+                now = time.perf_counter()
+                if screen_changed:
+                    self.last_change_time = now
+
+                for subscriber in list(self.subscriber_list):
+                    frame = self.latest_frame_dict.get(subscriber.stream_key)
+                    if frame is None:
+                        continue
+                    if frame is subscriber.latest_frame:
+                        # send the same frame again now and then so that the viewer knows the stream is alive
+                        if (now - subscriber.last_publish_time) < self.keepalive_interval_seconds:
+                            continue
+                    elif not subscriber.is_frame_due(now, frame_interval):
+                        continue
+                    subscriber.publish(frame, now)
+
+                # slow down while the screen is static and go back to full rate on the first change
+                if (now - self.last_change_time) > self.idle_after_seconds:
+                    frame_interval = max(frame_interval, 1.0 / self.idle_frame_rate)
+
+                # deadline based pacing so that the capture and encode time is not added on top of the frame interval
+                next_frame_deadline += frame_interval
+                remaining_seconds = next_frame_deadline - time.perf_counter()
+                if remaining_seconds > 0:
+                    await tornado.gen.sleep(remaining_seconds)
+                else:
+                    # we are running behind, drop the missed frames instead of bursting
+                    missed_frame_count = int(-remaining_seconds / frame_interval)
+                    if missed_frame_count > 0:
+                        METRICS.increment(METRIC_FRAMES_DROPPED, missed_frame_count, reason='capture')
+                    next_frame_deadline = time.perf_counter()
+        finally:
+            self.running = False
+
+
+# mss and the encoders are blocking
+# a single worker also keeps the capture on one thread
+CAPTURE_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=1,
+    thread_name_prefix='capture',
+)
+IMAGE_STREAM_PRODUCER = ImageStreamProducer()
+METRICS.set_gauge_function(
+    METRIC_ACTIVE_STREAMS,
+    lambda: [({}, len(IMAGE_STREAM_PRODUCER.subscriber_list))],
+)
+METRICS.set_gauge_function(
+    METRIC_ACTIVE_ENCODINGS,
+    lambda: [({}, len(set(x.stream_key for x in IMAGE_STREAM_PRODUCER.subscriber_list)))],
+)
+
+### END SHARED IMAGE STREAM PRODUCER ###################################
+########################################################################
+
+
+def parse_image_stream_arguments(
+    params: dict,
+    stream_key: ImageStreamKey = None,
+    frame_rate: int = None,
+):
+    # start from the current settings when a stream changes its parameters
+    if stream_key is None:
+        scaling_factor = None
+        target_width = None
+        render_mouse_cursor = False
+        image_format = DEFAULT_IMAGE_FORMAT
+        stream_mode = DEFAULT_STREAM_MODE
+        image_quality = None
+        encoder_options = ()
+        monitor_index = None
+        capture_region = None
+    else:
+        scaling_factor = stream_key.scaling_factor
+        target_width = stream_key.target_width
+        render_mouse_cursor = stream_key.render_mouse_cursor
+        image_format = stream_key.image_format
+        stream_mode = stream_key.stream_mode
+        image_quality = stream_key.image_quality
+        encoder_options = stream_key.encoder_options
+        monitor_index = stream_key.monitor_index
+        capture_region = stream_key.capture_region
+
+    if frame_rate is None:
+        frame_rate = DEFAULT_FRAME_RATE
+
+    if 'scaling' in params:
+        scaling_value_list = params['scaling']
+        scaling_factor = web_parse_scaling_value(scaling_value_list)
+    if 'width' in params:
+        target_width = web_parse_positive_int_value(params['width'])
+    if 'cursor' in params:
+        # the viewer draws the cursor from /cursor/ws with cursor=overlay
+        render_mouse_cursor = (params['cursor'][:1] != [CURSOR_OVERLAY_VALUE])
+    if 'format' in params:
+        image_format_value_list = params['format']
+        retval = web_parse_image_format_value(image_format_value_list)
+        if retval is not None:
+            image_format = retval
+    if 'mode' in params:
+        stream_mode_value_list = params['mode']
+        retval = web_parse_stream_mode_value(stream_mode_value_list)
+        if retval is not None:
+            stream_mode = retval
+    if 'quality' in params:
+        image_quality_value_list = params['quality']
+        image_quality = web_parse_quality_value(image_quality_value_list)
+    encoder_options = web_parse_encoder_options(params, encoder_options)
+    if 'monitor' in params:
+        monitor_index = web_parse_int_range_value(params['monitor'], 0, MAX_MONITOR_INDEX)
+    if 'region' in params:
+        capture_region = web_parse_region_value(params['region'])
+
+    frame_rate_key_list = ['fps', 'framerate', 'frame_rate']
+    for frame_rate_key in frame_rate_key_list:
+        if frame_rate_key in params:
+            frame_rate_value_list = params[frame_rate_key]
+            retval = web_parse_frame_rate_value(frame_rate_value_list)
+            if retval is not None:
+                frame_rate = retval
+                break
+
+    if frame_rate > MAX_FRAME_RATE:
+        frame_rate = DEFAULT_FRAME_RATE
+    if frame_rate == 0:
+        frame_rate = DEFAULT_FRAME_RATE
+
+    stream_key = ImageStreamKey(
+        image_format=image_format,
+        scaling_factor=scaling_factor,
+        target_width=target_width,
+        render_mouse_cursor=render_mouse_cursor,
+        stream_mode=stream_mode,
+        image_quality=image_quality,
+        encoder_options=encoder_options,
+        monitor_index=monitor_index,
+        capture_region=capture_region,
+    )
+
+    return stream_key, frame_rate
+
+
+########################################################################
+### ADAPTIVE QUALITY CONTROL ###########################################
+# per viewer rate controller, enabled with the `adaptive` query parameter
+# the time it takes for a frame to be written out of tornado's buffer is used as the latency signal
+# when it is over the target the stream steps down quality, then resolution, then frame rate
+# and it steps back up in reverse order after the latency has stayed well under the target for a while
+
+DEFAULT_TARGET_LATENCY_MS = 100
+DEFAULT_MIN_IMAGE_QUALITY = 30
+DEFAULT_MAX_IMAGE_QUALITY = 90
+DEFAULT_MIN_FRAME_RATE = 4
+DEFAULT_MAX_SCALING_DIVISOR = 4
+
+ADAPTIVE_QUALITY_STEP = 10
+ADAPTIVE_SMOOTHING_FACTOR = 0.2
+# consecutive frames under half of the target latency before stepping up
+ADAPTIVE_STEP_UP_FRAME_COUNT = 30
+# frames to wait after a change so that the frames already in flight do not trigger another step
+ADAPTIVE_COOLDOWN_FRAME_COUNT = 5
+
+
+class AdaptiveQualityController:
+    def __init__(
+        self,
+        image_quality: int,
+        scaling_divisor: int,
+        frame_rate: int,
+        min_image_quality: int = DEFAULT_MIN_IMAGE_QUALITY,
+        max_image_quality: int = DEFAULT_MAX_IMAGE_QUALITY,
+        min_scaling_divisor: int = 1,
+        max_scaling_divisor: int = DEFAULT_MAX_SCALING_DIVISOR,
+        min_frame_rate: int = DEFAULT_MIN_FRAME_RATE,
+        max_frame_rate: int = DEFAULT_FRAME_RATE,
+        target_latency_seconds: float = DEFAULT_TARGET_LATENCY_MS / 1000,
+    ):
+        self.min_image_quality = min(min_image_quality, max_image_quality)
+        self.max_image_quality = max_image_quality
+        self.min_scaling_divisor = min(min_scaling_divisor, max_scaling_divisor)
+        self.max_scaling_divisor = max_scaling_divisor
+        self.min_frame_rate = min(min_frame_rate, max_frame_rate)
+        self.max_frame_rate = max_frame_rate
+        self.target_latency_seconds = target_latency_seconds
+
+        self.image_quality = min(max(image_quality, self.min_image_quality), self.max_image_quality)
+        self.scaling_divisor = min(max(scaling_divisor, self.min_scaling_divisor), self.max_scaling_divisor)
+        self.frame_rate = min(max(frame_rate, self.min_frame_rate), self.max_frame_rate)
+
+        # smoothed measurements
+        self.latency_seconds = None
+        self.throughput = None
+
+        self.good_frame_count = 0
+        self.cooldown_frame_count = 0
+
+    def step_down(self):
+        if self.image_quality > self.min_image_quality:
+            self.image_quality = max(self.min_image_quality, self.image_quality - ADAPTIVE_QUALITY_STEP)
+            return True
+
+        if self.scaling_divisor < self.max_scaling_divisor:
+            self.scaling_divisor += 1
+            return True
+
+        if self.frame_rate > self.min_frame_rate:
+            self.frame_rate = max(self.min_frame_rate, (self.frame_rate * 3) // 4)
+            return True
+
+        return False
+
+    def step_up(self):
+        if self.frame_rate < self.max_frame_rate:
+            self.frame_rate = min(self.max_frame_rate, int(math.ceil(self.frame_rate * 4 / 3)))
+            return True
+
+        if self.scaling_divisor > self.min_scaling_divisor:
+            self.scaling_divisor -= 1
+            return True
+
+        if self.image_quality < self.max_image_quality:
+            self.image_quality = min(self.max_image_quality, self.image_quality + ADAPTIVE_QUALITY_STEP)
+            return True
+
+        return False
+
+    def on_frame_sent(
+        self,
+        number_of_bytes: int,
+        send_duration_seconds: float,
+    ):
+        # returns True when the stream settings changed
+        throughput = number_of_bytes / max(send_duration_seconds, 1e-6)
+        if self.latency_seconds is None:
+            self.latency_seconds = send_duration_seconds
+            self.throughput = throughput
+        else:
+            self.latency_seconds += ADAPTIVE_SMOOTHING_FACTOR * (send_duration_seconds - self.latency_seconds)
+            self.throughput += ADAPTIVE_SMOOTHING_FACTOR * (throughput - self.throughput)
+
+        if self.cooldown_frame_count > 0:
+            self.cooldown_frame_count -= 1
+            return False
+
+        changed = False
+        if self.latency_seconds > self.target_latency_seconds:
+            self.good_frame_count = 0
+            changed = self.step_down()
+        elif self.latency_seconds < (self.target_latency_seconds / 2):
+            self.good_frame_count += 1
+            if self.good_frame_count >= ADAPTIVE_STEP_UP_FRAME_COUNT:
+                self.good_frame_count = 0
+                changed = self.step_up()
+        else:
+            self.good_frame_count = 0
+
+        if changed:
+            self.cooldown_frame_count = ADAPTIVE_COOLDOWN_FRAME_COUNT
+
+        return changed
+
+    def get_stream_key(self, stream_key: ImageStreamKey):
+        if self.scaling_divisor == 1:
+            scaling_factor = None
+        else:
+            scaling_factor = 1 / self.scaling_divisor
+
+        return stream_key._replace(
+            image_quality=self.image_quality,
+            scaling_factor=scaling_factor,
+        )
+
+    def get_status_dict(self):
+        return {
+            'quality': self.image_quality,
+            'scaling': self.scaling_divisor,
+            'fps': self.frame_rate,
+            'latency_ms': round((self.latency_seconds or 0) * 1000, 1),
+            'throughput': int(self.throughput or 0),
+        }
+
+    def get_header_list(self):
+        status_dict = self.get_status_dict()
+        return [
+            ('X-Stream-Quality', status_dict['quality']),
+            ('X-Stream-Scaling', status_dict['scaling']),
+            ('X-Stream-Frame-Rate', status_dict['fps']),
+            ('X-Stream-Latency-Ms', status_dict['latency_ms']),
+            ('X-Stream-Throughput', status_dict['throughput']),
+        ]
+
+
+def create_adaptive_quality_controller(
+    params: dict,
+    stream_key: ImageStreamKey,
+    frame_rate: int,
+):
+    if 'adaptive' not in params:
+        return None
+
+    def parse_bound(name: str, default_value: int):
+        retval = web_parse_positive_int_value(params.get(name, []))
+        if retval is None:
+            return default_value
+        return retval
+
+    max_image_quality = min(parse_bound('max_quality', DEFAULT_MAX_IMAGE_QUALITY), MAX_IMAGE_QUALITY)
+    if stream_key.scaling_factor is None:
+        scaling_divisor = 1
+    else:
+        scaling_divisor = int(round(1 / stream_key.scaling_factor))
+
+    return AdaptiveQualityController(
+        image_quality=stream_key.image_quality or max_image_quality,
+        scaling_divisor=scaling_divisor,
+        frame_rate=frame_rate,
+        min_image_quality=parse_bound('min_quality', DEFAULT_MIN_IMAGE_QUALITY),
+        max_image_quality=max_image_quality,
+        min_scaling_divisor=parse_bound('min_scaling', 1),
+        max_scaling_divisor=parse_bound('max_scaling', DEFAULT_MAX_SCALING_DIVISOR),
+        min_frame_rate=parse_bound('min_fps', DEFAULT_MIN_FRAME_RATE),
+        max_frame_rate=min(parse_bound('max_fps', frame_rate), MAX_FRAME_RATE),
+        target_latency_seconds=parse_bound('target_latency', DEFAULT_TARGET_LATENCY_MS) / 1000,
+    )
+
+
+### END ADAPTIVE QUALITY CONTROL #######################################
+########################################################################
+
+
+def get_changed_tile_index_list(
+    frame: ImageStreamFrame,
+    sent_tile_version_grid: np.ndarray = None,
+):
+    # every tile which changed since the last frame this viewer received
+    # and everything on the first frame or after the frame size changed
+    if (sent_tile_version_grid is None) or (sent_tile_version_grid.shape != frame.tile_version_grid.shape):
+        return np.flatnonzero(frame.tile_version_grid)
+
+    return np.flatnonzero(frame.tile_version_grid != sent_tile_version_grid)
+
+
+def get_tile_position(
+    frame: ImageStreamFrame,
+    tile_index: int,
+):
+    grid_width = frame.tile_version_grid.shape[1]
+    tile_y, tile_x = divmod(tile_index, grid_width)
+    return tile_x * frame.tile_width, tile_y * frame.tile_height
+
+
+class ImageStreamHandler(tornado.web.RequestHandler):
+    async def get(self):
+        params = self.request.query_arguments
+        print(f'ImageStreamHandler: params: {params}')
+
+        stream_key, frame_rate = parse_image_stream_arguments(params)
+
+        self.adaptive_quality_controller = create_adaptive_quality_controller(params, stream_key, frame_rate)
+        if self.adaptive_quality_controller is not None:
+            stream_key = self.adaptive_quality_controller.get_stream_key(stream_key)
+            frame_rate = self.adaptive_quality_controller.frame_rate
+
+        self.image_content_type_header = f'Content-Type: image/{stream_key.image_format}\r\n'
+
+        self.set_header('Content-Type', 'multipart/x-mixed-replace;boundary=--frame')
+
+        subscriber = ImageStreamSubscriber(
+            stream_key=stream_key,
+            frame_rate=frame_rate,
+        )
+
+        self.subscriber = subscriber
+        self.last_frame = None
+        self.sent_tile_version_grid = None
+        viewer_id = next(VIEWER_ID_COUNTER)
+        remote_ip = self.request.remote_ip
+        IMAGE_STREAM_PRODUCER.subscribe(subscriber)
+        try:
+            while True:
+                # check if connection is still alive
+                if self.request.connection.stream.closed():
+                    print('connection closed')
+                    break
+
+                frame = await subscriber.wait_for_frame()
+                if frame is None:
+                    print('connection closed')
+                    break
+
+                self.written_bytes = 0
+                if frame.tile_version_grid is not None:
+                    if not self.write_changed_tile_parts(frame):
+                        if frame is not self.last_frame:
+                            continue
+                        # keep-alive for a static screen, send the first tile again
+                        self.write_tile_part(frame, 0)
+                else:
+                    self.write_image_part(
+                        frame.image_bytes,
+                        extra_header_list=self.get_frame_header_list(frame),
+                    )
+
+                self.last_frame = frame
+
+                send_start_time = time.perf_counter()
+                try:
+                    # frames published while the previous one is still being sent are skipped
+                    await self.flush()
+                except tornado.iostream.StreamClosedError:
+                    print('connection closed')
+                    break
+
+                send_duration_seconds = time.perf_counter() - send_start_time
+                record_frame_sent('multipart', viewer_id, remote_ip, self.written_bytes, send_duration_seconds)
+                if self.adaptive_quality_controller is not None:
+                    self.update_adaptive_quality(send_duration_seconds)
+        finally:
+            IMAGE_STREAM_PRODUCER.unsubscribe(subscriber)
+            remove_viewer_metrics('multipart', viewer_id, remote_ip)
+
+    def update_adaptive_quality(
+        self,
+        send_duration_seconds: float,
+    ):
+        controller = self.adaptive_quality_controller
+        if not controller.on_frame_sent(self.written_bytes, send_duration_seconds):
+            return
+
+        stream_key = controller.get_stream_key(self.subscriber.stream_key)
+        if stream_key != self.subscriber.stream_key:
+            # tiles of a different stream key have unrelated versions
+            self.sent_tile_version_grid = None
+
+        IMAGE_STREAM_PRODUCER.update_subscriber(
+            self.subscriber,
+            stream_key=stream_key,
+            frame_rate=controller.frame_rate,
+        )
+
+    def get_frame_header_list(
+        self,
+        frame: ImageStreamFrame,
+    ):
+        # for measuring the latency of the stream, see the overlay of index.js
+        header_list = [
+            ('X-Sequence-Number', frame.sequence_number),
+            # seconds since the epoch on the clock of the server, see ClockHandler
+            ('X-Capture-Timestamp', f'{frame.capture_timestamp:.6f}'),
+            ('X-Send-Timestamp', f'{time.time():.6f}'),
+            ('X-Dropped-Frames', self.subscriber.dropped_frame_count),
+        ]
+
+        if frame.stage_duration_dict:
+            # same syntax as the Server-Timing header, in milliseconds
+            stage_duration_list = [f'{stage};dur={duration_seconds * 1000:.3f}' for stage, duration_seconds in frame.stage_duration_dict.items()]
+            header_list.append(('X-Stage-Durations', ', '.join(stage_duration_list)))
+
+        return header_list
+
+    def write_image_part(
+        self,
+        image_bytes: bytes,
+        extra_header_list: list = None,
+    ):
+        self.write('--frame\r\n')
+        self.write(self.image_content_type_header)
+        if extra_header_list is not None:
+            for header_name, header_value in extra_header_list:
+                self.write(f'{header_name}: {header_value}\r\n')
+
+        # make the choices of the rate controller visible to the viewer
+        if self.adaptive_quality_controller is not None:
+            for header_name, header_value in self.adaptive_quality_controller.get_header_list():
+                self.write(f'{header_name}: {header_value}\r\n')
+
+        bs_len = len(image_bytes)
+        self.write(f'Content-Length: {bs_len}\r\n\r\n')
+        self.write(image_bytes)
+        self.written_bytes += bs_len
+
+    def write_changed_tile_parts(
+        self,
+        frame: ImageStreamFrame,
+    ):
+        changed_tile_index_list = get_changed_tile_index_list(
+            frame,
+            self.sent_tile_version_grid,
+        )
+        self.sent_tile_version_grid = frame.tile_version_grid
+
+        for tile_index in changed_tile_index_list:
+            self.write_tile_part(frame, int(tile_index))
+
+        return len(changed_tile_index_list) > 0
+
+    def write_tile_part(
+        self,
+        frame: ImageStreamFrame,
+        tile_index: int,
+    ):
+        tile_x, tile_y = get_tile_position(frame, tile_index)
+        self.write_image_part(
+            frame.tile_list[tile_index],
+            extra_header_list=[
+                ('X-Frame-Width', frame.frame_width),
+                ('X-Frame-Height', frame.frame_height),
+                ('X-Tile-X', tile_x),
+                ('X-Tile-Y', tile_y),
+            ] + self.get_frame_header_list(frame),
+        )
+
+    def on_connection_close(self):
+        subscriber = getattr(self, 'subscriber', None)
+        if subscriber is not None:
+            subscriber.close()
+
+
+########################################################################
+### SCREEN HISTORY REPLAY ##############################################
+# keep the last minutes of a stream in memory and play them back from any point in time
+# the frames are immutable and shared by all the replay viewers, only the changed frames are stored
+
+DEFAULT_HISTORY_QUERY = 'format=jpg&quality=70&fps=8&cursor'
+DEFAULT_HISTORY_MINUTES = 0.0
+DEFAULT_HISTORY_MEGABYTES = 256
+DEFAULT_HISTORY_PREVIEW_WIDTH = 320
+DEFAULT_HISTORY_PREVIEW_MEGABYTES = 32
+
+
+class ScreenHistoryRing:
+    def __init__(
+        self,
+        max_seconds: float,
+        max_bytes: int,
+    ):
+        self.max_seconds = max_seconds
+        self.max_bytes = max_bytes
+        # sorted capture timestamps for the binary search, parallel to frame_list
+        self.timestamp_list = []
+        self.frame_list = []
+        # absolute index of frame_list[0], the replay viewers keep absolute indices while the front is trimmed
+        self.first_index = 0
+        self.total_bytes = 0
+        self.last_sequence_number = None
+        self.new_frame_condition = tornado.locks.Condition()
+
+    def append(self, frame: ImageStreamFrame):
+        # the keep-alive of a static screen publishes the same frame again
+        if frame.sequence_number == self.last_sequence_number:
+            return
+        self.last_sequence_number = frame.sequence_number
+
+        if (len(self.timestamp_list) > 0) and (frame.capture_timestamp < self.timestamp_list[-1]):
+            # the wall clock went backwards, start over instead of breaking the order
+            self.first_index += len(self.frame_list)
+            self.timestamp_list = []
+            self.frame_list = []
+            self.total_bytes = 0
+
+        self.timestamp_list.append(frame.capture_timestamp)
+        self.frame_list.append(frame)
+        self.total_bytes += len(frame.image_bytes)
+        self.trim(frame.capture_timestamp)
+        self.new_frame_condition.notify_all()
+
+    def trim(self, now: float):
+        # the newest frame is always kept
+        remove_count = 0
+        removed_bytes = 0
+        while remove_count < (len(self.frame_list) - 1):
+            too_large = (self.total_bytes - removed_bytes) > self.max_bytes
+            too_old = self.timestamp_list[remove_count + 1] < (now - self.max_seconds)
+            if not (too_large or too_old):
+                break
+
+            removed_bytes += len(self.frame_list[remove_count].image_bytes)
+            remove_count += 1
+
+        if remove_count > 0:
+            del self.timestamp_list[:remove_count]
+            del self.frame_list[:remove_count]
+            self.first_index += remove_count
+            self.total_bytes -= removed_bytes
+
+    def get_end_index(self):
+        return self.first_index + len(self.frame_list)
+
+    def find_index(self, timestamp: float):
+        # absolute index of the frame on screen at the timestamp, the oldest frame if it is older than the history
+        local_index = bisect.bisect_right(self.timestamp_list, timestamp) - 1
+        return self.first_index + max(0, local_index)
+
+    def get_frame(self, absolute_index: int):
+        # a viewer which fell behind the trimmed front continues from the oldest frame
+        local_index = max(0, absolute_index - self.first_index)
+        if local_index >= len(self.frame_list):
+            return None, self.get_end_index()
+
+        return self.frame_list[local_index], self.first_index + local_index
+
+    def get_time_range(self):
+        if len(self.timestamp_list) == 0:
+            return None, None
+
+        return self.timestamp_list[0], self.timestamp_list[-1]
+
+
+class ScreenHistoryRecorder:
+    def __init__(
+        self,
+        history_ring: ScreenHistoryRing,
+        stream_key: ImageStreamKey,
+        frame_rate: int,
+    ):
+        self.history_ring = history_ring
+        # the replay streams whole images
+        self.subscriber = ImageStreamSubscriber(
+            stream_key._replace(stream_mode=STREAM_MODE_FULL),
+            frame_rate,
+        )
+
+    def start(self):
+        IMAGE_STREAM_PRODUCER.subscribe(self.subscriber)
+        tornado.ioloop.IOLoop.current().spawn_callback(self.run)
+
+    async def run(self):
+        try:
+            while True:
+                frame = await self.subscriber.wait_for_frame()
+                if frame is None:
+                    break
+
+                self.history_ring.append(frame)
+        finally:
+            IMAGE_STREAM_PRODUCER.unsubscribe(self.subscriber)
+
+
+SCREEN_HISTORY_RING = None
+SCREEN_HISTORY_PREVIEW_RING = None
+
+
+class ReplayHandler(tornado.web.RequestHandler):
+    async def get(self):
+        params = self.request.query_arguments
+        print(f'ReplayHandler: params: {params}')
+
+        if 'preview' in params:
+            history_ring = SCREEN_HISTORY_PREVIEW_RING
+        else:
+            history_ring = SCREEN_HISTORY_RING
+
+        if history_ring is None:
+            self.set_status(404)
+            self.write('screen history is disabled, start the server with --history-minutes <minutes>')
+            return
+
+        # `start` is a unix timestamp, `ago` is a number of seconds before now, the oldest frame by default
+        oldest_timestamp, newest_timestamp = history_ring.get_time_range()
+        start_timestamp = web_parse_timestamp_value(params.get('start', []))
+        ago_seconds = web_parse_timestamp_value(params.get('ago', []))
+        if ago_seconds is not None:
+            start_timestamp = time.time() - ago_seconds
+        if start_timestamp is None:
+            start_timestamp = oldest_timestamp
+        if start_timestamp is None:
+            start_timestamp = time.time()
+        if oldest_timestamp is not None:
+            # the playback clock starts at the first frame actually played, not at the requested time
+            start_timestamp = min(max(start_timestamp, oldest_timestamp), newest_timestamp)
+
+        speed = web_parse_speed_value(params.get('speed', []))
+        if speed is None:
+            speed = 1.0
+
+        self.set_header('Content-Type', 'multipart/x-mixed-replace;boundary=--frame')
+        if oldest_timestamp is not None:
+            self.set_header('X-History-Start', str(oldest_timestamp))
+            self.set_header('X-History-End', str(newest_timestamp))
 
+        viewer_id = next(VIEWER_ID_COUNTER)
+        remote_ip = self.request.remote_ip
+        try:
+            await self.send_replay_frames(
+                history_ring,
+                start_timestamp,
+                speed,
+                viewer_id,
+                remote_ip,
+            )
+        finally:
+            remove_viewer_metrics('replay', viewer_id, remote_ip)
+
+    async def send_replay_frames(
+        self,
+        history_ring: ScreenHistoryRing,
+        start_timestamp: float,
+        speed: float,
+        viewer_id: int,
+        remote_ip: str,
+    ):
+        io_loop = tornado.ioloop.IOLoop.current()
+        playback_start_time = time.perf_counter()
+        frame_index = history_ring.find_index(start_timestamp)
+        while True:
+            if self.request.connection.stream.closed():
+                print('connection closed')
+                break
+
+            frame, frame_index = history_ring.get_frame(frame_index)
+            if frame is None:
+                # caught up with the live end of the history
+                await history_ring.new_frame_condition.wait(timeout=io_loop.time() + 1.0)
+                continue
+
+            # hold the previous frame on screen for as long as it was shown when it was captured
+            delay_seconds = ((frame.capture_timestamp - start_timestamp) / speed) - (time.perf_counter() - playback_start_time)
+            if delay_seconds > 0:
+                await tornado.gen.sleep(delay_seconds)
+
+            self.write('--frame\r\n')
+            self.write(f'Content-Type: image/{frame.image_format}\r\n')
+            self.write(f'X-Capture-Timestamp: {frame.capture_timestamp}\r\n')
+            self.write(f'Content-Length: {len(frame.image_bytes)}\r\n\r\n')
+            self.write(frame.image_bytes)
+            send_start_time = time.perf_counter()
+            try:
+                await self.flush()
+            except tornado.iostream.StreamClosedError:
+                print('connection closed')
+                break
+
+            record_frame_sent('replay', viewer_id, remote_ip, len(frame.image_bytes), time.perf_counter() - send_start_time)
+
+            # skip the frames which should have been shown while this one was being sent
+            playback_timestamp = start_timestamp + ((time.perf_counter() - playback_start_time) * speed)
+            frame_index = max(frame_index + 1, history_ring.find_index(playback_timestamp))
+
+
+### END SCREEN HISTORY REPLAY ##########################################
 ########################################################################
-DEFAULT_FRAME_RATE = 32
-MAX_FRAME_RATE = 128
+### WEBSOCKET IMAGE STREAM #############################################
+# binary frames with a small header, the next frame is only sent after the previous one has been written to the socket
+# json text messages from the client change the stream parameters without reconnecting
+
+# little endian
+# header size, sequence number, capture timestamp (seconds since epoch), image format code,
+# frame width, frame height, x, y (position of the image in the frame, non-zero for tiles)
+WEBSOCKET_FRAME_HEADER_STRUCT = struct.Struct('<HIdBHHHH')
+
+IMAGE_FORMAT_CODE_DICT = {
+    'png': 1,
+    'jpg': 2,
+    'jpeg': 2,
+    'webp': 3,
+}
 
-DEFAULT_IMAGE_FORMAT = 'png'
 
+def web_parse_control_message(message: str):
+    # convert {"fps": 10, "cursor": false} to the same shape as request.query_arguments
+    obj = json.loads(message)
+    if not isinstance(obj, dict):
+        raise Exception(f'invalid control message: {message}')
 
-class ImageStreamHandler(tornado.web.RequestHandler):
-    @tornado.gen.coroutine
-    def get(self):
+    params = {}
+    for key, value in obj.items():
+        if value is None:
+            continue
+        if value is True:
+            value = ''
+        if value is False:
+            value = 'false'
+        params[key] = [str(value).encode('utf-8')]
+
+    disable_cursor = ('cursor' in obj) and (not obj['cursor'])
+    return params, disable_cursor
+
+
+class ImageStreamWebSocketHandler(tornado.websocket.WebSocketHandler):
+    def open(self):
         params = self.request.query_arguments
-        print(f'ImageStreamHandler: params: {params}')
+        print(f'ImageStreamWebSocketHandler: params: {params}')
 
-        scaling_factor = None
-        render_mouse_cursor = False
-        image_format = DEFAULT_IMAGE_FORMAT
-        frame_rate = DEFAULT_FRAME_RATE
+        stream_key, frame_rate = parse_image_stream_arguments(params)
 
-        if 'scaling' in params:
-            scaling_value_list = params['scaling']
-            scaling_factor = web_parse_scaling_value(scaling_value_list)
-        if 'cursor' in params:
-            render_mouse_cursor = True
-        if 'format' in params:
-            image_format_value_list = params['format']
-            retval = web_parse_image_format_value(image_format_value_list)
-            if retval is not None:
-                image_format = retval
-
-        frame_rate_key_list = ['fps', 'framerate', 'frame_rate']
-        for frame_rate_key in frame_rate_key_list:
-            if frame_rate_key in params:
-                frame_rate_value_list = params[frame_rate_key]
-                retval = web_parse_frame_rate_value(frame_rate_value_list)
-                if retval is not None:
-                    frame_rate = retval
+        self.adaptive_quality_controller = create_adaptive_quality_controller(params, stream_key, frame_rate)
+        if self.adaptive_quality_controller is not None:
+            stream_key = self.adaptive_quality_controller.get_stream_key(stream_key)
+            frame_rate = self.adaptive_quality_controller.frame_rate
+
+        self.subscriber = ImageStreamSubscriber(
+            stream_key=stream_key,
+            frame_rate=frame_rate,
+        )
+        self.sent_tile_version_grid = None
+        self.viewer_id = next(VIEWER_ID_COUNTER)
+        self.remote_ip = self.request.remote_ip
+
+        IMAGE_STREAM_PRODUCER.subscribe(self.subscriber)
+        tornado.ioloop.IOLoop.current().spawn_callback(self.send_frames)
+
+    def on_message(self, message):
+        if isinstance(message, bytes):
+            return
+
+        try:
+            params, disable_cursor = web_parse_control_message(message)
+        except Exception as ex:
+            print(ex)
+            return
+
+        print(f'ImageStreamWebSocketHandler: control: {params}')
+        stream_key, frame_rate = parse_image_stream_arguments(
+            params,
+            stream_key=self.subscriber.stream_key,
+            frame_rate=self.subscriber.frame_rate,
+        )
+        if disable_cursor:
+            stream_key = stream_key._replace(render_mouse_cursor=False)
+
+        if stream_key != self.subscriber.stream_key:
+            self.sent_tile_version_grid = None
+
+        IMAGE_STREAM_PRODUCER.update_subscriber(
+            self.subscriber,
+            stream_key=stream_key,
+            frame_rate=frame_rate,
+        )
+
+    def on_close(self):
+        self.subscriber.close()
+
+    async def write_image_message(
+        self,
+        frame: ImageStreamFrame,
+        image_bytes: bytes,
+        x: int = 0,
+        y: int = 0,
+    ):
+        header = WEBSOCKET_FRAME_HEADER_STRUCT.pack(
+            WEBSOCKET_FRAME_HEADER_STRUCT.size,
+            frame.sequence_number,
+            frame.capture_timestamp,
+            IMAGE_FORMAT_CODE_DICT[frame.image_format],
+            frame.frame_width,
+            frame.frame_height,
+            x,
+            y,
+        )
+        # resolves once the message has been written to the socket
+        send_start_time = time.perf_counter()
+        await self.write_message(header + image_bytes, binary=True)
+        self.written_bytes += len(image_bytes)
+        self.send_duration_seconds += time.perf_counter() - send_start_time
+
+    async def update_adaptive_quality(self):
+        controller = self.adaptive_quality_controller
+        if not controller.on_frame_sent(self.written_bytes, self.send_duration_seconds):
+            return
+
+        stream_key = controller.get_stream_key(self.subscriber.stream_key)
+        if stream_key != self.subscriber.stream_key:
+            self.sent_tile_version_grid = None
+
+        IMAGE_STREAM_PRODUCER.update_subscriber(
+            self.subscriber,
+            stream_key=stream_key,
+            frame_rate=controller.frame_rate,
+        )
+        # the chosen settings are sent as a text message
+        await self.write_message(json.dumps(controller.get_status_dict()))
+
+    async def send_frames(self):
+        subscriber = self.subscriber
+        last_frame = None
+        try:
+            while True:
+                frame = await subscriber.wait_for_frame()
+                if frame is None:
                     break
 
-        if frame_rate > MAX_FRAME_RATE:
-            frame_rate = DEFAULT_FRAME_RATE
-        if frame_rate == 0:
-            frame_rate = DEFAULT_FRAME_RATE
+                self.written_bytes = 0
+                self.send_duration_seconds = 0.0
+                await self.write_frame_messages(frame, last_frame)
+                last_frame = frame
+                if self.written_bytes == 0:
+                    continue
+
+                record_frame_sent('websocket', self.viewer_id, self.remote_ip, self.written_bytes, self.send_duration_seconds)
+                if self.adaptive_quality_controller is not None:
+                    await self.update_adaptive_quality()
+        except tornado.websocket.WebSocketClosedError:
+            print('websocket closed')
+        finally:
+            IMAGE_STREAM_PRODUCER.unsubscribe(subscriber)
+            remove_viewer_metrics('websocket', self.viewer_id, self.remote_ip)
+
+    async def write_frame_messages(
+        self,
+        frame: ImageStreamFrame,
+        last_frame: ImageStreamFrame,
+    ):
+        if frame.tile_version_grid is None:
+            await self.write_image_message(frame, frame.image_bytes)
+            return
+
+        changed_tile_index_list = get_changed_tile_index_list(frame, self.sent_tile_version_grid)
+        self.sent_tile_version_grid = frame.tile_version_grid
+        if (len(changed_tile_index_list) == 0) and (frame is last_frame):
+            # keep-alive for a static screen, send the first tile again
+            changed_tile_index_list = [0]
+
+        for tile_index in changed_tile_index_list:
+            tile_x, tile_y = get_tile_position(frame, int(tile_index))
+            await self.write_image_message(
+                frame,
+                frame.tile_list[tile_index],
+                x=tile_x,
+                y=tile_y,
+            )
 
-        sleep_time_seconds = 1.0 / frame_rate
-        image_content_type_header = f'Content-Type: image/{image_format}\r\n'
-        image_ext = f'.{image_format}'
 
-        self.set_header('Content-Type', 'multipart/x-mixed-replace;boundary=--frame')
+### END WEBSOCKET IMAGE STREAM #########################################
+########################################################################
+### INPUT CHANNEL ######################################################
+# mouse and keyboard events from the viewer over a websocket, json text messages:
+# {"type": "move", "x": 0.5, "y": 0.5} position relative to the streamed area, 0 to 1
+# {"type": "down" or "up", "button": "left", "middle" or "right"}
+# {"type": "scroll", "dx": 0, "dy": -1}
+# {"type": "keydown" or "keyup", "key": KeyboardEvent.key, "code": KeyboardEvent.code}
+# the key picks what is typed, the code is the physical key which is released
+# {"type": "release"} releases everything this session is holding, e.g. when the viewer loses focus
+# {"type": "viewonly", "value": true} stops (or resumes) applying the events of this session
+#
+# the events are applied on a dedicated thread so they never wait behind the capture and the encoders
+# consecutive mouse moves are merged, only the latest position is applied
+
+INPUT_EVENT_MOVE = 'move'
+INPUT_EVENT_BUTTON_DOWN = 'down'
+INPUT_EVENT_BUTTON_UP = 'up'
+INPUT_EVENT_SCROLL = 'scroll'
+INPUT_EVENT_KEY_DOWN = 'keydown'
+INPUT_EVENT_KEY_UP = 'keyup'
+INPUT_EVENT_RELEASE = 'release'
+INPUT_EVENT_VIEW_ONLY = 'viewonly'
+
+MOUSE_BUTTON_NAME_LIST = [
+    'left',
+    'middle',
+    'right',
+]
+
+# KeyboardEvent.key -> attribute of pynput.keyboard.Key, single characters are typed as they are
+BROWSER_KEY_NAME_DICT = {
+    'Alt': 'alt',
+    'AltGraph': 'alt_gr',
+    'ArrowDown': 'down',
+    'ArrowLeft': 'left',
+    'ArrowRight': 'right',
+    'ArrowUp': 'up',
+    'Backspace': 'backspace',
+    'CapsLock': 'caps_lock',
+    'ContextMenu': 'menu',
+    'Control': 'ctrl',
+    'Delete': 'delete',
+    'End': 'end',
+    'Enter': 'enter',
+    'Escape': 'esc',
+    'Home': 'home',
+    'Insert': 'insert',
+    'Meta': 'cmd',
+    'NumLock': 'num_lock',
+    'PageDown': 'page_down',
+    'PageUp': 'page_up',
+    'Pause': 'pause',
+    'PrintScreen': 'print_screen',
+    'ScrollLock': 'scroll_lock',
+    'Shift': 'shift',
+    'Tab': 'tab',
+    ' ': 'space',
+}
+for function_key_number in range(1, 21):
+    BROWSER_KEY_NAME_DICT[f'F{function_key_number}'] = f'f{function_key_number}'
+
+MAX_SCROLL_STEPS = 10
+# detect dead viewers so that their keys are released even if the connection was not closed
+INPUT_PING_INTERVAL_SECONDS = 5.0
+INPUT_PING_TIMEOUT_SECONDS = 5.0
+
 
+def get_input_key(browser_key: str):
+    # returns None for keys which cannot be typed
+    if pynput is None:
+        return None
+
+    key_name = BROWSER_KEY_NAME_DICT.get(browser_key)
+    if key_name is not None:
+        return getattr(pynput.keyboard.Key, key_name, None)
+
+    if len(browser_key) == 1:
+        return pynput.keyboard.KeyCode.from_char(browser_key)
+
+    return None
+
+
+def get_mouse_button(button_name: str):
+    if (pynput is None) or (button_name not in MOUSE_BUTTON_NAME_LIST):
+        return None
+
+    return getattr(pynput.mouse.Button, button_name)
+
+
+class InputInjector:
+    def __init__(self):
+        self.condition = threading.Condition()
+        # (event type, value) in the order they were received, applied by the input thread
+        self.event_queue = collections.deque()
+        # the latest mouse move which has not been applied yet
+        self.pending_mouse_position = None
+        self.thread = None
+
+    def start(self):
+        if self.thread is not None:
+            return
+
+        self.thread = threading.Thread(
+            target=self.run,
+            name='input',
+            daemon=True,
+        )
+        self.thread.start()
+
+    def move(self, position: tuple):
+        with self.condition:
+            if self.pending_mouse_position is not None:
+                METRICS.increment(METRIC_COALESCED_MOUSE_MOVES)
+            self.pending_mouse_position = position
+            self.condition.notify()
+
+    def put(
+        self,
+        event_type: str,
+        value,
+    ):
+        with self.condition:
+            # a click applies at the position of the moves before it
+            if self.pending_mouse_position is not None:
+                self.event_queue.append((INPUT_EVENT_MOVE, self.pending_mouse_position))
+                self.pending_mouse_position = None
+            self.event_queue.append((event_type, value))
+            self.condition.notify()
+
+    def run(self):
         while True:
-            # check if connection is still alive
-            if self.request.connection.stream.closed():
-                print('connection closed')
-                break
+            with self.condition:
+                while (len(self.event_queue) == 0) and (self.pending_mouse_position is None):
+                    self.condition.wait()
+
+                event_list = list(self.event_queue)
+                self.event_queue.clear()
+                # the pending move came after every queued event
+                if self.pending_mouse_position is not None:
+                    event_list.append((INPUT_EVENT_MOVE, self.pending_mouse_position))
+                    self.pending_mouse_position = None
+
+            for event_type, value in event_list:
+                try:
+                    self.apply(event_type, value)
+                except Exception as ex:
+                    print(f'InputInjector: {event_type} {value}: {ex}')
+
+    def apply(
+        self,
+        event_type: str,
+        value,
+    ):
+        METRICS.increment(METRIC_INPUT_EVENTS, type=event_type)
+        if event_type == INPUT_EVENT_MOVE:
+            MOUSE_CONTROLLER.position = value
+        elif event_type == INPUT_EVENT_BUTTON_DOWN:
+            MOUSE_CONTROLLER.press(value)
+        elif event_type == INPUT_EVENT_BUTTON_UP:
+            MOUSE_CONTROLLER.release(value)
+        elif event_type == INPUT_EVENT_SCROLL:
+            MOUSE_CONTROLLER.scroll(*value)
+        elif event_type == INPUT_EVENT_KEY_DOWN:
+            KEYBOARD_CONTROLLER.press(value)
+        elif event_type == INPUT_EVENT_KEY_UP:
+            KEYBOARD_CONTROLLER.release(value)
+
+
+INPUT_INJECTOR = InputInjector()
+INPUT_ENABLED = False
+
+
+class InputSession:
+    def __init__(
+        self,
+        screen_region: dict,
+        view_only: bool = False,
+    ):
+        self.screen_region = screen_region
+        self.view_only = view_only
+        # released when the session ends so that no key stays stuck on the remote machine
+        # physical key (KeyboardEvent.code) -> the key which was pressed for it
+        # the key of the same physical key depends on the modifiers, shift+a is pressed as 'A' and may be released as 'a'
+        self.pressed_key_dict = {}
+        self.pressed_button_set = set()
+
+    def release_all(self):
+        for key in self.pressed_key_dict.values():
+            INPUT_INJECTOR.put(INPUT_EVENT_KEY_UP, key)
+        for button in self.pressed_button_set:
+            INPUT_INJECTOR.put(INPUT_EVENT_BUTTON_UP, button)
+
+        self.pressed_key_dict = {}
+        self.pressed_button_set = set()
+
+    def handle_event(self, event: dict):
+        event_type = event.get('type')
+        if event_type == INPUT_EVENT_VIEW_ONLY:
+            self.view_only = bool(event.get('value', True))
+            if self.view_only:
+                self.release_all()
+            return
 
-            self.write('--frame\r\n')
-            self.write(image_content_type_header)
+        if event_type == INPUT_EVENT_RELEASE:
+            self.release_all()
+            return
+
+        if self.view_only:
+            return
+
+        if event_type == INPUT_EVENT_MOVE:
+            # relative to the streamed monitor or region so it does not depend on the scaling of the stream
+            x = min(max(float(event['x']), 0.0), 1.0)
+            y = min(max(float(event['y']), 0.0), 1.0)
+            screen_region = self.screen_region
+            INPUT_INJECTOR.move((
+                screen_region['left'] + min(int(x * screen_region['width']), screen_region['width'] - 1),
+                screen_region['top'] + min(int(y * screen_region['height']), screen_region['height'] - 1),
+            ))
+        elif event_type in (INPUT_EVENT_BUTTON_DOWN, INPUT_EVENT_BUTTON_UP):
+            button = get_mouse_button(event.get('button'))
+            if button is None:
+                raise Exception(f'unknown mouse button: {event.get("button")}')
+
+            if event_type == INPUT_EVENT_BUTTON_DOWN:
+                self.pressed_button_set.add(button)
+            else:
+                self.pressed_button_set.discard(button)
+            INPUT_INJECTOR.put(event_type, button)
+        elif event_type == INPUT_EVENT_SCROLL:
+            dx = min(max(int(event.get('dx', 0)), -MAX_SCROLL_STEPS), MAX_SCROLL_STEPS)
+            dy = min(max(int(event.get('dy', 0)), -MAX_SCROLL_STEPS), MAX_SCROLL_STEPS)
+            INPUT_INJECTOR.put(event_type, (dx, dy))
+        elif event_type in (INPUT_EVENT_KEY_DOWN, INPUT_EVENT_KEY_UP):
+            physical_key = str(event.get('code') or event.get('key'))
+            if event_type == INPUT_EVENT_KEY_UP:
+                # release what was pressed for this physical key, a key which was never pressed is ignored
+                key = self.pressed_key_dict.pop(physical_key, None)
+                if key is not None:
+                    INPUT_INJECTOR.put(event_type, key)
+                return
+
+            # auto repeat presses the same key again even if the modifiers changed meanwhile
+            key = self.pressed_key_dict.get(physical_key)
+            if key is None:
+                key = get_input_key(str(event.get('key')))
+            if key is None:
+                raise Exception(f'unknown key: {event.get("key")}')
+
+            self.pressed_key_dict[physical_key] = key
+            INPUT_INJECTOR.put(event_type, key)
+        else:
+            raise Exception(f'unknown input event: {event_type}')
+
+
+class InputWebSocketHandler(tornado.websocket.WebSocketHandler):
+    @property
+    def ping_interval(self):
+        return INPUT_PING_INTERVAL_SECONDS
+
+    @property
+    def ping_timeout(self):
+        return INPUT_PING_TIMEOUT_SECONDS
+
+    async def get(self, *args, **kwargs):
+        if not INPUT_ENABLED:
+            self.set_status(403)
+            self.finish('input is disabled, start the server with --allow-input')
+            return
+
+        await super().get(*args, **kwargs)
+
+    async def open(self):
+        params = self.request.query_arguments
+        print(f'InputWebSocketHandler: params: {params}')
+
+        # the same query string as the image stream, the positions are relative to the same monitor or region
+        stream_key, _ = parse_image_stream_arguments(params)
+        screen_region = await tornado.ioloop.IOLoop.current().run_in_executor(
+            CAPTURE_EXECUTOR,
+            IMAGE_STREAM_PRODUCER.frame_grabber.get_screen_region,
+            stream_key.monitor_index,
+            stream_key.capture_region,
+        )
+
+        view_only = ('viewonly' in params) and (web_parse_flag_value(params['viewonly']) is not None)
+        self.input_session = InputSession(screen_region, view_only=view_only)
+        INPUT_INJECTOR.start()
+
+    def on_message(self, message):
+        input_session = getattr(self, 'input_session', None)
+        if (input_session is None) or isinstance(message, bytes):
+            return
+
+        try:
+            event = json.loads(message)
+            if not isinstance(event, dict):
+                raise Exception(f'invalid input message: {message}')
+
+            input_session.handle_event(event)
+        except Exception as ex:
+            print(ex)
+
+    def on_close(self):
+        input_session = getattr(self, 'input_session', None)
+        if input_session is not None:
+            input_session.release_all()
+            print('InputWebSocketHandler: closed, released the keys and buttons of the session')
+
+
+### END INPUT CHANNEL ##################################################
+########################################################################
+### CURSOR CHANNEL #####################################################
+# the cursor drawn by the viewer on top of the stream instead of being merged into the frames
+# moving the mouse then changes no pixel, so a static screen is not encoded again and the cursor moves at its own rate
+# the first message is the sprite as json text, then every position change is a binary message
+
+# little endian
+# x, y of the top left corner of the sprite relative to the streamed monitor or region, in screen pixels
+CURSOR_POSITION_STRUCT = struct.Struct('<ii')
+
+DEFAULT_CURSOR_POSITION_RATE = 60
+
+# `cursor=overlay` in the stream query string leaves the cursor out of the frames
+CURSOR_OVERLAY_VALUE = b'overlay'
+
+CURSOR_SPRITE_DATA_URL = 'data:image/png;base64,' + base64.b64encode(cv2.imencode('.png', CURSOR_BGRA_IMAGE)[1].tobytes()).decode('ascii')
+
+
+class CursorPositionBroadcaster:
+    def __init__(self):
+        self.handler_set = set()
+        self.position_rate = DEFAULT_CURSOR_POSITION_RATE
+        self.periodic_callback = None
+
+    def subscribe(self, handler):
+        self.handler_set.add(handler)
+        if self.periodic_callback is None:
+            self.periodic_callback = tornado.ioloop.PeriodicCallback(
+                self.broadcast,
+                1000 / self.position_rate,
+            )
+            self.periodic_callback.start()
+
+    def unsubscribe(self, handler):
+        self.handler_set.discard(handler)
+        if (len(self.handler_set) == 0) and (self.periodic_callback is not None):
+            self.periodic_callback.stop()
+            self.periodic_callback = None
+
+    def broadcast(self):
+        # one query of the mouse for every viewer, it is quick enough to run on the io loop
+        # the capture executor would delay it behind the grab and the encoders
+        mouse_position = get_mouse_position()
+        if mouse_position is None:
+            return
+
+        for handler in list(self.handler_set):
+            handler.send_position(mouse_position)
+
+
+CURSOR_POSITION_BROADCASTER = CursorPositionBroadcaster()
+
+
+class CursorWebSocketHandler(tornado.websocket.WebSocketHandler):
+    async def open(self):
+        params = self.request.query_arguments
+        print(f'CursorWebSocketHandler: params: {params}')
+
+        # the same query string as the image stream, the positions are relative to the same monitor or region
+        stream_key, _ = parse_image_stream_arguments(params)
+        self.screen_region = await tornado.ioloop.IOLoop.current().run_in_executor(
+            CAPTURE_EXECUTOR,
+            IMAGE_STREAM_PRODUCER.frame_grabber.get_screen_region,
+            stream_key.monitor_index,
+            stream_key.capture_region,
+        )
+        self.sent_position = None
+        self.write_future = None
+        if self.ws_connection is None:
+            # the viewer left while the region was looked up, on_close has already run
+            return
+
+        # the viewer scales the sprite by the size it displays the stream at
+        self.write_message(json.dumps({
+            'image': CURSOR_SPRITE_DATA_URL,
+            'width': CURSOR_WIDTH,
+            'height': CURSOR_HEIGHT,
+            'region_width': self.screen_region['width'],
+            'region_height': self.screen_region['height'],
+        }))
+        CURSOR_POSITION_BROADCASTER.subscribe(self)
+
+    def send_position(self, mouse_position: tuple):
+        position = (
+            int(mouse_position[0]) - self.screen_region['left'],
+            int(mouse_position[1]) - self.screen_region['top'],
+        )
+        if position == self.sent_position:
+            return
+
+        # a slow viewer skips positions instead of buffering them, the latest one is sent once the socket has drained
+        if (self.write_future is not None) and (not self.write_future.done()):
+            return
+
+        try:
+            self.write_future = self.write_message(CURSOR_POSITION_STRUCT.pack(*position), binary=True)
+        except tornado.websocket.WebSocketClosedError:
+            CURSOR_POSITION_BROADCASTER.unsubscribe(self)
+            return
+
+        self.sent_position = position
+        METRICS.increment(METRIC_CURSOR_POSITIONS_SENT)
+
+    def on_message(self, message):
+        pass
+
+    def on_close(self):
+        CURSOR_POSITION_BROADCASTER.unsubscribe(self)
+
+
+### END CURSOR CHANNEL #################################################
+########################################################################
+### ENCODER REPORT #####################################################
+# time every codec and setting on the current screen content so that the best tradeoff can be picked for each machine
+
+ENCODER_REPORT_SETTING_LIST = [
+    ('png', (('png_compression', 0),)),
+    ('png', (('png_compression', 1),)),
+    ('png', (('png_compression', 1), ('png_strategy', 'rle'))),
+    ('png', (('png_compression', 1), ('png_strategy', 'huffman'))),
+    ('png', (('png_compression', 3),)),
+    ('png', (('png_compression', 6),)),
+    ('png', (('png_compression', 9),)),
+    ('jpg', (('jpeg_quality', 50),)),
+    ('jpg', (('jpeg_quality', 70),)),
+    ('jpg', (('jpeg_quality', 85),)),
+    ('jpg', (('jpeg_quality', 95),)),
+    ('jpg', (('jpeg_quality', 85), ('jpeg_subsampling', '444'))),
+    ('jpg', (('jpeg_quality', 85), ('jpeg_subsampling', '420'))),
+    ('webp', (('webp_method', 0), ('webp_quality', 50))),
+    ('webp', (('webp_method', 0), ('webp_quality', 80))),
+    ('webp', (('webp_method', 4), ('webp_quality', 80))),
+    ('webp', (('lossless', True), ('webp_method', 0))),
+]
+
+DEFAULT_ENCODER_REPORT_REPEAT = 3
+MAX_ENCODER_REPORT_REPEAT = 20
+
+# the report takes seconds, encoding it on the capture thread would freeze every stream meanwhile
+# a single worker also runs concurrent reports one after the other
+ENCODER_REPORT_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=1,
+    thread_name_prefix='encoder_report',
+)
+
+
+def grab_encoder_report_images(
+    frame_grabber: FrameGrabber,
+    scaling_factor: float = None,
+):
+    # must run on the capture thread, the change detection of the streams is left untouched
+    np_image, screen_region = frame_grabber.grab(detect_changes=False)
+    bgra_image = frame_grabber.resize(np_image, scaling_factor)
+    bgr_image = frame_grabber.convert_to_bgr(bgra_image)
+    # the grabber reuses its buffers for the next frame
+    return bgra_image.copy(), bgr_image.copy()
+
+
+def get_encoder_report(
+    bgra_image: np.ndarray,
+    bgr_image: np.ndarray,
+    repeat: int = DEFAULT_ENCODER_REPORT_REPEAT,
+):
+    image_height, image_width = bgr_image.shape[:2]
+
+    result_list = []
+    for image_format, encoder_options in ENCODER_REPORT_SETTING_LIST:
+        if image_format in BGRA_ENCODABLE_IMAGE_FORMAT_LIST:
+            source_image = bgra_image
+        else:
+            source_image = bgr_image
+
+        # options which this opencv build does not support are skipped
+        jpeg_subsampling = dict(encoder_options).get('jpeg_subsampling')
+        if (jpeg_subsampling is not None) and (jpeg_subsampling not in JPEG_SUBSAMPLING_DICT):
+            continue
+
+        duration_list = []
+        bs = None
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            bs = encode_image(source_image, image_format, encoder_options=encoder_options)
+            duration_list.append(time.perf_counter() - start_time)
+
+        if bs is None:
+            continue
+
+        duration_list.sort()
+        encode_ms = duration_list[len(duration_list) // 2] * 1000
+        query_string = urllib.parse.urlencode([('format', image_format)] + list(encoder_options))
+        result_list.append({
+            'format': image_format,
+            'options': dict(encoder_options),
+            'query': query_string,
+            'bytes': len(bs),
+            'bits_per_pixel': round(len(bs) * 8 / (image_width * image_height), 3),
+            'encode_ms': round(encode_ms, 2),
+            'max_fps': round(1000 / max(encode_ms, 1e-3), 1),
+        })
+
+    result_list.sort(key=lambda x: x['encode_ms'])
+    return {
+        'width': image_width,
+        'height': image_height,
+        'repeat': repeat,
+        'results': result_list,
+    }
+
+
+class EncoderReportHandler(tornado.web.RequestHandler):
+    async def get(self):
+        params = self.request.query_arguments
+        scaling_factor = web_parse_scaling_value(params.get('scaling', []))
+        repeat = web_parse_positive_int_value(params.get('repeat', []))
+        if repeat is None:
+            repeat = DEFAULT_ENCODER_REPORT_REPEAT
+        repeat = min(repeat, MAX_ENCODER_REPORT_REPEAT)
+
+        io_loop = tornado.ioloop.IOLoop.current()
+        bgra_image, bgr_image = await io_loop.run_in_executor(
+            CAPTURE_EXECUTOR,
+            grab_encoder_report_images,
+            IMAGE_STREAM_PRODUCER.frame_grabber,
+            scaling_factor,
+        )
+        report = await io_loop.run_in_executor(
+            ENCODER_REPORT_EXECUTOR,
+            get_encoder_report,
+            bgra_image,
+            bgr_image,
+            repeat,
+        )
+
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(report, indent=2))
+
+
+### END ENCODER REPORT #################################################
+########################################################################
+### MONITOR LIST #######################################################
+# geometry of the monitors for the `monitor` and `region` stream parameters
+
+
+def get_monitor_list_report(frame_grabber: FrameGrabber):
+    # must run on the capture thread
+    monitor_list = []
+    for monitor_index, monitor in enumerate(frame_grabber.get_monitor_list()):
+        monitor_list.append({
+            'monitor': monitor_index,
+            'left': monitor['left'],
+            'top': monitor['top'],
+            'width': monitor['width'],
+            'height': monitor['height'],
+            'query': f'monitor={monitor_index}',
+        })
+
+    return monitor_list
+
+
+class MonitorListHandler(tornado.web.RequestHandler):
+    async def get(self):
+        monitor_list = await tornado.ioloop.IOLoop.current().run_in_executor(
+            CAPTURE_EXECUTOR,
+            get_monitor_list_report,
+            IMAGE_STREAM_PRODUCER.frame_grabber,
+        )
 
-            bs = capture_screen_to_image_bytes(
-                encode_image_format_extension=image_ext,
-                scaling_factor=scaling_factor,
-                render_mouse_cursor=render_mouse_cursor,
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(monitor_list, indent=2))
+
+
+### END MONITOR LIST ###################################################
+########################################################################
+### SESSION RECORDING ##################################################
+# append the frames of one stream to a rolling archive on disk
+# the archive is a directory of segments, each segment is a pair of append-only files
+# - <start>.frames: the encoded images back to back
+# - <start>.index: fixed size records sorted by timestamp which are memory-mapped for the lookups
+
+SESSION_INDEX_RECORD_DTYPE = np.dtype([
+    ('timestamp', '<f8'),
+    ('offset', '<u8'),
+    ('length', '<u4'),
+    ('sequence_number', '<u4'),
+    ('frame_width', '<u2'),
+    ('frame_height', '<u2'),
+    ('image_format', '<u2'),
+    ('reserved', '<u2'),
+])
+SESSION_FRAME_FILE_EXTENSION = '.frames'
+SESSION_INDEX_FILE_EXTENSION = '.index'
+
+DEFAULT_RECORD_QUERY = 'format=jpg&quality=70&fps=4&cursor'
+DEFAULT_RECORD_MINUTES = 60.0
+DEFAULT_RECORD_GIGABYTES = 1.0
+DEFAULT_RECORD_SEGMENT_SECONDS = 60.0
+
+IMAGE_FORMAT_BY_CODE_DICT = {v: k for k, v in IMAGE_FORMAT_CODE_DICT.items()}
+
+
+class SessionArchiveSegment:
+    def __init__(
+        self,
+        archive_dir: str,
+        start_time: float,
+    ):
+        self.start_time = start_time
+        segment_name = f'{int(start_time * 1000):016d}'
+        self.frame_path = os.path.join(archive_dir, segment_name + SESSION_FRAME_FILE_EXTENSION)
+        self.index_path = os.path.join(archive_dir, segment_name + SESSION_INDEX_FILE_EXTENSION)
+        self.frame_file = None
+        self.index_file = None
+        self.frame_file_size = 0
+        self.record_count = 0
+        self.last_record = None
+        self.index_array = None
+
+        if os.path.exists(self.index_path):
+            # a partially written record at the end is ignored
+            self.record_count = os.path.getsize(self.index_path) // SESSION_INDEX_RECORD_DTYPE.itemsize
+        if os.path.exists(self.frame_path):
+            self.frame_file_size = os.path.getsize(self.frame_path)
+
+    def get_size(self):
+        return self.frame_file_size + (self.record_count * SESSION_INDEX_RECORD_DTYPE.itemsize)
+
+    def get_end_time(self):
+        index_array = self.get_index_array()
+        if len(index_array) == 0:
+            return self.start_time
+
+        return float(index_array['timestamp'][-1])
+
+    def open_for_writing(self):
+        self.frame_file = open(self.frame_path, 'ab')
+        self.index_file = open(self.index_path, 'ab')
+
+    def close(self):
+        if self.frame_file is not None:
+            self.frame_file.close()
+            self.frame_file = None
+        if self.index_file is not None:
+            self.index_file.close()
+            self.index_file = None
+
+    def append_record(
+        self,
+        image_bytes: bytes,
+        record: np.ndarray,
+    ):
+        if image_bytes is not None:
+            record['offset'] = self.frame_file_size
+            record['length'] = len(image_bytes)
+            self.frame_file.write(image_bytes)
+            self.frame_file.flush()
+            self.frame_file_size += len(image_bytes)
+
+        # the frame bytes are flushed first so that a record never points past the end of the frame file
+        self.index_file.write(record.tobytes())
+        self.index_file.flush()
+        self.record_count += 1
+        self.last_record = record
+
+    def get_index_array(self):
+        if self.record_count == 0:
+            return np.empty(0, dtype=SESSION_INDEX_RECORD_DTYPE)
+
+        # remap only when records were appended since the last lookup
+        if (self.index_array is None) or (len(self.index_array) != self.record_count):
+            self.index_array = np.memmap(
+                self.index_path,
+                dtype=SESSION_INDEX_RECORD_DTYPE,
+                mode='r',
+                shape=(self.record_count,),
             )
 
-            bs_len = len(bs)
-            self.write(f'Content-Length: {bs_len}\r\n\r\n')
-            self.write(bs)
-            self.flush()
-            time.sleep(sleep_time_seconds)
+        return self.index_array
+
+    def read_frame(self, record: np.ndarray):
+        with open(self.frame_path, 'rb') as infile:
+            infile.seek(int(record['offset']))
+            return infile.read(int(record['length']))
+
+    def delete(self):
+        self.close()
+        self.index_array = None
+        for path in [self.frame_path, self.index_path]:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class SessionArchive:
+    def __init__(
+        self,
+        archive_dir: str,
+        max_seconds: float = DEFAULT_RECORD_MINUTES * 60,
+        max_bytes: int = int(DEFAULT_RECORD_GIGABYTES * (1024 ** 3)),
+        segment_seconds: float = DEFAULT_RECORD_SEGMENT_SECONDS,
+    ):
+        # not thread-safe, all the calls go through RECORDER_EXECUTOR
+        self.archive_dir = archive_dir
+        self.max_seconds = max_seconds
+        self.max_bytes = max_bytes
+        self.segment_seconds = segment_seconds
+        self.segment_list = []
+        self.segment_start_time_list = []
+        self.writing_segment = None
+        self.last_sequence_number = None
+        self.last_timestamp = 0.0
+
+        os.makedirs(archive_dir, exist_ok=True)
+        # keep the segments of the previous runs, they are rolled out like the others
+        for child_name in sorted(os.listdir(archive_dir)):
+            segment_name, ext = os.path.splitext(child_name)
+            if ext != SESSION_INDEX_FILE_EXTENSION:
+                continue
+            try:
+                start_time = int(segment_name) / 1000
+            except Exception as ex:
+                continue
+
+            segment = SessionArchiveSegment(archive_dir, start_time)
+            if segment.record_count > 0:
+                self.add_segment(segment)
+
+    def add_segment(self, segment: SessionArchiveSegment):
+        self.segment_list.append(segment)
+        self.segment_start_time_list.append(segment.start_time)
+
+    def remove_oldest_segment(self):
+        segment = self.segment_list.pop(0)
+        self.segment_start_time_list.pop(0)
+        segment.delete()
+
+    def append_frame(self, frame: ImageStreamFrame):
+        # unchanged frames are re-published by the producer with the same sequence number
+        is_reference = (frame.sequence_number == self.last_sequence_number)
+        if is_reference:
+            timestamp = time.time()
+        else:
+            timestamp = frame.capture_timestamp
+        # the index must stay sorted for the binary search
+        timestamp = max(timestamp, self.last_timestamp)
+
+        segment = self.writing_segment
+        if (segment is None) or ((timestamp - segment.start_time) >= self.segment_seconds):
+            if segment is not None:
+                segment.close()
+            segment = SessionArchiveSegment(self.archive_dir, timestamp)
+            segment.open_for_writing()
+            self.add_segment(segment)
+            self.writing_segment = segment
+            # every segment starts with a full frame so that it can be deleted on its own
+            is_reference = False
+
+        record = np.zeros((), dtype=SESSION_INDEX_RECORD_DTYPE)
+        record['timestamp'] = timestamp
+        record['sequence_number'] = frame.sequence_number & 0xFFFFFFFF
+        record['frame_width'] = frame.frame_width
+        record['frame_height'] = frame.frame_height
+        record['image_format'] = IMAGE_FORMAT_CODE_DICT[frame.image_format]
+
+        if is_reference:
+            # point at the bytes of the previous record instead of storing them again
+            record['offset'] = segment.last_record['offset']
+            record['length'] = segment.last_record['length']
+            segment.append_record(None, record)
+        else:
+            segment.append_record(frame.image_bytes, record)
+
+        self.last_sequence_number = frame.sequence_number
+        self.last_timestamp = timestamp
+        self.enforce_limits(timestamp)
+
+    def enforce_limits(self, now: float):
+        while len(self.segment_list) > 1:
+            total_size = sum(x.get_size() for x in self.segment_list)
+            # a segment ends where the next one starts
+            oldest_end_time = self.segment_start_time_list[1]
+            if (total_size <= self.max_bytes) and (oldest_end_time >= (now - self.max_seconds)):
+                break
+
+            self.remove_oldest_segment()
+
+    def find_record(self, timestamp: float):
+        # the latest frame at or before the timestamp, one binary search for the segment and one in its index
+        segment_index = bisect.bisect_right(self.segment_start_time_list, timestamp) - 1
+        if segment_index < 0:
+            return None, None
+
+        segment = self.segment_list[segment_index]
+        index_array = segment.get_index_array()
+        record_index = int(np.searchsorted(index_array['timestamp'], timestamp, side='right')) - 1
+        if record_index < 0:
+            return None, None
+
+        return segment, index_array[record_index]
+
+    def read_frame(self, timestamp: float):
+        segment, record = self.find_record(timestamp)
+        if record is None:
+            return None
+
+        image_bytes = segment.read_frame(record)
+        return {
+            'timestamp': float(record['timestamp']),
+            'sequence_number': int(record['sequence_number']),
+            'frame_width': int(record['frame_width']),
+            'frame_height': int(record['frame_height']),
+            'image_format': IMAGE_FORMAT_BY_CODE_DICT[int(record['image_format'])],
+            'image_bytes': image_bytes,
+        }
+
+    def get_status_dict(self):
+        segment_info_list = []
+        for segment in self.segment_list:
+            segment_info_list.append({
+                'start_time': segment.start_time,
+                'end_time': segment.get_end_time(),
+                'frame_count': segment.record_count,
+                'size': segment.get_size(),
+            })
+
+        return {
+            'archive_dir': self.archive_dir,
+            'max_seconds': self.max_seconds,
+            'max_bytes': self.max_bytes,
+            'size': sum(x['size'] for x in segment_info_list),
+            'segments': segment_info_list,
+        }
+
+
+class SessionRecorder:
+    def __init__(
+        self,
+        archive: SessionArchive,
+        stream_key: ImageStreamKey,
+        frame_rate: int,
+    ):
+        self.archive = archive
+        # the archive stores whole images
+        self.subscriber = ImageStreamSubscriber(
+            stream_key._replace(stream_mode=STREAM_MODE_FULL),
+            frame_rate,
+        )
+
+    def start(self):
+        IMAGE_STREAM_PRODUCER.subscribe(self.subscriber)
+        tornado.ioloop.IOLoop.current().spawn_callback(self.run)
+
+    async def run(self):
+        io_loop = tornado.ioloop.IOLoop.current()
+        try:
+            while True:
+                frame = await self.subscriber.wait_for_frame()
+                if frame is None:
+                    break
+
+                try:
+                    await io_loop.run_in_executor(
+                        RECORDER_EXECUTOR,
+                        self.archive.append_frame,
+                        frame,
+                    )
+                except Exception as ex:
+                    print(ex)
+                    print(traceback.format_exc())
+        finally:
+            IMAGE_STREAM_PRODUCER.unsubscribe(self.subscriber)
+
+
+# disk writes and the lookups are kept off the io loop and on a single thread
+RECORDER_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=1,
+    thread_name_prefix='recorder',
+)
+SESSION_ARCHIVE = None
+
+
+class RecordingStatusHandler(tornado.web.RequestHandler):
+    async def get(self):
+        if SESSION_ARCHIVE is None:
+            self.set_status(404)
+            self.write('recording is disabled, start the server with --record <directory>')
+            return
+
+        status_dict = await tornado.ioloop.IOLoop.current().run_in_executor(
+            RECORDER_EXECUTOR,
+            SESSION_ARCHIVE.get_status_dict,
+        )
+
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(status_dict, indent=2))
+
+
+class RecordingFrameHandler(tornado.web.RequestHandler):
+    async def get(self):
+        if SESSION_ARCHIVE is None:
+            self.set_status(404)
+            self.write('recording is disabled, start the server with --record <directory>')
+            return
+
+        timestamp = web_parse_timestamp_value(self.request.query_arguments.get('time', []))
+        if timestamp is None:
+            timestamp = time.time()
+
+        frame_info = await tornado.ioloop.IOLoop.current().run_in_executor(
+            RECORDER_EXECUTOR,
+            SESSION_ARCHIVE.read_frame,
+            timestamp,
+        )
+        if frame_info is None:
+            self.set_status(404)
+            self.write(f'no frame recorded at or before {timestamp}')
+            return
+
+        self.set_header('Content-Type', f'image/{frame_info["image_format"]}')
+        self.set_header('X-Capture-Timestamp', str(frame_info['timestamp']))
+        self.set_header('X-Sequence-Number', str(frame_info['sequence_number']))
+        self.write(frame_info['image_bytes'])
+
+
+### END SESSION RECORDING ##############################################
 ########################################################################
 
 
 DEFAULT_SERVER_PORT = 21578
 
 
+def parse_query_string(query_string: str):
+    # same shape as request.query_arguments
+    params = {}
+    for key, value_list in urllib.parse.parse_qs(query_string, keep_blank_values=True).items():
+        params[key] = [x.encode('utf-8') for x in value_list]
+
+    return params
+
+
 def main():
     parser = argparse.ArgumentParser(description='Remote desktop webserver')
     parser.add_argument('port', type=int, default=DEFAULT_SERVER_PORT, nargs='?')
+    parser.add_argument('--idle-fps', type=int, default=DEFAULT_IDLE_FRAME_RATE, help='capture rate while the screen is static')
+    parser.add_argument('--idle-after', type=float, default=DEFAULT_IDLE_AFTER_SECONDS, help='seconds without any change before dropping to the idle capture rate')
+    parser.add_argument('--keepalive', type=float, default=DEFAULT_KEEPALIVE_INTERVAL_SECONDS, help='seconds between repeated frames while the screen is static')
+    parser.add_argument('--encoder-workers', type=int, default=DEFAULT_ENCODER_WORKER_COUNT, help='number of threads encoding the tiles and stripes of a frame in parallel')
+    parser.add_argument('--static-cache-mb', type=float, default=DEFAULT_STATIC_CACHE_MEGABYTES, help='memory used to cache the files of the webdata directory and their compressed variants')
+    parser.add_argument('--record', metavar='DIR', help='record the screen to a rolling archive in this directory')
+    parser.add_argument('--record-query', default=DEFAULT_RECORD_QUERY, help='stream parameters of the recording, same as the /imagestream query string')
+    parser.add_argument('--record-minutes', type=float, default=DEFAULT_RECORD_MINUTES, help='how much of the recording to keep')
+    parser.add_argument('--record-gb', type=float, default=DEFAULT_RECORD_GIGABYTES, help='maximum size of the recording on disk')
+    parser.add_argument('--record-segment-seconds', type=float, default=DEFAULT_RECORD_SEGMENT_SECONDS, help='length of the archive files, the oldest file is deleted when the recording is over its limits')
+    parser.add_argument('--history-minutes', type=float, default=DEFAULT_HISTORY_MINUTES, help='keep this many minutes of the screen in memory for /replay, disabled by default')
+    parser.add_argument('--history-mb', type=float, default=DEFAULT_HISTORY_MEGABYTES, help='memory limit of the full size history')
+    parser.add_argument('--history-preview-mb', type=float, default=DEFAULT_HISTORY_PREVIEW_MEGABYTES, help='memory limit of the reduced resolution history used by /replay?preview')
+    parser.add_argument('--history-preview-width', type=int, default=DEFAULT_HISTORY_PREVIEW_WIDTH, help='width of the reduced resolution history')
+    parser.add_argument('--history-query', default=DEFAULT_HISTORY_QUERY, help='stream parameters of the history, same as the /imagestream query string')
+    parser.add_argument('--cursor-fps', type=int, default=DEFAULT_CURSOR_POSITION_RATE, help='rate of the cursor positions sent to the viewers with cursor=overlay')
+    parser.add_argument('--allow-input', action='store_true', help='apply the mouse and keyboard events of the viewers (/input/ws), anyone who can reach the port can then control the machine')
+    parser.add_argument('--workers', type=int, default=1, help='number of server processes sharing the port, more than 1 implies --capture-process')
+    parser.add_argument('--capture-process', action='store_true', help='grab the screen in a separate process which writes the frames to shared memory')
+    parser.add_argument('--capture-fps', type=int, default=DEFAULT_CAPTURE_FRAME_RATE, help='grab rate of the capture process')
+    parser.add_argument('--capture-slots', type=int, default=DEFAULT_FRAME_RING_SLOT_COUNT, help='number of frames in the shared memory ring, a server process has slots - 1 frame intervals to encode a frame')
     args = parser.parse_args()
     print('args', args)
 
+    if args.allow_input and (pynput is None):
+        parser.error('--allow-input needs pynput')
+
+    if args.workers > 1:
+        args.capture_process = True
+        # every process would record its own copy and only one of them would answer /replay and /recording
+        if (args.record is not None) or (args.history_minutes > 0):
+            parser.error('--record and --history-minutes need --workers 1')
+
+    if not args.capture_process:
+        start_server(args)
+        return
+
+    # clean up the processes and the shared memory on kill as well as on ctrl+c
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    with mss.mss() as sct:
+        monitor_list = sct.monitors
+    frame_ring = create_shared_frame_ring(monitor_list, max(2, args.capture_slots))
+
+    # spawn instead of fork so that no process inherits the X connections of mss and pynput or the executor threads
+    process_context = multiprocessing.get_context('spawn')
+    process_list = [
+        process_context.Process(
+            target=run_capture_process,
+            args=(
+                frame_ring.name,
+                min(max(1, args.capture_fps), MAX_FRAME_RATE),
+                max(1, args.idle_fps),
+            ),
+            name='capture',
+            daemon=True,
+        ),
+    ]
+
+    try:
+        if args.workers > 1:
+            # the processes accept the connections of the same listening socket
+            socket_list = tornado.netutil.bind_sockets(args.port, address='0.0.0.0')
+            for worker_index in range(args.workers):
+                process_list.append(process_context.Process(
+                    target=start_server,
+                    args=(
+                        args,
+                        socket_list,
+                        frame_ring.name,
+                    ),
+                    name=f'server-{worker_index}',
+                    daemon=True,
+                ))
+
+            for process in process_list:
+                process.start()
+            for process in process_list:
+                process.join()
+        else:
+            process_list[0].start()
+            start_server(args, frame_ring_name=frame_ring.name)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in process_list:
+            if process.is_alive():
+                process.terminate()
+                process.join()
+
+        frame_ring.close()
+        frame_ring.unlink()
+
+
+def start_server(
+    args: argparse.Namespace,
+    socket_list: list = None,
+    frame_ring_name: str = None,
+):
+    # runs in every server process
+    if frame_ring_name is not None:
+        IMAGE_STREAM_PRODUCER.frame_grabber = FrameGrabber(frame_ring=open_shared_frame_ring(frame_ring_name))
+
+    IMAGE_STREAM_PRODUCER.idle_frame_rate = max(1, args.idle_fps)
+    IMAGE_STREAM_PRODUCER.idle_after_seconds = args.idle_after
+    IMAGE_STREAM_PRODUCER.keepalive_interval_seconds = args.keepalive
+    IMAGE_STREAM_PRODUCER.encoder_worker_count = max(1, args.encoder_workers)
+    STATIC_ASSET_CACHE.max_bytes = int(args.static_cache_mb * (1024 ** 2))
+
+    CURSOR_POSITION_BROADCASTER.position_rate = max(1, args.cursor_fps)
+
+    if args.allow_input:
+        global INPUT_ENABLED
+        INPUT_ENABLED = True
+
+    if args.record is not None:
+        global SESSION_ARCHIVE
+        SESSION_ARCHIVE = SessionArchive(
+            args.record,
+            max_seconds=args.record_minutes * 60,
+            max_bytes=int(args.record_gb * (1024 ** 3)),
+            segment_seconds=args.record_segment_seconds,
+        )
+
+        record_stream_key, record_frame_rate = parse_image_stream_arguments(parse_query_string(args.record_query))
+        session_recorder = SessionRecorder(
+            SESSION_ARCHIVE,
+            record_stream_key,
+            record_frame_rate,
+        )
+        tornado.ioloop.IOLoop.current().add_callback(session_recorder.start)
+
+    if args.history_minutes > 0:
+        global SCREEN_HISTORY_RING
+        global SCREEN_HISTORY_PREVIEW_RING
+        SCREEN_HISTORY_RING = ScreenHistoryRing(
+            max_seconds=args.history_minutes * 60,
+            max_bytes=int(args.history_mb * (1024 ** 2)),
+        )
+        SCREEN_HISTORY_PREVIEW_RING = ScreenHistoryRing(
+            max_seconds=args.history_minutes * 60,
+            max_bytes=int(args.history_preview_mb * (1024 ** 2)),
+        )
+
+        # both renditions are resized from the same grab
+        history_stream_key, history_frame_rate = parse_image_stream_arguments(parse_query_string(args.history_query))
+        history_preview_stream_key = history_stream_key._replace(target_width=args.history_preview_width)
+        for history_ring, stream_key in [
+            (SCREEN_HISTORY_RING, history_stream_key),
+            (SCREEN_HISTORY_PREVIEW_RING, history_preview_stream_key),
+        ]:
+            history_recorder = ScreenHistoryRecorder(
+                history_ring,
+                stream_key,
+                history_frame_rate,
+            )
+            tornado.ioloop.IOLoop.current().add_callback(history_recorder.start)
+
     PORT_NUMBER = args.port
 
     app = tornado.web.Application([
         (r'/imagestream', ImageStreamHandler),
+        (r'/imagestream/ws', ImageStreamWebSocketHandler),
+        (r'/input/ws', InputWebSocketHandler),
+        (r'/cursor/ws', CursorWebSocketHandler),
+        (r'/replay', ReplayHandler),
+        (r'/encoders', EncoderReportHandler),
+        (r'/metrics', MetricsHandler),
+        (r'/clock', ClockHandler),
+        (r'/monitors', MonitorListHandler),
+        (r'/recording', RecordingStatusHandler),
+        (r'/recording/frame', RecordingFrameHandler),
         (r'', AllRequestHandler),
         (r'/', AllRequestHandler),
         (r'/.*', AllRequestHandler),
@@ -665,8 +4768,23 @@ def main():
 
     print(f'http://localhost:{PORT_NUMBER}')
     print(f'http://localhost:{PORT_NUMBER}/?cursor&fps=32&format=jpg')
-    app.listen(PORT_NUMBER, address='0.0.0.0')
-    tornado.ioloop.IOLoop.current().start()
+    if socket_list is None:
+        app.listen(PORT_NUMBER, address='0.0.0.0')
+    else:
+        print(f'server process: {os.getpid()}')
+        server = tornado.httpserver.HTTPServer(app)
+        server.add_sockets(socket_list)
+
+        def stop_without_parent():
+            if not is_parent_process_alive():
+                tornado.ioloop.IOLoop.current().stop()
+
+        tornado.ioloop.PeriodicCallback(stop_without_parent, 1000).start()
+
+    try:
+        tornado.ioloop.IOLoop.current().start()
+    except KeyboardInterrupt:
+        pass
 
 
 if __name__ == '__main__':
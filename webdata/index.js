@@ -1,8 +1,556 @@
 var container = document.getElementById('container');
+var searchParams = new URLSearchParams(window.location.search);
 var imagestreamUrl = `/imagestream${window.location.search}`;
-var imageElement = document.createElement('img');
-container.innerHTML = '';
-container.appendChild(imageElement);
-setTimeout(function () {
-    imageElement.src = imagestreamUrl;
-});
+
+var HEADER_SEPARATOR = new Uint8Array([13, 10, 13, 10]); // \r\n\r\n
+
+function indexOfSequence(buffer, sequence, fromIndex) {
+    var lastIndex = buffer.length - sequence.length;
+    for (var i = fromIndex; i <= lastIndex; i++) {
+        var found = true;
+        for (var j = 0; j < sequence.length; j++) {
+            if (buffer[i + j] !== sequence[j]) {
+                found = false;
+                break;
+            }
+        }
+
+        if (found) {
+            return i;
+        }
+    }
+
+    return -1;
+}
+
+function parsePartHeaders(headerText) {
+    // header names are lowercased, the boundary line is skipped
+    var headers = {};
+    var lines = headerText.split('\r\n');
+    for (var i = 0; i < lines.length; i++) {
+        var separatorIndex = lines[i].indexOf(':');
+        if (separatorIndex < 0) {
+            continue;
+        }
+
+        var name = lines[i].substring(0, separatorIndex).trim().toLowerCase();
+        var value = lines[i].substring(separatorIndex + 1).trim();
+        headers[name] = value;
+    }
+
+    return headers;
+}
+
+// read the multipart/x-mixed-replace response incrementally
+// and call onPart(headers, body) for each part, every part has a Content-Length header
+async function readMultipartStream(url, onPart) {
+    var response = await fetch(url);
+    var reader = response.body.getReader();
+    var textDecoder = new TextDecoder('ascii');
+
+    var buffer = new Uint8Array(0);
+    var offset = 0;
+    var headers = null;
+
+    while (true) {
+        var result = await reader.read();
+        if (result.done) {
+            break;
+        }
+
+        var remaining = buffer.subarray(offset);
+        var merged = new Uint8Array(remaining.length + result.value.length);
+        merged.set(remaining, 0);
+        merged.set(result.value, remaining.length);
+        buffer = merged;
+        offset = 0;
+
+        while (true) {
+            if (headers === null) {
+                var headerEndIndex = indexOfSequence(buffer, HEADER_SEPARATOR, offset);
+                if (headerEndIndex < 0) {
+                    break;
+                }
+
+                headers = parsePartHeaders(textDecoder.decode(buffer.subarray(offset, headerEndIndex)));
+                offset = headerEndIndex + HEADER_SEPARATOR.length;
+            }
+
+            var contentLength = parseInt(headers['content-length']);
+            if ((buffer.length - offset) < contentLength) {
+                break;
+            }
+
+            // copy the body out so the buffer can be released
+            var body = buffer.slice(offset, offset + contentLength);
+            offset += contentLength;
+            onPart(headers, body);
+            headers = null;
+        }
+    }
+}
+
+// latency overlay, enabled with ?overlay
+var OVERLAY_SAMPLE_COUNT = 120;
+var OVERLAY_REFRESH_MS = 250;
+var CLOCK_SYNC_INTERVAL_MS = 30000;
+var CLOCK_SYNC_ROUND_TRIP_COUNT = 5;
+
+async function estimateClockOffset() {
+    // seconds to add to the viewer clock to get the server clock, from the fastest of a few round trips
+    var bestRoundTripMs = Infinity;
+    var clockOffset = 0;
+    for (var i = 0; i < CLOCK_SYNC_ROUND_TRIP_COUNT; i++) {
+        var requestTime = Date.now();
+        var response = await fetch('/clock', { cache: 'no-store' });
+        var serverTime = (await response.json()).time;
+        var responseTime = Date.now();
+        if ((responseTime - requestTime) < bestRoundTripMs) {
+            bestRoundTripMs = responseTime - requestTime;
+            clockOffset = serverTime - ((requestTime + responseTime) / 2000);
+        }
+    }
+
+    return clockOffset;
+}
+
+function getPercentile(sampleList, percentile) {
+    if (sampleList.length === 0) {
+        return NaN;
+    }
+
+    var sortedList = sampleList.slice().sort(function (a, b) { return a - b; });
+    return sortedList[Math.min(sortedList.length - 1, Math.floor(sortedList.length * percentile / 100))];
+}
+
+function createLatencyOverlay() {
+    var element = document.createElement('pre');
+    element.className = 'latency-overlay';
+    document.body.appendChild(element);
+
+    var overlay = {
+        clockOffset: 0,
+        latencyList: [],
+        decodeList: [],
+        lastSequenceNumber: null,
+        frameTimeList: [],
+        droppedFrames: 0,
+        missingSequenceNumbers: 0,
+        stageDurations: '',
+    };
+
+    function syncClock() {
+        estimateClockOffset().then(function (clockOffset) {
+            overlay.clockOffset = clockOffset;
+        }).catch(function (error) {
+            console.error(error);
+        });
+    }
+
+    syncClock();
+    setInterval(syncClock, CLOCK_SYNC_INTERVAL_MS);
+
+    function addSample(sampleList, value) {
+        sampleList.push(value);
+        if (sampleList.length > OVERLAY_SAMPLE_COUNT) {
+            sampleList.shift();
+        }
+    }
+
+    // called once the frame is drawn, tiles of the same frame are counted once
+    overlay.onFrameDrawn = function (frame) {
+        addSample(overlay.decodeList, frame.decodeMs);
+        if (frame.sequenceNumber === overlay.lastSequenceNumber) {
+            return;
+        }
+
+        if ((overlay.lastSequenceNumber !== null) && (frame.sequenceNumber > overlay.lastSequenceNumber + 1)) {
+            // captures which did not reach this viewer, including the ones without any change on the screen
+            overlay.missingSequenceNumbers += frame.sequenceNumber - overlay.lastSequenceNumber - 1;
+        }
+
+        overlay.lastSequenceNumber = frame.sequenceNumber;
+        var now = Date.now();
+        addSample(overlay.latencyList, ((now / 1000) + overlay.clockOffset - frame.captureTimestamp) * 1000);
+        addSample(overlay.frameTimeList, now);
+        if (frame.droppedFrames !== undefined) {
+            overlay.droppedFrames = frame.droppedFrames;
+        }
+        if (frame.stageDurations !== undefined) {
+            overlay.stageDurations = frame.stageDurations;
+        }
+    };
+
+    setInterval(function () {
+        var frameTimeList = overlay.frameTimeList;
+        var fps = 0;
+        if (frameTimeList.length > 1) {
+            fps = (frameTimeList.length - 1) * 1000 / (frameTimeList[frameTimeList.length - 1] - frameTimeList[0]);
+        }
+
+        var latestLatency = overlay.latencyList[overlay.latencyList.length - 1];
+        element.textContent = [
+            `latency  ${(latestLatency || 0).toFixed(1)} ms, p50 ${getPercentile(overlay.latencyList, 50).toFixed(1)} ms, p95 ${getPercentile(overlay.latencyList, 95).toFixed(1)} ms`,
+            `decode   p50 ${getPercentile(overlay.decodeList, 50).toFixed(1)} ms, p95 ${getPercentile(overlay.decodeList, 95).toFixed(1)} ms`,
+            `fps      ${fps.toFixed(1)}`,
+            `sequence ${overlay.lastSequenceNumber}, skipped ${overlay.missingSequenceNumbers}, dropped by the server ${overlay.droppedFrames}`,
+            `server   ${overlay.stageDurations}`,
+            `clock    ${(overlay.clockOffset * 1000).toFixed(1)} ms offset`,
+        ].join('\n');
+    }, OVERLAY_REFRESH_MS);
+
+    return overlay;
+}
+
+function getStreamFrameStats(headers, decodeMs) {
+    return {
+        sequenceNumber: parseInt(headers['x-sequence-number']),
+        captureTimestamp: parseFloat(headers['x-capture-timestamp']),
+        droppedFrames: parseInt(headers['x-dropped-frames']),
+        stageDurations: headers['x-stage-durations'] || '',
+        decodeMs: decodeMs,
+    };
+}
+
+// draw the parts of the multipart stream on a canvas
+// full frames have no x-tile-* headers and are drawn at the origin
+function startCanvasStream(url, overlay) {
+    var canvas = document.createElement('canvas');
+    var context = canvas.getContext('2d');
+    container.innerHTML = '';
+    container.appendChild(canvas);
+
+    // decode in parallel but draw in arrival order so an older tile never covers a newer one
+    var drawQueue = Promise.resolve();
+
+    readMultipartStream(url, function (headers, body) {
+        var blob = new Blob([body], { type: headers['content-type'] });
+        var decodeStartTime = performance.now();
+        var decodeMs = 0;
+        var bitmapPromise = createImageBitmap(blob).then(function (bitmap) {
+            decodeMs = performance.now() - decodeStartTime;
+            return bitmap;
+        });
+        drawQueue = drawQueue.then(function () {
+            return bitmapPromise;
+        }).then(function (bitmap) {
+            var frameWidth = parseInt(headers['x-frame-width'] || bitmap.width);
+            var frameHeight = parseInt(headers['x-frame-height'] || bitmap.height);
+            if ((canvas.width !== frameWidth) || (canvas.height !== frameHeight)) {
+                canvas.width = frameWidth;
+                canvas.height = frameHeight;
+            }
+
+            context.drawImage(bitmap, parseInt(headers['x-tile-x'] || '0'), parseInt(headers['x-tile-y'] || '0'));
+            bitmap.close();
+            if (overlay) {
+                overlay.onFrameDrawn(getStreamFrameStats(headers, decodeMs));
+            }
+        }).catch(function (error) {
+            console.error(error);
+        });
+    }).catch(function (error) {
+        console.error(error);
+    });
+}
+
+// keep in sync with WEBSOCKET_FRAME_HEADER_STRUCT and IMAGE_FORMAT_CODE_DICT in remotedesktopwebserver.py
+var IMAGE_FORMAT_MIME_TYPE_DICT = {
+    1: 'image/png',
+    2: 'image/jpeg',
+    3: 'image/webp',
+};
+
+function parseWebSocketFrameHeader(buffer) {
+    var view = new DataView(buffer);
+    return {
+        headerSize: view.getUint16(0, true),
+        sequenceNumber: view.getUint32(2, true),
+        captureTimestamp: view.getFloat64(6, true),
+        imageFormat: view.getUint8(14),
+        frameWidth: view.getUint16(15, true),
+        frameHeight: view.getUint16(17, true),
+        x: view.getUint16(19, true),
+        y: view.getUint16(21, true),
+    };
+}
+
+function parseStreamParameters(queryString) {
+    // same parameters as the query string, e.g. #fps=10&scaling=2&format=jpg
+    var parameters = {};
+    new URLSearchParams(queryString).forEach(function (value, key) {
+        // #cursor=false turns a flag off
+        parameters[key] = (value === 'false') ? false : value;
+    });
+
+    return parameters;
+}
+
+function startWebSocketStream(queryString, overlay) {
+    var canvas = document.createElement('canvas');
+    var context = canvas.getContext('2d');
+    container.innerHTML = '';
+    container.appendChild(canvas);
+
+    var protocol = (window.location.protocol === 'https:') ? 'wss:' : 'ws:';
+    var socket = new WebSocket(`${protocol}//${window.location.host}/imagestream/ws${queryString}`);
+    socket.binaryType = 'arraybuffer';
+
+    var drawQueue = Promise.resolve();
+
+    socket.onmessage = function (event) {
+        if (typeof event.data === 'string') {
+            // stream settings chosen by the adaptive rate controller
+            console.log(JSON.parse(event.data));
+            return;
+        }
+
+        var header = parseWebSocketFrameHeader(event.data);
+        var blob = new Blob([new Uint8Array(event.data, header.headerSize)], {
+            type: IMAGE_FORMAT_MIME_TYPE_DICT[header.imageFormat],
+        });
+
+        var decodeStartTime = performance.now();
+        var decodeMs = 0;
+        var bitmapPromise = createImageBitmap(blob).then(function (bitmap) {
+            decodeMs = performance.now() - decodeStartTime;
+            return bitmap;
+        });
+        drawQueue = drawQueue.then(function () {
+            return bitmapPromise;
+        }).then(function (bitmap) {
+            if ((canvas.width !== header.frameWidth) || (canvas.height !== header.frameHeight)) {
+                canvas.width = header.frameWidth;
+                canvas.height = header.frameHeight;
+            }
+
+            context.drawImage(bitmap, header.x, header.y);
+            bitmap.close();
+            if (overlay) {
+                overlay.onFrameDrawn({
+                    sequenceNumber: header.sequenceNumber,
+                    captureTimestamp: header.captureTimestamp,
+                    decodeMs: decodeMs,
+                });
+            }
+        }).catch(function (error) {
+            console.error(error);
+        });
+    };
+
+    socket.onclose = function () {
+        console.log('image stream websocket closed');
+    };
+
+    // change the stream parameters without reconnecting by editing the url hash
+    window.addEventListener('hashchange', function () {
+        if (socket.readyState === WebSocket.OPEN) {
+            socket.send(JSON.stringify(parseStreamParameters(window.location.hash.substring(1))));
+        }
+    });
+}
+
+function startImageStream(url) {
+    var imageElement = document.createElement('img');
+    container.innerHTML = '';
+    container.appendChild(imageElement);
+    setTimeout(function () {
+        imageElement.src = url;
+    });
+}
+
+// draw the cursor sent over /cursor/ws on top of the stream, the stream itself is requested with cursor=overlay
+function startCursorOverlay(queryString) {
+    var cursorElement = document.createElement('img');
+    cursorElement.className = 'cursor-overlay';
+    cursorElement.style.display = 'none';
+    document.body.appendChild(cursorElement);
+
+    var protocol = (window.location.protocol === 'https:') ? 'wss:' : 'ws:';
+    var socket = new WebSocket(`${protocol}//${window.location.host}/cursor/ws${queryString}`);
+    socket.binaryType = 'arraybuffer';
+
+    var sprite = null;
+    var position = null;
+
+    function placeCursor() {
+        if (!position) {
+            return;
+        }
+
+        var x = position.x;
+        var y = position.y;
+        var element = container.firstChild;
+        if (!sprite || !element || (x < 0) || (y < 0) || (x >= sprite.region_width) || (y >= sprite.region_height)) {
+            cursorElement.style.display = 'none';
+            return;
+        }
+
+        // from screen pixels to the size the stream is displayed at
+        var rect = element.getBoundingClientRect();
+        var scale = rect.width / sprite.region_width;
+        cursorElement.style.width = `${sprite.width * scale}px`;
+        cursorElement.style.height = `${sprite.height * scale}px`;
+        cursorElement.style.transform = `translate(${rect.left + x * scale}px, ${rect.top + y * (rect.height / sprite.region_height)}px)`;
+        cursorElement.style.display = '';
+    }
+
+    socket.onmessage = function (event) {
+        if (typeof event.data === 'string') {
+            sprite = JSON.parse(event.data);
+            cursorElement.src = sprite.image;
+            return;
+        }
+
+        // keep in sync with CURSOR_POSITION_STRUCT in remotedesktopwebserver.py
+        var view = new DataView(event.data);
+        position = {
+            x: view.getInt32(0, true),
+            y: view.getInt32(4, true),
+        };
+        placeCursor();
+    };
+
+    // the stream moves or changes size on the page while the cursor may stay still
+    window.addEventListener('resize', placeCursor);
+    window.addEventListener('scroll', placeCursor);
+    // e.g. when the first frame gives the stream its size
+    new ResizeObserver(placeCursor).observe(container);
+
+    socket.onclose = function () {
+        console.log('cursor websocket closed');
+        position = null;
+        cursorElement.style.display = 'none';
+    };
+}
+
+// send the mouse and keyboard events over /input/ws, the server needs --allow-input
+// the same query string as the stream so that the positions map to the same monitor or region
+function startInputChannel(queryString) {
+    var protocol = (window.location.protocol === 'https:') ? 'wss:' : 'ws:';
+    var socket = new WebSocket(`${protocol}//${window.location.host}/input/ws${queryString}`);
+
+    function send(event) {
+        if (socket.readyState === WebSocket.OPEN) {
+            socket.send(JSON.stringify(event));
+        }
+    }
+
+    // position relative to the image or canvas of the stream, 0 to 1
+    function getPosition(event) {
+        var element = container.firstChild;
+        if (!element) {
+            return null;
+        }
+
+        var rect = element.getBoundingClientRect();
+        if ((rect.width === 0) || (rect.height === 0)) {
+            return null;
+        }
+
+        return {
+            x: (event.clientX - rect.left) / rect.width,
+            y: (event.clientY - rect.top) / rect.height,
+        };
+    }
+
+    // at most one move per animation frame, the server only applies the latest one anyway
+    var pendingPosition = null;
+    function sendPendingPosition() {
+        if (pendingPosition) {
+            send({ type: 'move', x: pendingPosition.x, y: pendingPosition.y });
+            pendingPosition = null;
+        }
+    }
+
+    container.addEventListener('mousemove', function (event) {
+        var position = getPosition(event);
+        if (!position) {
+            return;
+        }
+
+        if (!pendingPosition) {
+            requestAnimationFrame(sendPendingPosition);
+        }
+        pendingPosition = position;
+    });
+
+    var MOUSE_BUTTON_NAME_LIST = ['left', 'middle', 'right'];
+    function onMouseButton(type, event) {
+        var button = MOUSE_BUTTON_NAME_LIST[event.button];
+        var position = getPosition(event);
+        if (!button || !position) {
+            return;
+        }
+
+        event.preventDefault();
+        // press where the pointer is even if the last move is still pending
+        pendingPosition = null;
+        send({ type: 'move', x: position.x, y: position.y });
+        send({ type: type, button: button });
+    }
+
+    container.addEventListener('mousedown', function (event) {
+        onMouseButton('down', event);
+    });
+    container.addEventListener('mouseup', function (event) {
+        onMouseButton('up', event);
+    });
+    container.addEventListener('contextmenu', function (event) {
+        event.preventDefault();
+    });
+    container.addEventListener('wheel', function (event) {
+        event.preventDefault();
+        // one step per event, wheel up scrolls up
+        send({ type: 'scroll', dx: Math.sign(event.deltaX), dy: -Math.sign(event.deltaY) });
+    }, { passive: false });
+
+    window.addEventListener('keydown', function (event) {
+        event.preventDefault();
+        // the key is what is typed, the code is the physical key which the server releases
+        send({ type: 'keydown', key: event.key, code: event.code });
+    });
+    window.addEventListener('keyup', function (event) {
+        event.preventDefault();
+        send({ type: 'keyup', key: event.key, code: event.code });
+    });
+
+    // the key up events of a tab in the background never arrive
+    window.addEventListener('blur', function () {
+        send({ type: 'release' });
+    });
+    document.addEventListener('visibilitychange', function () {
+        if (document.hidden) {
+            send({ type: 'release' });
+        }
+    });
+
+    socket.onclose = function () {
+        console.log('input websocket closed');
+    };
+}
+
+// e.g. ?overlay&format=jpg to compare the latency of different settings
+var latencyOverlay = searchParams.has('overlay') ? createLatencyOverlay() : null;
+
+if (searchParams.has('replay')) {
+    // e.g. ?replay&ago=60&speed=4, add preview for the reduced resolution history
+    startImageStream(`/replay${window.location.search}`);
+} else if (searchParams.get('transport') === 'ws') {
+    startWebSocketStream(window.location.search, latencyOverlay);
+} else if ((searchParams.get('mode') === 'tiles') || (searchParams.get('mode') === 'stripes') || latencyOverlay) {
+    // an <img> does not expose the part headers
+    startCanvasStream(imagestreamUrl, latencyOverlay);
+} else {
+    startImageStream(imagestreamUrl);
+}
+
+// e.g. ?input&viewonly to join a session without controlling it
+if (searchParams.has('input') && !searchParams.has('replay')) {
+    startInputChannel(window.location.search);
+}
+
+// e.g. ?cursor=overlay&fps=5, the cursor stays smooth at a low frame rate and moving it encodes nothing
+if ((searchParams.get('cursor') === 'overlay') && !searchParams.has('replay')) {
+    startCursorOverlay(window.location.search);
+}